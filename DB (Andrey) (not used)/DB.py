@@ -1,79 +1,391 @@
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
-from io import StringIO
+from contextlib import closing
+import io
+import logging
+import os
+import sqlite3
 import pandas as pd
-from sqlalchemy.sql import text
+
+from schema import FLAG_COLUMNS, OFFICES, create_schema
+from ingest import (IngestBusyError, IngestError, active_run, enable_wal, get_run, ingest_csv, ingest_frames,
+                    seed_place_hashes)
+from walk_times import recompute_walk_times
+from storage import ReadPool, fetch_page, stream_csv
+from autoparse import sync_dumps
+from metrics import LOAD_SECONDS, QUERY_SECONDS, init_app
 
 app = Flask(__name__)
-uri = 'sqlite:///mydatabase.db'
+uri = os.getenv('DATABASE_URI', 'sqlite:///mydatabase.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = uri
 
 db = SQLAlchemy(app)
 
-@app.route('/get_office_1', methods=['GET'])
-def get_office_1():
-    query = """SELECT name, id, address_name, price_limit, `Европейская кухня`,
-                    `Паназиатская кухня`, `Русская кухня`, `Американская кухня`,
-                    `Грузинская кухня`, `Постное меню`, `Вегетарианское меню`,
-                    Cuisine, price_limit, office_1_time,  reviews_general_rating, reviews_general_review_count FROM Place WHERE near_office_1=TRUE"""
-    df = pd.read_sql(query, db.engine)
-    return df.to_csv()
-    
-@app.route('/get_office_2', methods=['GET'])
-def get_office_2():
-    query = """SELECT name, id, address_name, price_limit, `Европейская кухня`,
-                    `Паназиатская кухня`, `Русская кухня`, `Американская кухня`,
-                    `Грузинская кухня`, `Постное меню`, `Вегетарианское меню`,
-                    Cuisine,
-                    price_limit, office_2_time,  reviews_general_rating, reviews_general_review_count FROM Place WHERE near_office_2=TRUE"""
-    df = pd.read_sql(query, db.engine)
-    return df.to_csv()
-
-@app.route('/get_office_3', methods=['GET'])
-def get_office_3():
-    query = """SELECT name, id, address_name, price_limit, `Европейская кухня`,
-                    `Паназиатская кухня`, `Русская кухня`, `Американская кухня`,
-                    `Грузинская кухня`, `Постное меню`, `Вегетарианское меню`,
-                    Cuisine,
-                    price_limit, office_3_time,  reviews_general_rating, reviews_general_review_count FROM Place WHERE near_office_3=TRUE"""
-    df = pd.read_sql(query, db.engine)
-    return df.to_csv()
-
-
-def preprocess_csv(csv_data):
-    required_columns = required_columns = ['name', 'id', 'address_name', 'Европейская кухня',
-                    'Паназиатская кухня', 'Русская кухня', 'Американская кухня',
-                    'Грузинская кухня', 'Постное меню', 'Вегетарианское меню',
-                    'Average bill', 'point_lat', 'point_lon', 'Cuisine',
-                    'near_office_1', 'near_office_2', 'near_office_3',
-                    'office_1_time', 'office_2_time', 'office_3_time',
-                    'reviews_general_review_count', 'reviews_general_rating']
-    csv_file = StringIO(csv_data)
-    df = pd.read_csv(csv_file)
-    df['near_office_1'] = df['near_office_1'].fillna(False)
-    df['near_office_2'] = df['near_office_2'].fillna(False)
-    df['near_office_3'] = df['near_office_3'].fillna(False)
-    df = df[required_columns]
-    df = df.dropna(subset=required_columns)
-    df = df.rename(columns={'Average bill': 'price_limit'})
-    df.to_sql('Place', db.engine)
+# Массовая загрузка CSV (WAL, прагмы на время загрузки, одна транзакция) – см. benchmark_ingest.py
+INGEST_BULK = os.getenv('INGEST_BULK', '1') == '1'
+# Сколько read-only соединений держит каждый воркер (обычно – по числу потоков gunicorn)
+READ_POOL_SIZE = int(os.getenv('READ_POOL_SIZE', '4'))
+# Каталог с выгрузками парсера для /sync_dumps – см. autoparse.py
+DUMP_DIR = os.getenv('DUMP_DIR', 'dumps')
+
+# Один параметризованный запрос вместо отдельного SQL на каждый офис.
+# Колонки-признаки собираются из place_cuisines, чтобы новые кухни не требовали смены схемы.
+# Внутренний запрос отбирает заведения (фильтры по индексам office_place и places),
+# внешний – собирает выбранные поля только для отобранных.
+OFFICE_QUERY = """SELECT {select}
+                FROM ({candidates}) op
+                JOIN places p ON p.id = op.place_id
+                {joins}
+                GROUP BY p.id
+                ORDER BY {order}"""
+
+# Поля ответа офиса: имя колонки -> выражение SQL
+OFFICE_FIELDS = {
+    'name': 'p.name',
+    'id': 'p.id',
+    'address_name': 'p.address_name',
+    'price_limit': 'p.price_limit',
+    **{flag: f'COALESCE(MAX(c.name = :flag_{i}), 0)' for i, flag in enumerate(FLAG_COLUMNS)},
+    'Cuisine': 'p.cuisine',
+    'office_time': 'op.walk_time',
+    'reviews_general_rating': 'p.reviews_general_rating',
+    'reviews_general_review_count': 'p.reviews_general_review_count',
+    'dishes': 'p.dishes'
+}
+# Колонки по умолчанию – те, что ждёт сервис рекомендаций; остальные – только через fields
+OFFICE_COLUMNS = [field for field in OFFICE_FIELDS if field != 'dishes']
+
+# Признаки кухонь требуют присоединения связей заведение-кухня
+CUISINE_JOINS = """LEFT JOIN place_cuisines pc ON pc.place_id = p.id
+                LEFT JOIN cuisines c ON c.id = pc.cuisine_id"""
+
+PLACES_QUERY = """SELECT {select} FROM places p {where} ORDER BY p.id {limit}"""
+PLACE_COLUMNS = ['id', 'name', 'address_name', 'price_limit', 'point_lat', 'point_lon', 'cuisine',
+                 'reviews_general_rating', 'reviews_general_review_count', 'dishes']
+
+# Заведение удалено – поля places пустые
+CHANGES_QUERY = f"""SELECT ch.id AS change_id, ch.run_id, ch.change, ch.place_id,
+                        {', '.join(f'p.{column}' for column in PLACE_COLUMNS[1:])}
+                    FROM place_changes ch
+                    LEFT JOIN places p ON p.id = ch.place_id AND ch.change != 'deleted'
+                    WHERE ch.id > :after
+                    ORDER BY ch.id
+                    LIMIT :limit"""
+
+# Порядок и условие постраничной выдачи (keyset): следующая страница – заведения с id больше курсора
+PAGE_ORDER = 'op.place_id'
+PAGE_CONDITION = 'op.place_id > :after'
+MAX_PAGE_ROWS = 10000
+
+CANDIDATES_QUERY = """SELECT op.place_id, op.walk_time
+                FROM office_place op
+                JOIN places p ON p.id = op.place_id
+                WHERE op.office_id = :office_id AND op.near = 1 {filters}
+                ORDER BY {order} {limit}"""
+
+# Жёсткие ограничения /candidates: параметр запроса -> условие SQL
+CANDIDATE_FILTERS = {
+    'max_walk': 'op.walk_time <= :max_walk',
+    'max_price': 'p.price_limit <= :max_price',
+    'min_rating': 'p.reviews_general_rating >= :min_rating'
+}
+
+# Дешёвая предварительная оценка для ограничения числа кандидатов: рейтинг, отзывы, близость
+PREFILTER_ORDER = 'p.reviews_general_rating DESC, p.reviews_general_review_count DESC, op.walk_time'
+
+
+def cuisine_filter(names, prefix, require_all):
+    """
+    Условие на кухни заведения: все из names (require_all) или ни одной из них.
+    Возвращает (SQL, параметры).
+    """
+    names = list(dict.fromkeys(names))
+    params = {f'{prefix}_{i}': name for i, name in enumerate(names)}
+    subquery = (f"SELECT pc.place_id FROM place_cuisines pc JOIN cuisines c ON c.id = pc.cuisine_id "
+                f"WHERE c.name IN ({', '.join(':' + name for name in params)})")
+    if require_all:
+        params[f'{prefix}_count'] = len(names)
+        return f'p.id IN ({subquery} GROUP BY pc.place_id HAVING COUNT(*) = :{prefix}_count)', params
+    return f'p.id NOT IN ({subquery})', params
+
+
+def office_places_query(office_id, conditions=(), params=None, order='op.walk_time', limit=None, fields=None):
+    """
+    Запрос заведений рядом с офисом в формате, который ждёт сервис рекомендаций (колонка office_N_time,
+    признаки кухонь 0/1). conditions – дополнительные условия отбора на SQL, fields – колонки ответа.
+    Возвращает (SQL, параметры, заголовок CSV).
+    """
+    fields = fields or OFFICE_COLUMNS
+    params = dict(params or {}, office_id=office_id)
+    params.update({f'flag_{i}': flag for i, flag in enumerate(FLAG_COLUMNS)})
+    if limit:
+        params['limit'] = limit
+    sql = OFFICE_QUERY.format(
+        select=', '.join(OFFICE_FIELDS[field] for field in fields),
+        candidates=candidates_query(conditions, order, 'LIMIT :limit' if limit else ''),
+        joins=CUISINE_JOINS if any(field in FLAG_COLUMNS for field in fields) else '',
+        order=order
+    )
+    # Сервис рекомендаций ожидает колонку office_N_time
+    header = [field if field != 'office_time' else f'office_{office_id}_time' for field in fields]
+    return sql, params, header
+
+
+def candidates_query(conditions, order, limit=''):
+    return CANDIDATES_QUERY.format(filters=''.join(f' AND {condition}' for condition in conditions),
+                                   order=order, limit=limit)
+
+
+def page_args(columns, default_fields, aliases=None):
+    """
+    Параметры постраничной выдачи: after – id последнего заведения предыдущей страницы,
+    limit – размер страницы, fields – колонки через запятую. Возвращает (after, limit, fields)
+    или строку с ошибкой.
+    """
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and not 0 < limit <= MAX_PAGE_ROWS:
+        return f'limit должен быть от 1 до {MAX_PAGE_ROWS}.'
+    fields = request.args.get('fields')
+    fields = [(aliases or {}).get(field, field) for field in fields.split(',')] if fields else default_fields
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        return 'Неизвестные поля: ' + ', '.join(unknown)
+    return after, limit, fields
+
+
+def csv_response(sql, params, header=None):
+    """
+    Потоковый CSV-ответ.
+    """
+    return Response(stream_csv(read_pool, sql, params, header, query=request.endpoint), mimetype='text/csv')
+
+
+def page_response(sql, params, limit, header=None):
+    """
+    CSV-ответ со страницей из limit строк; курсор следующей страницы – в заголовке X-Next-Cursor.
+    Последняя колонка sql – id заведения для курсора.
+    """
+    body, cursor = fetch_page(read_pool, sql, params, limit, header, query=request.endpoint)
+    response = Response(body, mimetype='text/csv')
+    if cursor is not None:
+        response.headers['X-Next-Cursor'] = str(cursor)
+    return response
+
+
+def connect():
+    """
+    Отдельное соединение sqlite3 с ручным управлением транзакциями – для схемы и загрузок.
+    """
+    return sqlite3.connect(db_path, isolation_level=None, timeout=30)
+
+
+@app.route('/get_office/<int:office_id>', methods=['GET'])
+@app.route('/get_office_<int:office_id>', methods=['GET'])
+def get_office(office_id):
+    """
+    Заведения рядом с офисом. Без параметров – все, по времени в пути.
+    С after и/или limit – страницы по возрастанию id (курсор следующей – в X-Next-Cursor);
+    fields – нужные колонки.
+    """
+    args = page_args(list(OFFICE_FIELDS), OFFICE_COLUMNS, aliases={f'office_{office_id}_time': 'office_time'})
+    if isinstance(args, str):
+        return args, 400
+    after, limit, fields = args
+    if after is None and limit is None:
+        return csv_response(*office_places_query(office_id, fields=fields))
+
+    conditions, params = [], {'office_id': office_id}
+    if after is not None:
+        conditions.append(PAGE_CONDITION)
+        params['after'] = after
+    if not limit:
+        return csv_response(*office_places_query(office_id, conditions, params, order=PAGE_ORDER, fields=fields))
+    # id заведения – последней колонкой, для курсора
+    sql, params, header = office_places_query(office_id, conditions, params, order=PAGE_ORDER, limit=limit,
+                                              fields=fields + ['id'])
+    return page_response(sql, params, limit, header[:-1])
+
+
+@app.route('/candidates', methods=['GET'])
+def get_candidates():
+    """
+    Кандидаты для рекомендации с жёсткими ограничениями, вычисляемыми в SQL:
+    office_id (обязателен), max_price, max_walk, min_rating, cuisine / exclude_cuisine
+    (можно повторять: нужны все cuisine и ни одной exclude_cuisine), limit – не больше
+    limit лучших по PREFILTER_ORDER. Формат ответа – как у /get_office.
+    """
+    office_id = request.args.get('office_id', type=int)
+    if office_id is None:
+        return "Не указан office_id.", 400
+    conditions = []
+    params = {}
+    for name, condition in CANDIDATE_FILTERS.items():
+        value = request.args.get(name, type=float)
+        if value is not None:
+            conditions.append(condition)
+            params[name] = value
+    for arg, prefix, require_all in (('cuisine', 'req', True), ('exclude_cuisine', 'exc', False)):
+        names = request.args.getlist(arg)
+        if names:
+            condition, cuisine_params = cuisine_filter(names, prefix, require_all)
+            conditions.append(condition)
+            params.update(cuisine_params)
+    limit = request.args.get('limit', type=int)
+    return csv_response(*office_places_query(office_id, conditions, params, order=PREFILTER_ORDER, limit=limit))
+
+
+def migrate_legacy_place():
+    """
+    Переносит данные из старой «широкой» таблицы Place в нормализованную схему (один раз).
+    Сама таблица Place не удаляется.
+    """
+    with closing(connect()) as conn:
+        has_legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Place'").fetchone()
+        if not has_legacy or conn.execute('SELECT 1 FROM places LIMIT 1').fetchone():
+            return
+        df = pd.read_sql('SELECT * FROM Place', conn).rename(columns={'price_limit': 'Average bill'})
+        try:
+            ingest_frames(conn, [df], bulk=INGEST_BULK)
+        except IngestBusyError:
+            # Миграцию уже выполняет другой воркер
+            logging.info('Перенос таблицы Place выполняется в другом процессе')
+
 
 @app.route('/upload_csv', methods=['POST'])
 def upload_csv():
-    with app.app_context():
-        db.session.execute(text('DROP TABLE IF EXISTS Place;'))
-        db.session.commit()
+    """
+    Потоковая загрузка CSV: файл читается порциями в staging-таблицы,
+    рабочие таблицы подменяются только после успешной загрузки всего файла.
+    """
     file = request.files.get('data')
-    csv_data = file.read().decode('utf-8')
-    preprocess_csv(csv_data)
-    return "Данные из CSV успешно добавлены в базу данных.", 200
+    if file is None:
+        return "Не передан файл data.", 400
+    try:
+        with closing(connect()) as conn:
+            with LOAD_SECONDS.labels('csv').time():
+                run = ingest_csv(conn, io.TextIOWrapper(file.stream, encoding='utf-8'), bulk=INGEST_BULK)
+    except IngestBusyError as e:
+        return str(e), 409
+    except IngestError as e:
+        return str(e), 400
+    return (f"Данные из CSV успешно добавлены в базу данных: загружено {run['rows_loaded']} строк, "
+            f"отброшено {run['rows_rejected']}."), 200
+
+
+@app.route('/upload_status')
+def upload_status():
+    with closing(connect()) as conn:
+        run = get_run(conn)
+    if run is None:
+        return jsonify({'state': 'none'})
+    return jsonify(run)
+
+
+@app.route('/sync_dumps', methods=['POST'])
+def sync_dump_files():
+    """
+    Инкрементальная загрузка выгрузок парсера из DUMP_DIR:
+    записываются только новые, изменившиеся и пропавшие заведения.
+    """
+    try:
+        with closing(connect()) as conn:
+            with LOAD_SECONDS.labels('dump').time():
+                run = sync_dumps(conn, DUMP_DIR)
+    except IngestBusyError as e:
+        return str(e), 409
+    except (IngestError, OSError) as e:
+        return str(e), 400
+    return jsonify(run)
+
+
+@app.route('/changes')
+def get_changes():
+    """
+    Изменения заведений после загрузок выгрузок: after – id последнего полученного изменения,
+    limit – сколько изменений вернуть. Для добавленных и изменённых – текущие данные заведения.
+    """
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', 1000, type=int)
+    if not 0 < limit <= MAX_PAGE_ROWS:
+        return f'limit должен быть от 1 до {MAX_PAGE_ROWS}.', 400
+    with read_pool.connection() as conn, QUERY_SECONDS.labels('changes').time():
+        cursor = conn.execute(CHANGES_QUERY, {'after': after, 'limit': limit})
+        columns = [column[0] for column in cursor.description]
+        changes = [dict(zip(columns, row)) for row in cursor]
+    return jsonify({'changes': changes, 'next': changes[-1]['change_id'] if changes else after})
+
+
+@app.route('/offices/<int:office_id>', methods=['POST'])
+def put_office(office_id):
+    """
+    Добавляет или меняет офис (JSON: name, lat, lon) и пересчитывает время в пути до всех заведений.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        lat, lon = float(data['lat']), float(data['lon'])
+    except (KeyError, TypeError, ValueError):
+        return "Нужны координаты офиса lat и lon.", 400
+    with closing(connect()) as conn:
+        if active_run(conn):
+            return "Идёт загрузка данных, попробуйте позже.", 409
+        conn.execute('INSERT INTO offices (id, name, lat, lon) VALUES (?, ?, ?, ?) '
+                     'ON CONFLICT (id) DO UPDATE SET name = excluded.name, lat = excluded.lat, lon = excluded.lon',
+                     (office_id, data.get('name') or f'Офис {office_id}', lat, lon))
+        with LOAD_SECONDS.labels('walk_times').time():
+            rows = recompute_walk_times(conn, office_ids=[office_id])
+    return jsonify({'office_id': office_id, 'rows': rows})
+
+
+@app.route('/recompute_walk_times', methods=['POST'])
+def recompute_all_walk_times():
+    """
+    Пересчитывает время в пути для всех офисов; speed (м/мин) можно передать в запросе. С radius (м)
+    признак near всех пар тоже пересчитывается по радиусу, без него – сохраняется.
+    """
+    with closing(connect()) as conn:
+        if active_run(conn):
+            return "Идёт загрузка данных, попробуйте позже.", 409
+        with LOAD_SECONDS.labels('walk_times').time():
+            rows = recompute_walk_times(conn, speed=request.args.get('speed', type=float),
+                                        radius=request.args.get('radius', type=float))
+    return jsonify({'rows': rows})
+
+
+def seed_office_coordinates(conn):
+    """
+    Проставляет координаты офисов по умолчанию в базе, созданной до их появления в схеме,
+    и пересчитывает для них время в пути.
+    """
+    missing = [office_id for office_id, in conn.execute('SELECT id FROM offices WHERE lat IS NULL OR lon IS NULL')
+               if office_id in OFFICES]
+    for office_id in missing:
+        conn.execute('UPDATE offices SET lat = ?, lon = ? WHERE id = ?',
+                     (OFFICES[office_id]['lat'], OFFICES[office_id]['lon'], office_id))
+    if missing:
+        recompute_walk_times(conn, office_ids=missing)
+
 
 @app.route('/places')
 def get_places():
-    query = "SELECT name, address_name FROM Place"
-    df = pd.read_sql(query, db.engine)
-    print(df['name'])
-    return df.to_csv()
+    """
+    Заведения по возрастанию id: after – курсор (id последнего заведения предыдущей страницы),
+    limit – размер страницы, fields – колонки (по умолчанию name,address_name).
+    Курсор следующей страницы – в заголовке X-Next-Cursor.
+    """
+    args = page_args(PLACE_COLUMNS, ['name', 'address_name'])
+    if isinstance(args, str):
+        return args, 400
+    after, limit, fields = args
+    params = {'after': after}
+    where = 'WHERE p.id > :after' if after is not None else ''
+    select = ', '.join(f'p.{field}' for field in fields)
+    if not limit:
+        return csv_response(PLACES_QUERY.format(select=select, where=where, limit=''), params)
+    # id заведения – последней колонкой, для курсора
+    sql = PLACES_QUERY.format(select=f'{select}, p.id', where=where, limit='LIMIT :limit')
+    return page_response(sql, params, limit, fields)
+
 
 @app.route('/hello', methods=['POST'])
 def hello():
@@ -83,5 +395,20 @@ def hello():
 def index_page():
     return 'hello'
 
+
+with app.app_context():
+    db_path = db.engine.url.database
+    with closing(connect()) as conn:
+        # WAL: чтение из пула не блокируется загрузкой, а загрузка – чтением
+        enable_wal(conn)
+        create_schema(conn)
+    migrate_legacy_place()
+    with closing(connect()) as conn:
+        seed_office_coordinates(conn)
+        seed_place_hashes(conn)
+# Соединения открываются лениво, отдельно в каждом воркере
+read_pool = ReadPool(db_path, size=READ_POOL_SIZE)
+init_app(app, read_pool)
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,240 @@
+"""
+Инкрементальная загрузка заведений из выгрузок парсера (JSON Lines, можно .jsonl.gz).
+
+Каждая строка выгрузки – заведение в формате каталога 2GIS:
+
+    {"id": "70000001062703679_...", "name": "Harbor, ресторан", "address_name": "9-я Советская улица, 3",
+     "point": {"lat": 59.93, "lon": 30.37}, "average_bill": 1600,
+     "cuisines": ["Американская кухня", "Европейская кухня"], "attributes": ["Вегетарианское меню"],
+     "reviews": {"general_rating": 4.6, "general_review_count": 7}, "dishes": ["бургер", "стейк"]}
+
+Для каждого заведения считается хэш содержимого; перезаписываются только новые и изменившиеся,
+заведения, пропавшие из выгрузки, удаляются. Изменения каждого запуска пишутся в place_changes.
+
+    python autoparse.py dumps/                          # один запуск
+    python autoparse.py dumps/ --every-minutes 1440     # раз в сутки
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from ingest import IngestError, content_hash, get_run, start_run, update_run
+from schema import create_schema
+from walk_times import UPSERT_WALK_TIME, office_coordinates, office_place_rows
+
+# Сколько заведений записываем одной транзакцией
+BATCH_RECORDS = 2000
+# Изменения скольких последних запусков хранить в place_changes
+KEEP_CHANGE_RUNS = 30
+
+UPSERT_PLACE = """INSERT INTO places (id, name, address_name, price_limit, point_lat, point_lon, cuisine,
+                      reviews_general_review_count, reviews_general_rating, dishes)
+                  VALUES (:id, :name, :address_name, :price_limit, :point_lat, :point_lon, :cuisine,
+                      :reviews_general_review_count, :reviews_general_rating, :dishes)
+                  ON CONFLICT (id) DO UPDATE SET
+                      name = excluded.name, address_name = excluded.address_name, price_limit = excluded.price_limit,
+                      point_lat = excluded.point_lat, point_lon = excluded.point_lon, cuisine = excluded.cuisine,
+                      reviews_general_review_count = excluded.reviews_general_review_count,
+                      reviews_general_rating = excluded.reviews_general_rating, dishes = excluded.dishes"""
+
+
+def dump_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*.jsonl')) + glob.glob(os.path.join(path, '*.jsonl.gz')))
+    return [path]
+
+
+def read_records(paths):
+    """
+    Записи всех файлов выгрузки по очереди; нечитаемая строка отдаётся как None.
+    """
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    yield None
+
+
+def flatten_record(record):
+    """
+    Приводит запись выгрузки к колонкам таблицы places (+ список кухонь и признаков).
+    None, если у записи нет id, названия или координат.
+    """
+    try:
+        point = record.get('point') or {}
+        place = {
+            # В 2GIS id филиала бывает вида "<id>_<хэш>"
+            'id': int(str(record['id']).split('_')[0]),
+            'name': record['name'],
+            'address_name': record.get('address_name'),
+            'price_limit': record.get('average_bill'),
+            'point_lat': float(point['lat']),
+            'point_lon': float(point['lon'])
+        }
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    reviews = record.get('reviews') or {}
+    cuisines = [name.strip() for name in record.get('cuisines') or [] if name.strip()]
+    place.update({
+        'cuisine': '; '.join(cuisines) or None,
+        'reviews_general_rating': reviews.get('general_rating'),
+        'reviews_general_review_count': reviews.get('general_review_count'),
+        'dishes': '; '.join(record.get('dishes') or []) or None,
+        'cuisines': sorted(set(cuisines) | {name.strip() for name in record.get('attributes') or [] if name.strip()})
+    })
+    return place
+
+
+def cuisine_id(conn, cuisine_ids, name):
+    if name not in cuisine_ids:
+        conn.execute('INSERT OR IGNORE INTO cuisines (name) VALUES (?)', (name,))
+        cuisine_ids[name] = conn.execute('SELECT id FROM cuisines WHERE name = ?', (name,)).fetchone()[0]
+    return cuisine_ids[name]
+
+
+def apply_batch(conn, run_id, batch, cuisine_ids, offices):
+    """
+    Записывает новые и изменившиеся заведения одной транзакцией.
+    batch – список (заведение, хэш, вид изменения 'added'/'updated').
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        place_ids = [(place['id'],) for place, _, _ in batch]
+        conn.executemany(UPSERT_PLACE, [place for place, _, _ in batch])
+        conn.executemany('DELETE FROM place_cuisines WHERE place_id = ?', place_ids)
+        conn.executemany('INSERT OR IGNORE INTO place_cuisines (place_id, cuisine_id) VALUES (?, ?)', [
+            (place['id'], cuisine_id(conn, cuisine_ids, name)) for place, _, _ in batch for name in place['cuisines']
+        ])
+        # Время в пути пересчитывается, признак near у известных пар сохраняется (см. walk_times.py)
+        conn.executemany(UPSERT_WALK_TIME,
+                         office_place_rows([place['id'] for place, _, _ in batch],
+                                           [place['point_lat'] for place, _, _ in batch],
+                                           [place['point_lon'] for place, _, _ in batch], offices))
+        conn.executemany('INSERT OR REPLACE INTO place_hashes (place_id, hash) VALUES (?, ?)',
+                         [(place['id'], place_hash) for place, place_hash, _ in batch])
+        conn.executemany('INSERT INTO place_changes (run_id, place_id, change) VALUES (?, ?, ?)',
+                         [(run_id, place['id'], change) for place, _, change in batch])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def delete_places(conn, run_id, place_ids):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = [(place_id,) for place_id in place_ids]
+        for table, column in (('places', 'id'), ('place_cuisines', 'place_id'),
+                              ('office_place', 'place_id'), ('place_hashes', 'place_id')):
+            conn.executemany(f'DELETE FROM {table} WHERE {column} = ?', rows)
+        conn.executemany("INSERT INTO place_changes (run_id, place_id, change) VALUES (?, ?, 'deleted')",
+                         [(run_id, place_id) for place_id in place_ids])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def sync_dumps(conn, path):
+    """
+    Загружает выгрузку (файл или каталог с файлами) в рабочие таблицы, меняя только то,
+    что изменилось с прошлой загрузки. conn – соединение sqlite3 с isolation_level=None.
+    Возвращает запись о загрузке с итогами: added, updated, deleted, unchanged.
+    Каждая порция фиксируется отдельно; прерванную загрузку можно просто повторить.
+    """
+    paths = dump_files(path)
+    if not paths:
+        raise IngestError(f'В {path} нет файлов выгрузки')
+    run_id = start_run(conn, source='dump')
+    try:
+        known = dict(conn.execute('SELECT place_id, hash FROM place_hashes'))
+        cuisine_ids = {name: cuisine for cuisine, name in conn.execute('SELECT id, name FROM cuisines')}
+        offices = office_coordinates(conn)
+        seen = set()
+        counts = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        rows_read = rows_rejected = 0
+        batch = []
+        for record in read_records(paths):
+            rows_read += 1
+            place = flatten_record(record) if isinstance(record, dict) else None
+            if place is None:
+                rows_rejected += 1
+                continue
+            # Если заведение встречается в выгрузке несколько раз, берём первую запись
+            if place['id'] in seen:
+                continue
+            seen.add(place['id'])
+            place_hash = content_hash(place)
+            if known.get(place['id']) == place_hash:
+                counts['unchanged'] += 1
+                continue
+            change = 'updated' if place['id'] in known else 'added'
+            counts[change] += 1
+            batch.append((place, place_hash, change))
+            if len(batch) >= BATCH_RECORDS:
+                apply_batch(conn, run_id, batch, cuisine_ids, offices)
+                batch = []
+                update_run(conn, run_id, rows_read=rows_read, rows_rejected=rows_rejected,
+                           rows_loaded=counts['added'] + counts['updated'])
+        if batch:
+            apply_batch(conn, run_id, batch, cuisine_ids, offices)
+
+        if not seen:
+            # Пустая или битая выгрузка не должна удалить все заведения
+            raise IngestError('В выгрузке нет ни одного корректного заведения')
+        deleted = [place_id for place_id in known if place_id not in seen]
+        for start in range(0, len(deleted), BATCH_RECORDS):
+            delete_places(conn, run_id, deleted[start:start + BATCH_RECORDS])
+        counts['deleted'] = len(deleted)
+
+        prune_changes(conn)
+        update_run(conn, run_id, state='done', finished_at=time.time(), rows_read=rows_read,
+                   rows_rejected=rows_rejected, rows_loaded=counts['added'] + counts['updated'] + counts['deleted'])
+    except Exception as e:
+        update_run(conn, run_id, state='failed', finished_at=time.time(), error=str(e))
+        raise
+    logging.info('Загрузка выгрузки %s: %s', run_id, counts)
+    run = get_run(conn, run_id)
+    run.update(counts)
+    return run
+
+
+def prune_changes(conn):
+    conn.execute("""DELETE FROM place_changes WHERE run_id NOT IN (
+                        SELECT id FROM ingest_runs WHERE source = 'dump' ORDER BY id DESC LIMIT ?)""",
+                 (KEEP_CHANGE_RUNS,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='файл выгрузки или каталог с файлами *.jsonl / *.jsonl.gz')
+    parser.add_argument('--db', default='instance/mydatabase.db')
+    parser.add_argument('--every-minutes', type=float, default=0, help='повторять с этим интервалом')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    conn = sqlite3.connect(args.db, isolation_level=None, timeout=30)
+    conn.execute('PRAGMA journal_mode = WAL')
+    create_schema(conn)
+    while True:
+        try:
+            print(sync_dumps(conn, args.path))
+        except IngestError as e:
+            logging.error('Загрузка выгрузки не выполнена: %s', e)
+        if not args.every_minutes:
+            break
+        time.sleep(args.every_minutes * 60)
+
+
+if __name__ == '__main__':
+    main()
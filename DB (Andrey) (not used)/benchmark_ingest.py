@@ -0,0 +1,130 @@
+"""
+Бенчмарк загрузки заведений на синтетических CSV.
+
+Сравнивает три способа:
+  - to_sql   – исходная загрузка: весь CSV в память и df.to_sql в «широкую» таблицу Place;
+  - chunked  – потоковая загрузка ingest_csv с транзакцией на каждую порцию;
+  - bulk     – ingest_csv(bulk=True): WAL, LOAD_PRAGMAS, одна транзакция, индексы после данных.
+
+Каждый прогон выполняется в отдельном процессе, чтобы пиковая память (RSS) не смешивалась.
+
+    python benchmark_ingest.py                 # 100k и 1M строк
+    python benchmark_ingest.py --rows 100000 --modes chunked bulk
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from ingest import CHUNK_ROWS, ingest_csv
+from schema import FLAG_COLUMNS, create_schema
+
+MODES = ['to_sql', 'chunked', 'bulk']
+CUISINE_NAMES = ['Русская кухня', 'Европейская кухня', 'Паназиатская кухня', 'Американская кухня',
+                 'Грузинская кухня', 'Итальянская кухня', 'Японская кухня', 'Кофейня']
+
+
+def generate_csv(path, rows, chunk_rows=100000, seed=0):
+    """
+    Пишет синтетический CSV в формате выгрузки заведений (как ждёт /upload_csv).
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, rows, chunk_rows):
+        n = min(chunk_rows, rows - start)
+        ids = np.arange(start, start + n) + 70000001000000000
+        cuisine_idx = rng.integers(0, len(CUISINE_NAMES), size=(n, 2))
+        df = pd.DataFrame({
+            'name': [f'Заведение {i}' for i in range(start, start + n)],
+            'id': ids,
+            'address_name': [f'ул. Синтетическая, {i % 300}' for i in range(start, start + n)],
+            'Average bill': rng.integers(2, 40, size=n) * 100,
+            'point_lat': rng.uniform(59.85, 60.05, size=n),
+            'point_lon': rng.uniform(30.2, 30.45, size=n),
+            'Cuisine': [f'{CUISINE_NAMES[a]}; {CUISINE_NAMES[b]}' for a, b in cuisine_idx],
+            'reviews_general_review_count': rng.integers(0, 2000, size=n),
+            'reviews_general_rating': rng.uniform(3, 5, size=n).round(1)
+        })
+        for flag in FLAG_COLUMNS:
+            df[flag] = (rng.random(n) < 0.2).astype(int)
+        for office_id in (1, 2, 3):
+            walk = rng.uniform(1, 30, size=n).round(2)
+            df[f'near_office_{office_id}'] = walk <= 15
+            df[f'office_{office_id}_time'] = walk
+        df.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+
+def load_to_sql(csv_path, db_path):
+    """
+    Исходный способ загрузки (до потоковой загрузки): весь файл в DataFrame и df.to_sql.
+    """
+    from sqlalchemy import create_engine
+    df = pd.read_csv(csv_path)
+    df = df.dropna(subset=['name', 'id', 'address_name', 'Average bill', 'point_lat', 'point_lon', 'Cuisine'])
+    df = df.rename(columns={'Average bill': 'price_limit'})
+    df.to_sql('Place', create_engine(f'sqlite:///{db_path}'))
+    return len(df)
+
+
+def run_mode(mode, csv_path, db_path, chunk_rows, result):
+    started = time.perf_counter()
+    if mode == 'to_sql':
+        rows = load_to_sql(csv_path, db_path)
+    else:
+        conn = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+        create_schema(conn)
+        with open(csv_path, encoding='utf-8') as stream:
+            rows = ingest_csv(conn, stream, chunk_rows=chunk_rows, bulk=mode == 'bulk')['rows_loaded']
+        conn.close()
+    result['seconds'] = time.perf_counter() - started
+    result['rows'] = rows
+    # ru_maxrss в Linux – в килобайтах
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(rows, modes, chunk_rows, workdir):
+    csv_path = os.path.join(workdir, f'places_{rows}.csv')
+    if not os.path.exists(csv_path):
+        print(f'Генерируем {csv_path}...')
+        generate_csv(csv_path, rows)
+    size_mb = os.path.getsize(csv_path) / 2 ** 20
+
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        for mode in modes:
+            db_path = os.path.join(workdir, f'bench_{mode}_{rows}.db')
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+            result = manager.dict()
+            process = context.Process(target=run_mode, args=(mode, csv_path, db_path, chunk_rows, result))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f'{rows:>9} {mode:>8}  ошибка (код {process.exitcode})')
+                continue
+            print(f"{rows:>9} {mode:>8} {size_mb:>8.1f} МБ {result['seconds']:>8.2f} с "
+                  f"{result['rows'] / result['seconds']:>10.0f} строк/с {result['peak_rss_mb']:>8.1f} МБ RSS")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--workdir', default=None, help='каталог для CSV и баз (по умолчанию временный)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ingest_bench_')
+    print(f"{'строк':>9} {'режим':>8} {'CSV':>11} {'время':>10} {'скорость':>16} {'пик памяти':>15}")
+    for rows in args.rows:
+        benchmark(rows, args.modes, args.chunk_rows, workdir)
+
+
+if __name__ == '__main__':
+    main()
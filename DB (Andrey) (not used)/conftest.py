@@ -0,0 +1,66 @@
+"""
+Общие фикстуры тестов: копия базы из репозитория со старой «широкой» таблицей Place,
+загруженная в нормализованную схему, и клиент Flask-приложения поверх такой копии.
+"""
+import io
+import os
+import shutil
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from ingest import ingest_frames
+from schema import create_schema
+
+LEGACY_DB = Path(__file__).with_name('instance') / 'mydatabase.db'
+
+
+def legacy_places(conn):
+    """
+    Таблица Place в виде CSV для /upload_csv (средний чек там называется Average bill).
+    """
+    return pd.read_sql('SELECT * FROM Place', conn).rename(columns={'price_limit': 'Average bill'})
+
+
+def upload_legacy_places(conn):
+    """
+    Загружает таблицу Place так же, как /upload_csv (и перенос старой базы при старте).
+    """
+    return ingest_frames(conn, [legacy_places(conn)])
+
+
+@pytest.fixture
+def conn(tmp_path):
+    shutil.copy(LEGACY_DB, tmp_path / 'places.db')
+    conn = sqlite3.connect(tmp_path / 'places.db', isolation_level=None)
+    create_schema(conn)
+    upload_legacy_places(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def client(tmp_path_factory):
+    """
+    Клиент DB.py. Приложение настраивается при импорте, поэтому импортируется здесь,
+    после того как DATABASE_URI указывает на копию базы (старая таблица переносится при старте).
+    """
+    path = tmp_path_factory.mktemp('db') / 'places.db'
+    shutil.copy(LEGACY_DB, path)
+    previous = os.environ.get('DATABASE_URI')
+    os.environ['DATABASE_URI'] = f'sqlite:///{path}'
+    try:
+        import DB
+    finally:
+        if previous is None:
+            del os.environ['DATABASE_URI']
+        else:
+            os.environ['DATABASE_URI'] = previous
+    return DB.app.test_client()
+
+
+def read_csv_response(response):
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return pd.read_csv(io.StringIO(response.get_data(as_text=True)), index_col=0)
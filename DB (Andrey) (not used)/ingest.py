@@ -0,0 +1,365 @@
+import hashlib
+import json
+import logging
+import re
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from schema import FLAG_COLUMNS, OFFICES, STAGING_SUFFIX, TABLES, create_indexes, create_tables
+from walk_times import office_place_rows
+
+# Сколько строк CSV читаем и записываем за раз – ограничивает пиковую память загрузки
+CHUNK_ROWS = 5000
+# Загрузка со статусом running старше этого срока считается оборвавшейся
+STALE_RUN_SECONDS = 3600
+
+# Настройки SQLite на время массовой загрузки. Данные сначала пишутся в staging-таблицы,
+# поэтому при сбое теряется только сама загрузка, а рабочие таблицы не затрагиваются.
+LOAD_PRAGMAS = {
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 МБ страничного кэша
+    'temp_store': 'MEMORY'
+}
+
+REQUIRED_COLUMNS = ['name', 'id', 'address_name', 'Average bill', 'point_lat', 'point_lon', 'Cuisine',
+                    'reviews_general_review_count', 'reviews_general_rating']
+# Колонки CSV в порядке колонок INSERT INTO places (Dishes – необязательная)
+PLACE_COLUMNS = ['id', 'name', 'address_name', 'Average bill', 'point_lat', 'point_lon', 'Cuisine',
+                 'reviews_general_review_count', 'reviews_general_rating', 'Dishes']
+
+# Содержимое заведения для хэша (см. autoparse.py): колонки places и отсортированный список кухонь
+# и признаков. Числа приводятся к типам колонок, чтобы хэш записи выгрузки совпадал с хэшем,
+# посчитанным по таблицам после её записи.
+HASH_FIELDS = ['id', 'name', 'address_name', 'price_limit', 'point_lat', 'point_lon', 'cuisine',
+               'reviews_general_rating', 'reviews_general_review_count', 'dishes']
+REAL_FIELDS = ['price_limit', 'point_lat', 'point_lon', 'reviews_general_rating']
+INTEGER_FIELDS = ['reviews_general_review_count']
+STORED_PLACES_QUERY = f"""SELECT {', '.join(f'p.{field}' for field in HASH_FIELDS)},
+                              (SELECT group_concat(c.name, char(31)) FROM place_cuisines pc
+                               JOIN cuisines c ON c.id = pc.cuisine_id WHERE pc.place_id = p.id)
+                          FROM places p"""
+
+INSERTS = {
+    'places': """INSERT OR IGNORE INTO places{suffix} (id, name, address_name, price_limit, point_lat, point_lon,
+                    cuisine, reviews_general_review_count, reviews_general_rating, dishes)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    'cuisines': 'INSERT INTO cuisines{suffix} (id, name) VALUES (?, ?)',
+    'place_cuisines': 'INSERT OR IGNORE INTO place_cuisines{suffix} (place_id, cuisine_id) VALUES (?, ?)',
+    'offices': 'INSERT INTO offices{suffix} (id, name, lat, lon) VALUES (?, ?, ?, ?)',
+    'office_place': 'INSERT OR IGNORE INTO office_place{suffix} (office_id, place_id, walk_time, near) VALUES (?, ?, ?, ?)'
+}
+
+
+class IngestError(Exception):
+    """Загрузка отклонена: некорректный файл."""
+
+
+class IngestBusyError(IngestError):
+    """Загрузка отклонена: уже идёт другая загрузка."""
+
+
+def rows(df, columns):
+    """
+    Строки DataFrame как кортежи python-значений (sqlite3 не принимает numpy-типы).
+    """
+    return list(zip(*(df[column].tolist() for column in columns)))
+
+
+def normalize_chunk(df, cuisine_ids, offices):
+    """
+    Раскладывает порцию «широкой» таблицы заведений (одна колонка на кухню и на офис)
+    по строкам нормализованных таблиц. cuisine_ids – общий для всех порций словарь {кухня: id},
+    offices – {office_id: {'name', 'lat', 'lon'}}.
+    Возвращает ({таблица: строки}, число отброшенных строк).
+    """
+    valid = df.dropna(subset=REQUIRED_COLUMNS)
+    rejected = len(df) - len(valid)
+    valid = valid.astype({'id': 'int64'})
+    if 'Dishes' not in valid.columns:
+        valid = valid.assign(Dishes=None)
+    else:
+        valid = valid.assign(Dishes=valid['Dishes'].astype(object).where(valid['Dishes'].notna(), None))
+
+    places = rows(valid, PLACE_COLUMNS)
+
+    # Кухни: из колонок-признаков и из строки Cuisine ("Американская кухня; Европейская кухня")
+    pairs = [valid[['id']].assign(name=flag).loc[valid[flag] == 1] for flag in FLAG_COLUMNS if flag in valid.columns]
+    names = valid[['id']].assign(name=valid['Cuisine'].astype(str).str.split(';')).explode('name')
+    names['name'] = names['name'].str.strip()
+    pairs.append(names[names['name'] != ''])
+    place_cuisines = pd.concat(pairs).drop_duplicates()
+    for name in place_cuisines['name'].unique().tolist():
+        cuisine_ids.setdefault(name, len(cuisine_ids) + 1)
+    # Вставка в порядке первичного ключа не перестраивает страницы B-дерева
+    place_cuisines['cuisine_id'] = place_cuisines['name'].map(cuisine_ids)
+    place_cuisines = place_cuisines.sort_values(['id', 'cuisine_id'])
+
+    # Время в пути считается по координатам для всех офисов с известными координатами.
+    # Признак near – из выгрузки (near_office_N, иначе – есть ли office_N_time), по радиусу – только без них
+    coordinates = {office_id: (office['lat'], office['lon']) for office_id, office in offices.items()
+                   if office.get('lat') is not None and office.get('lon') is not None}
+    source_near = {}
+    for office_id in coordinates:
+        near_column, time_column = f'near_office_{office_id}', f'office_{office_id}_time'
+        if near_column in valid.columns:
+            source_near[office_id] = valid[near_column].fillna(False).astype(bool).to_numpy()
+        elif time_column in valid.columns:
+            source_near[office_id] = valid[time_column].notna().to_numpy()
+    office_place = office_place_rows(valid['id'].tolist(), valid['point_lat'].to_numpy(),
+                                     valid['point_lon'].to_numpy(), coordinates, near=source_near)
+
+    # Для остальных офисов – по колонкам office_N_time и near_office_N из CSV
+    for column in valid.columns:
+        match = re.fullmatch(r'office_(\d+)_time', column)
+        if not match or int(match.group(1)) in coordinates:
+            continue
+        office_id = int(match.group(1))
+        near_column = f'near_office_{office_id}'
+        near = valid[near_column].fillna(False).astype(bool) if near_column in valid.columns else True
+        office_rows = pd.DataFrame({'office_id': office_id, 'place_id': valid['id'],
+                                    'walk_time': valid[column], 'near': near}).dropna(subset=['walk_time'])
+        office_rows['near'] = office_rows['near'].astype(int)
+        office_place.extend(rows(office_rows, ['office_id', 'place_id', 'walk_time', 'near']))
+
+    return {
+        'places': places,
+        'place_cuisines': rows(place_cuisines, ['id', 'cuisine_id']),
+        'office_place': office_place
+    }, rejected
+
+
+def known_offices(conn):
+    """
+    Офисы по умолчанию (OFFICES) вместе с добавленными в рабочую таблицу offices.
+    """
+    offices = {office_id: dict(office) for office_id, office in OFFICES.items()}
+    has_offices = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'offices'").fetchone()
+    if has_offices:
+        for office_id, name, lat, lon in conn.execute('SELECT id, name, lat, lon FROM offices'):
+            if lat is not None and lon is not None:
+                offices[office_id] = {'name': name, 'lat': lat, 'lon': lon}
+    return offices
+
+
+def enable_wal(conn):
+    """
+    WAL: читатели не блокируются записью. Режим сохраняется в файле базы.
+    """
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+
+
+@contextmanager
+def load_pragmas(conn):
+    """
+    Включает LOAD_PRAGMAS на время загрузки и возвращает прежние значения после неё.
+    """
+    previous = {name: conn.execute(f'PRAGMA {name}').fetchone()[0] for name in LOAD_PRAGMAS}
+    for name, value in LOAD_PRAGMAS.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    try:
+        yield
+    finally:
+        # Прагмы не меняются внутри незавершённой транзакции – откатываем прерванную загрузку
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        for name, value in previous.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+
+
+def active_run(conn):
+    """
+    Номер выполняющейся загрузки или None.
+    """
+    running = conn.execute("SELECT id FROM ingest_runs WHERE state IN ('running', 'indexing') AND started_at > ?",
+                           (time.time() - STALE_RUN_SECONDS,)).fetchone()
+    return running[0] if running else None
+
+
+def start_run(conn, source='upload'):
+    """
+    Регистрирует новую загрузку; параллельно может идти только одна.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        running = active_run(conn)
+        if running:
+            raise IngestBusyError(f'Загрузка {running} ещё выполняется')
+        run_id = conn.execute("INSERT INTO ingest_runs (state, started_at, source) VALUES ('running', ?, ?)",
+                              (time.time(), source)).lastrowid
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return run_id
+
+
+def update_run(conn, run_id, **fields):
+    assignments = ', '.join(f'{field} = ?' for field in fields)
+    conn.execute(f'UPDATE ingest_runs SET {assignments} WHERE id = ?', (*fields.values(), run_id))
+
+
+def content_hash(place):
+    """
+    Хэш содержимого заведения: словарь с полями HASH_FIELDS и списком кухонь cuisines.
+    """
+    place = dict(place)
+    for field in REAL_FIELDS:
+        if isinstance(place.get(field), int):
+            place[field] = float(place[field])
+    for field in INTEGER_FIELDS:
+        if isinstance(place.get(field), float) and place[field].is_integer():
+            place[field] = int(place[field])
+    return hashlib.sha1(json.dumps(place, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def rehash_places(conn):
+    """
+    Пересчитывает place_hashes по рабочим таблицам. Вызывается внутри транзакции,
+    которая изменила таблицы целиком, – следующая загрузка выгрузок сравнит записи
+    с тем, что действительно лежит в базе.
+    """
+    hashes = []
+    for *values, cuisines in conn.execute(STORED_PLACES_QUERY):
+        place = dict(zip(HASH_FIELDS, values), cuisines=sorted(set(cuisines.split('\x1f'))) if cuisines else [])
+        hashes.append((place['id'], content_hash(place)))
+    conn.execute('DELETE FROM place_hashes')
+    conn.executemany('INSERT INTO place_hashes (place_id, hash) VALUES (?, ?)', hashes)
+
+
+def seed_place_hashes(conn):
+    """
+    Заполняет place_hashes для базы, загруженной до их появления (или когда их очищала загрузка CSV).
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if conn.execute('SELECT 1 FROM place_hashes LIMIT 1').fetchone() is None:
+            rehash_places(conn)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def swap_staging(conn):
+    """
+    Атомарно подменяет рабочие таблицы заполненными staging-таблицами.
+    Читатели видят либо старые, либо новые данные целиком.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for table in TABLES:
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+            conn.execute(f'ALTER TABLE {table}{STAGING_SUFFIX} RENAME TO {table}')
+        # Хэши – по новым данным, в той же транзакции: лента изменений выгрузок не видит ложных «added»
+        rehash_places(conn)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def ingest_frames(conn, chunks, bulk=False):
+    """
+    Загружает порции «широкой» таблицы заведений в staging-таблицы, строит индексы
+    и подменяет ими рабочие таблицы. conn – соединение sqlite3 с isolation_level=None.
+    Прогресс пишется в ingest_runs. Возвращает итоговую запись о загрузке.
+
+    bulk=True – режим массовой загрузки: WAL, LOAD_PRAGMAS и все порции в одной транзакции
+    (прогресс в ingest_runs при этом виден другим соединениям только в конце, в логе – по ходу).
+    """
+    run_id = start_run(conn)
+    try:
+        if bulk:
+            enable_wal(conn)
+            with load_pragmas(conn):
+                load_staging(conn, run_id, chunks, bulk)
+        else:
+            load_staging(conn, run_id, chunks, bulk)
+        swap_staging(conn)
+        update_run(conn, run_id, state='done', finished_at=time.time())
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        update_run(conn, run_id, state='failed', finished_at=time.time(), error=str(e))
+        for table in TABLES:
+            conn.execute(f'DROP TABLE IF EXISTS {table}{STAGING_SUFFIX}')
+        raise
+    return get_run(conn, run_id)
+
+
+def load_staging(conn, run_id, chunks, bulk):
+    """
+    Заполняет staging-таблицы и строит на них индексы (после данных – так быстрее,
+    чем поддерживать индексы на каждой вставке).
+    """
+    for table in TABLES:
+        conn.execute(f'DROP TABLE IF EXISTS {table}{STAGING_SUFFIX}')
+    create_tables(conn, suffix=STAGING_SUFFIX)
+
+    offices = known_offices(conn)
+    if bulk:
+        conn.execute('BEGIN')
+    cuisine_ids = {}
+    office_ids = set()
+    rows_read = rows_loaded = rows_rejected = 0
+    for chunk in chunks:
+        if rows_read == 0:
+            missing = [column for column in REQUIRED_COLUMNS if column not in chunk.columns]
+            if missing:
+                raise IngestError('В CSV нет обязательных колонок: ' + ', '.join(missing))
+        chunk_rows, rejected = normalize_chunk(chunk, cuisine_ids, offices)
+        office_ids.update(office_id for office_id, _, _, _ in chunk_rows['office_place'])
+
+        if not bulk:
+            conn.execute('BEGIN')
+        for table, table_rows in chunk_rows.items():
+            conn.executemany(INSERTS[table].format(suffix=STAGING_SUFFIX), table_rows)
+        rows_read += len(chunk)
+        rows_rejected += rejected
+        rows_loaded += len(chunk_rows['places'])
+        update_run(conn, run_id, rows_read=rows_read, rows_loaded=rows_loaded, rows_rejected=rows_rejected)
+        if not bulk:
+            conn.execute('COMMIT')
+        logging.info('Загрузка %s: прочитано %s строк, отброшено %s', run_id, rows_read, rows_rejected)
+
+    if rows_loaded == 0:
+        raise IngestError('В CSV нет ни одной корректной строки')
+
+    update_run(conn, run_id, state='indexing')
+    if not bulk:
+        conn.execute('BEGIN')
+    conn.executemany(INSERTS['cuisines'].format(suffix=STAGING_SUFFIX),
+                     [(cuisine_id, name) for name, cuisine_id in cuisine_ids.items()])
+    office_ids.update(office_id for office_id, office in offices.items() if office.get('lat') is not None)
+    office_rows = []
+    for office_id in sorted(office_ids):
+        office = offices.get(office_id, {'name': f'Офис {office_id}'})
+        office_rows.append((office_id, office['name'], office.get('lat'), office.get('lon')))
+    conn.executemany(INSERTS['offices'].format(suffix=STAGING_SUFFIX), office_rows)
+    create_indexes(conn, suffix=STAGING_SUFFIX, generation=run_id)
+    conn.execute('COMMIT')
+
+
+def ingest_csv(conn, stream, chunk_rows=CHUNK_ROWS, bulk=False):
+    """
+    Потоково загружает CSV из текстового потока порциями по chunk_rows строк.
+    """
+    chunks = pd.read_csv(stream, chunksize=chunk_rows, dtype={'id': 'Int64'})
+    return ingest_frames(conn, chunks, bulk=bulk)
+
+
+def get_run(conn, run_id=None):
+    """
+    Запись о загрузке run_id (или о последней загрузке) в виде словаря.
+    """
+    cursor = conn.execute(
+        'SELECT * FROM ingest_runs WHERE id = ?' if run_id else 'SELECT * FROM ingest_runs ORDER BY id DESC LIMIT 1',
+        (run_id,) if run_id else ()
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cursor.description], row))
@@ -0,0 +1,123 @@
+"""
+Нагрузочный тест чтения: сколько запросов /get_office_N в секунду выдерживает сервис БД
+при разном числе воркеров gunicorn, пока параллельно идёт загрузка CSV.
+
+Для каждого числа воркеров запускается gunicorn на копии базы, клиенты в потоках
+читают офисы, а отдельный поток без перерыва загружает синтетический CSV через /upload_csv.
+
+    python loadtest_reads.py --db instance/mydatabase.db
+    python loadtest_reads.py --db instance/mydatabase.db --workers 1 2 4 --clients 16 --duration 20
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmark_ingest import generate_csv
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f'Сервис {url} не запустился')
+
+
+def reader(url, stop, latencies, errors):
+    session = requests.Session()
+    office_id = 0
+    while not stop.is_set():
+        office_id = office_id % 3 + 1
+        started = time.perf_counter()
+        try:
+            response = session.get(f'{url}/get_office_{office_id}', timeout=30)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        except requests.RequestException:
+            errors.append(1)
+
+
+def uploader(url, csv_path, stop, uploads):
+    while not stop.is_set():
+        with open(csv_path, 'rb') as f:
+            response = requests.post(f'{url}/upload_csv', files={'data': f}, timeout=600)
+        uploads.append(response.status_code)
+
+
+def run(workers, args, csv_path, workdir):
+    db_path = os.path.join(workdir, f'load_{workers}.db')
+    shutil.copy(args.db, db_path)
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    env = dict(os.environ, DATABASE_URI=f'sqlite:///{db_path}')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(args.threads),
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'DB:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env
+    )
+    try:
+        wait_ready(url)
+        stop = threading.Event()
+        latencies, errors, uploads = [], [], []
+        threads = [threading.Thread(target=reader, args=(url, stop, latencies, errors)) for _ in range(args.clients)]
+        if not args.no_upload:
+            threads.append(threading.Thread(target=uploader, args=(url, csv_path, stop, uploads)))
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+    print(f'{workers:>8} {len(latencies) / args.duration:>10.1f} {p50:>9.1f} {p95:>9.1f} '
+          f'{len(errors):>7} {len(uploads):>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', required=True, help='база с данными (копируется, исходная не меняется)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=4, help='потоков на воркер gunicorn')
+    parser.add_argument('--clients', type=int, default=8, help='параллельных читателей')
+    parser.add_argument('--duration', type=float, default=15, help='секунд на каждое число воркеров')
+    parser.add_argument('--upload-rows', type=int, default=2000, help='строк в загружаемом CSV')
+    parser.add_argument('--no-upload', action='store_true', help='только чтение, без параллельной загрузки')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='db_load_')
+    csv_path = os.path.join(workdir, 'upload.csv')
+    if not args.no_upload:
+        generate_csv(csv_path, args.upload_rows)
+    print(f"{'воркеров':>8} {'запросов/с':>10} {'p50, мс':>9} {'p95, мс':>9} {'ошибок':>7} {'загрузок':>9}")
+    try:
+        for workers in args.workers:
+            run(workers, args, csv_path, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Метрики сервиса БД в текстовом формате Prometheus: GET /metrics.
+
+Под gunicorn с несколькими воркерами задайте PROMETHEUS_MULTIPROC_DIR – пустой каталог,
+через который воркеры складывают значения (см. gunicorn.conf.py).
+"""
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUESTS = Counter('db_requests_total', 'Запросы к сервису БД', ['endpoint', 'status'])
+REQUEST_SECONDS = Histogram('db_request_seconds', 'Время до начала ответа', ['endpoint'], buckets=BUCKETS)
+# Ответы отдаются потоком, поэтому запрос SQL измеряется от выполнения до последней строки
+QUERY_SECONDS = Histogram('db_query_seconds', 'Время запроса SQL с выборкой всех строк', ['query'], buckets=BUCKETS)
+QUERY_ROWS = Counter('db_query_rows_total', 'Строк отдано запросами', ['query'])
+# csv – /upload_csv, dump – выгрузки парсера, walk_times – пересчёт времени в пути
+LOAD_SECONDS = Histogram('db_load_seconds', 'Время загрузки данных', ['source'], buckets=BUCKETS)
+TABLE_ROWS = Gauge('db_table_rows', 'Строк в таблице', ['table'], multiprocess_mode='livemostrecent')
+DATASET_VERSION = Gauge('db_dataset_version', 'Номер последней успешной загрузки',
+                        multiprocess_mode='livemostrecent')
+
+# Таблицы, размер которых показываем в db_table_rows
+COUNTED_TABLES = ['places', 'cuisines', 'office_place', 'place_changes']
+
+
+def metrics_view(pool):
+    with pool.connection() as conn:
+        for table in COUNTED_TABLES:
+            TABLE_ROWS.labels(table).set(conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0])
+        version = conn.execute("SELECT MAX(id) FROM ingest_runs WHERE state = 'done'").fetchone()[0]
+        DATASET_VERSION.set(version or 0)
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app, pool):
+    """
+    Считает запросы и время их обработки по endpoint и добавляет /metrics;
+    размеры таблиц читаются из pool в момент запроса метрик.
+    """
+    @app.before_request
+    def start_timer():
+        g.started_at = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'unknown'
+        REQUESTS.labels(endpoint, response.status_code).inc()
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.started_at)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', lambda: metrics_view(pool))
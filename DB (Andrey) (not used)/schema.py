@@ -0,0 +1,144 @@
+# Схема хранилища заведений. Используется и Flask-приложением, и загрузкой данных.
+
+# Офисы по умолчанию: адрес и координаты (широта, долгота), от которых считается время в пути.
+# Новые офисы добавляются через /offices/<id> и хранятся в таблице offices.
+OFFICES = {
+    1: {'name': 'пер. Виленский, 14А', 'lat': 59.94018, 'lon': 30.36982},
+    2: {'name': 'Дегтярный пер., 11Б', 'lat': 59.93845, 'lon': 30.38439},
+    3: {'name': 'Киевская ул., 5 корп. 4', 'lat': 59.90188, 'lon': 30.32378}
+}
+
+# Признаки заведения, которые сервис рекомендаций ждёт отдельными колонками 0/1
+FLAG_COLUMNS = ['Европейская кухня', 'Паназиатская кухня', 'Русская кухня', 'Американская кухня',
+                'Грузинская кухня', 'Постное меню', 'Вегетарианское меню']
+
+# Таблицы с данными заведений; при загрузке они заполняются как {имя}_staging и подменяются целиком
+TABLES = ['places', 'cuisines', 'place_cuisines', 'offices', 'office_place']
+STAGING_SUFFIX = '_staging'
+
+# Нормализованная схема: заведения, кухни (в т.ч. признаки вроде «Постное меню»),
+# связь заведение-кухня, офисы и время пешком от офиса до заведения
+TABLE_DDL = {
+    'places': """CREATE TABLE {if_not_exists} {name} (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        address_name TEXT,
+        price_limit REAL,
+        point_lat REAL,
+        point_lon REAL,
+        cuisine TEXT,
+        reviews_general_rating REAL,
+        reviews_general_review_count INTEGER,
+        dishes TEXT
+    )""",
+    'cuisines': """CREATE TABLE {if_not_exists} {name} (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )""",
+    'place_cuisines': """CREATE TABLE {if_not_exists} {name} (
+        place_id INTEGER NOT NULL,
+        cuisine_id INTEGER NOT NULL,
+        PRIMARY KEY (place_id, cuisine_id)
+    ) WITHOUT ROWID""",
+    'offices': """CREATE TABLE {if_not_exists} {name} (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        lat REAL,
+        lon REAL
+    )""",
+    'office_place': """CREATE TABLE {if_not_exists} {name} (
+        office_id INTEGER NOT NULL,
+        place_id INTEGER NOT NULL,
+        walk_time REAL NOT NULL,
+        near INTEGER NOT NULL,
+        PRIMARY KEY (office_id, place_id)
+    ) WITHOUT ROWID"""
+}
+
+# Вторичные индексы: (таблица, суффикс имени, колонки).
+# В имя индекса добавляется номер загрузки, чтобы индексы новой staging-таблицы
+# не конфликтовали с индексами рабочей таблицы до подмены.
+INDEXES = [
+    # Покрывающий индекс для фильтра по офису и времени в пути
+    ('office_place', 'near', '(office_id, near, walk_time, place_id)'),
+    # Индексы для фильтров по цене, рейтингу и по кухне
+    ('places', 'price', '(price_limit, id)'),
+    ('places', 'rating', '(reviews_general_rating, id)'),
+    ('place_cuisines', 'cuisine', '(cuisine_id, place_id)')
+]
+
+# Журнал загрузок: прогресс текущей и итоги прошлых.
+# source – 'upload' (CSV целиком) или 'dump' (инкрементальная загрузка выгрузок, см. autoparse.py)
+INGEST_RUNS_DDL = """CREATE TABLE IF NOT EXISTS ingest_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    state TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    rows_read INTEGER NOT NULL DEFAULT 0,
+    rows_loaded INTEGER NOT NULL DEFAULT 0,
+    rows_rejected INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    source TEXT NOT NULL DEFAULT 'upload'
+)"""
+
+# Хэш содержимого заведения из последней выгрузки: неизменившиеся заведения не перезаписываются.
+# Не входит в TABLES – при загрузке CSV целиком пересчитывается по новым таблицам.
+PLACE_HASHES_DDL = """CREATE TABLE IF NOT EXISTS place_hashes (
+    place_id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL
+)"""
+
+# Изменения заведений по загрузкам выгрузок – для потребителей, которым нужны только дельты
+PLACE_CHANGES_DDL = """CREATE TABLE IF NOT EXISTS place_changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL,
+    place_id INTEGER NOT NULL,
+    change TEXT NOT NULL
+)"""
+
+
+def create_tables(conn, suffix='', if_not_exists=False):
+    for table in TABLES:
+        conn.execute(TABLE_DDL[table].format(
+            name=table + suffix, if_not_exists='IF NOT EXISTS' if if_not_exists else ''
+        ))
+
+
+def create_indexes(conn, suffix='', generation=0):
+    for table, index_name, columns in INDEXES:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_{index_name}_{generation} ON {table}{suffix} {columns}')
+
+
+def create_missing_indexes(conn):
+    """
+    Достраивает на рабочих таблицах индексы, добавленные в INDEXES после их создания.
+    """
+    for table, index_name, columns in INDEXES:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE ?",
+                              (table, f'ix_{table}_{index_name}_%')).fetchone()
+        if not exists:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_{index_name}_0 ON {table} {columns}')
+
+
+def add_missing_columns(conn, table, columns):
+    existing = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    for column, column_type in columns.items():
+        if column not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+def create_schema(conn):
+    """
+    Создаёт рабочие таблицы, если базы ещё нет, и недостающие индексы. conn – соединение sqlite3.
+    """
+    has_places = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'places'").fetchone()
+    if not has_places:
+        create_tables(conn, if_not_exists=True)
+    # Колонки, добавленные в схему позже, достраиваем в старой базе
+    add_missing_columns(conn, 'offices', {'lat': 'REAL', 'lon': 'REAL'})
+    add_missing_columns(conn, 'places', {'dishes': 'TEXT'})
+    create_missing_indexes(conn)
+    conn.execute(INGEST_RUNS_DDL)
+    add_missing_columns(conn, 'ingest_runs', {'source': "TEXT NOT NULL DEFAULT 'upload'"})
+    conn.execute(PLACE_HASHES_DDL)
+    conn.execute(PLACE_CHANGES_DDL)
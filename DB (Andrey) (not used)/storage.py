@@ -0,0 +1,138 @@
+import csv
+import io
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import QUERY_ROWS, QUERY_SECONDS
+
+# Сколько подготовленных запросов sqlite3 держит в кэше на одно соединение.
+# Запросы сервиса – фиксированные строки SQL, поэтому повторный запрос не компилируется заново.
+CACHED_STATEMENTS = 256
+# Сколько строк курсора выбираем за раз при потоковой отдаче
+FETCH_ROWS = 500
+
+
+class ReadPool:
+    """
+    Пул read-only соединений SQLite одного процесса. Каждый воркер gunicorn после fork
+    открывает свои соединения; в режиме WAL чтение не ждёт загрузки данных.
+    """
+
+    def __init__(self, path, size=4, timeout=30):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pid = None
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=self.timeout,
+                               check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def _acquire(self):
+        # Соединения, открытые до fork, в дочернем процессе использовать нельзя
+        if self.pid != os.getpid():
+            self._reset()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                return self._open()
+        return self.idle.get(timeout=self.timeout)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    @contextmanager
+    def dedicated(self):
+        """
+        Отдельное соединение вне пула – для выгрузок, которые читаются столько, сколько клиент
+        принимает ответ. Медленные клиенты не занимают соединения пула, нужные коротким запросам.
+        """
+        conn = self._open()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def fetch_batches(cursor, query):
+    """
+    Строки курсора пачками по FETCH_ROWS; отданные строки учитываются в метриках запроса query.
+    """
+    for rows in iter(lambda: cursor.fetchmany(FETCH_ROWS), []):
+        QUERY_ROWS.labels(query).inc(len(rows))
+        yield rows
+
+
+def csv_chunks(columns, batches):
+    """
+    Текст CSV по одной порции на каждую пачку строк из batches.
+    Формат совпадает с DataFrame.to_csv() – первая колонка с номером строки.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow([''] + columns)
+    index = 0
+    for rows in batches:
+        for row in rows:
+            writer.writerow((index, *row))
+            index += 1
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream_csv(pool, sql, params, header=None, query='query'):
+    """
+    Генератор CSV прямо из курсора, без DataFrame: отдаёт текст порциями по FETCH_ROWS строк.
+    header – имена колонок вместо имён из запроса, query – имя запроса в метриках.
+    Курсор живёт до конца ответа, поэтому читает через отдельное соединение, а не из пула.
+    """
+    with pool.dedicated() as conn:
+        started_at = time.perf_counter()
+        cursor = conn.execute(sql, params)
+        try:
+            yield from csv_chunks(header or [column[0] for column in cursor.description], fetch_batches(cursor, query))
+            QUERY_SECONDS.labels(query).observe(time.perf_counter() - started_at)
+        finally:
+            cursor.close()
+
+
+def fetch_page(pool, sql, params, limit, header=None, query='query'):
+    """
+    Страница выдачи и курсор следующей за одно чтение: запрос выбирает limit + 1 строк (параметр :limit
+    подставляется здесь), поэтому курсор берётся из того же снимка базы, что и сама страница.
+    Последняя колонка sql – ключ курсора, в CSV она не попадает. Страница ограничена по размеру
+    и читается целиком, так что соединение пула освобождается до отдачи ответа.
+    Возвращает (генератор CSV, курсор или None, если страница последняя).
+    """
+    with pool.connection() as conn, QUERY_SECONDS.labels(query).time():
+        cursor = conn.execute(sql, dict(params, limit=limit + 1))
+        columns = header or [column[0] for column in cursor.description[:-1]]
+        rows = cursor.fetchall()
+    next_cursor = rows[limit - 1][-1] if len(rows) > limit else None
+    rows = [row[:-1] for row in rows[:limit]]
+    QUERY_ROWS.labels(query).inc(len(rows))
+    return csv_chunks(columns, (rows[i:i + FETCH_ROWS] for i in range(0, len(rows), FETCH_ROWS))), next_cursor
@@ -0,0 +1,102 @@
+"""
+Чтение через API DB.py: /candidates отбирает то же, что фильтр тех же ограничений
+по полной выдаче /get_office_N на pandas, а страницы по курсору X-Next-Cursor покрывают
+выдачу целиком, каждую строку ровно один раз.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import pytest
+
+from conftest import read_csv_response
+from schema import FLAG_COLUMNS, OFFICES
+
+
+def python_filter(places, office_id, params):
+    """
+    Жёсткие ограничения /candidates, применённые к полной выдаче офиса.
+    Пустые значения не проходят сравнения – как NULL в SQL.
+    """
+    keep = places.index == places.index
+    if 'max_price' in params:
+        keep &= places['price_limit'] <= params['max_price']
+    if 'max_walk' in params:
+        keep &= places[f'office_{office_id}_time'] <= params['max_walk']
+    if 'min_rating' in params:
+        keep &= places['reviews_general_rating'] >= params['min_rating']
+    for cuisine in params.get('cuisine', []):
+        keep &= places[cuisine] == 1
+    for cuisine in params.get('exclude_cuisine', []):
+        keep &= places[cuisine] == 0
+    return places[keep]
+
+
+CANDIDATE_PARAMS = [
+    {'max_price': 1000},
+    {'max_walk': 10},
+    {'min_rating': 4.7},
+    {'cuisine': [FLAG_COLUMNS[0]]},
+    {'cuisine': [FLAG_COLUMNS[0], FLAG_COLUMNS[2]]},
+    {'exclude_cuisine': [FLAG_COLUMNS[1], FLAG_COLUMNS[6]]},
+    {'max_price': 1500, 'max_walk': 15, 'min_rating': 4.0, 'cuisine': [FLAG_COLUMNS[2]],
+     'exclude_cuisine': [FLAG_COLUMNS[4]]},
+]
+
+
+@pytest.mark.parametrize('office_id', list(OFFICES))
+@pytest.mark.parametrize('params', CANDIDATE_PARAMS)
+def test_candidates_match_python_filter(client, office_id, params):
+    places = read_csv_response(client.get(f'/get_office/{office_id}'))
+    expected = python_filter(places, office_id, params)
+    candidates = read_csv_response(client.get('/candidates', query_string={'office_id': office_id, **params}))
+
+    assert 0 < len(expected) < len(places)
+    assert sorted(candidates['id']) == sorted(expected['id'])
+    assert candidates.set_index('id').sort_index().equals(expected.set_index('id').sort_index())
+
+
+@pytest.mark.parametrize('office_id', list(OFFICES))
+def test_candidates_limit_takes_best_by_prefilter_order(client, office_id):
+    params = {'max_walk': 15}
+    expected = python_filter(read_csv_response(client.get(f'/get_office/{office_id}')), office_id, params)
+    candidates = read_csv_response(client.get('/candidates', query_string={'office_id': office_id, 'limit': 20,
+                                                                         **params}))
+    order = ['reviews_general_rating', 'reviews_general_review_count', f'office_{office_id}_time']
+
+    def keys(frame):
+        return list(frame[order].itertuples(index=False, name=None))
+
+    assert len(candidates) == 20
+    assert set(candidates['id']) <= set(expected['id'])
+    # Те же значения ключей сортировки, что у 20 лучших (при равенстве ключей порядок не важен)
+    best = expected.sort_values(order, ascending=[False, False, True]).head(20)
+    assert keys(candidates) == keys(best)
+
+
+def walk_pages(client, url, limit):
+    """
+    Обходит страницы по X-Next-Cursor; возвращает id строк всех страниц подряд и число страниц.
+    """
+    ids, pages, after = [], 0, None
+    while True:
+        query = {'limit': limit, 'fields': 'id,name'}
+        if after is not None:
+            query['after'] = after
+        response = client.get(url, query_string=query)
+        page = read_csv_response(response)
+        ids += page['id'].tolist()
+        pages += 1
+        after = response.headers.get('X-Next-Cursor')
+        if after is None:
+            return ids, pages
+        assert int(after) == page['id'].iloc[-1]
+
+
+@pytest.mark.parametrize('url', ['/places'] + [f'/get_office/{office_id}' for office_id in OFFICES])
+@pytest.mark.parametrize('limit', [1, 7, 100, 10000])
+def test_pages_cover_every_row_once(client, url, limit):
+    everything = read_csv_response(client.get(url, query_string={'fields': 'id'}))['id'].tolist()
+    ids, pages = walk_pages(client, url, limit)
+
+    assert ids == sorted(everything)
+    assert pages == max(1, -(-len(everything) // limit))
@@ -0,0 +1,61 @@
+"""
+Инкрементальная загрузка выгрузок: повторная выгрузка без изменений и выгрузка после загрузки
+CSV с теми же данными не попадают в ленту изменений как «added»/«updated».
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import json
+
+from autoparse import sync_dumps
+from conftest import upload_legacy_places
+
+
+def counts(run):
+    return {change: run[change] for change in ('added', 'updated', 'deleted', 'unchanged')}
+
+
+def write_dump(conn, path):
+    """
+    Выгрузка парсера с теми же заведениями, что сейчас в базе. Средний чек – целым числом,
+    как его отдаёт 2GIS, хотя в таблице он хранится как REAL.
+    """
+    names = {}
+    for place_id, name in conn.execute('SELECT pc.place_id, c.name FROM place_cuisines pc '
+                                       'JOIN cuisines c ON c.id = pc.cuisine_id'):
+        names.setdefault(place_id, set()).add(name)
+    with open(path, 'w', encoding='utf-8') as f:
+        for place_id, name, address, price, lat, lon, cuisine, review_count, rating, dishes in conn.execute(
+                'SELECT id, name, address_name, price_limit, point_lat, point_lon, cuisine, '
+                'reviews_general_review_count, reviews_general_rating, dishes FROM places'):
+            cuisines = [item.strip() for item in (cuisine or '').split(';') if item.strip()]
+            record = {
+                'id': f'{place_id}_70000001', 'name': name, 'address_name': address,
+                'point': {'lat': lat, 'lon': lon},
+                'average_bill': int(price) if price is not None and price.is_integer() else price,
+                'cuisines': cuisines, 'attributes': sorted(names.get(place_id, set()) - set(cuisines)),
+                'reviews': {'general_rating': rating, 'general_review_count': review_count},
+                'dishes': dishes.split('; ') if dishes else []
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return str(path)
+
+
+def test_repeated_sync_reports_unchanged(conn, tmp_path):
+    dump = write_dump(conn, tmp_path / 'dump.jsonl')
+    total = conn.execute('SELECT COUNT(*) FROM places').fetchone()[0]
+    sync_dumps(conn, dump)
+    changes = conn.execute('SELECT COUNT(*) FROM place_changes').fetchone()[0]
+
+    assert counts(sync_dumps(conn, dump)) == {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': total}
+    assert conn.execute('SELECT COUNT(*) FROM place_changes').fetchone()[0] == changes
+
+
+def test_sync_after_csv_upload_has_no_spurious_changes(conn, tmp_path):
+    dump = write_dump(conn, tmp_path / 'dump.jsonl')
+    total = conn.execute('SELECT COUNT(*) FROM places').fetchone()[0]
+    sync_dumps(conn, dump)
+    # Загрузка CSV целиком подменяет таблицы, но данные те же, что в выгрузке
+    upload_legacy_places(conn)
+
+    assert counts(sync_dumps(conn, dump)) == {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': total}
@@ -0,0 +1,80 @@
+"""
+Загрузка «широкой» таблицы заведений в нормализованную схему: данные старой таблицы Place
+восстанавливаются из places, place_cuisines и office_place без потерь, а неудачная загрузка
+CSV не меняет рабочие таблицы.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import io
+
+import pandas as pd
+import pytest
+
+from conftest import legacy_places
+from ingest import REQUIRED_COLUMNS, IngestError, get_run, ingest_csv
+from schema import FLAG_COLUMNS, OFFICES, STAGING_SUFFIX, TABLES
+
+PLACE_FIELDS = {'id': 'id', 'name': 'name', 'address_name': 'address_name', 'Average bill': 'price_limit',
+                'point_lat': 'point_lat', 'point_lon': 'point_lon', 'Cuisine': 'cuisine',
+                'reviews_general_review_count': 'reviews_general_review_count',
+                'reviews_general_rating': 'reviews_general_rating'}
+
+
+def loaded_legacy(conn):
+    """
+    Строки Place, которые должна принять загрузка: с обязательными полями, первая запись на каждый id.
+    """
+    legacy = legacy_places(conn).dropna(subset=REQUIRED_COLUMNS)
+    return legacy.astype({'id': 'int64'}).drop_duplicates('id').set_index('id', drop=False).sort_index()
+
+
+def test_legacy_place_round_trips(conn):
+    legacy = loaded_legacy(conn)
+
+    places = pd.read_sql(f"SELECT {', '.join(PLACE_FIELDS.values())} FROM places ORDER BY id", conn)
+    expected = legacy[list(PLACE_FIELDS)].rename(columns=PLACE_FIELDS).reset_index(drop=True)
+    pd.testing.assert_frame_equal(places, expected, check_dtype=False)
+
+    # Признаки 0/1 и кухни из строки Cuisine – в place_cuisines
+    expected_cuisines = {(place_id, flag) for flag in FLAG_COLUMNS
+                         for place_id in legacy.index[legacy[flag] == 1]}
+    expected_cuisines |= {(place_id, name.strip()) for place_id, cuisine in legacy['Cuisine'].items()
+                          for name in str(cuisine).split(';') if name.strip()}
+    assert set(conn.execute('SELECT pc.place_id, c.name FROM place_cuisines pc '
+                            'JOIN cuisines c ON c.id = pc.cuisine_id')) == expected_cuisines
+
+    # Признак «рядом с офисом» – из near_office_N
+    expected_near = {(office_id, place_id) for office_id in OFFICES
+                     for place_id in legacy.index[legacy[f'near_office_{office_id}'].fillna(0).astype(bool)]}
+    assert set(conn.execute('SELECT office_id, place_id FROM office_place WHERE near = 1')) == expected_near
+    # Время в пути – для каждой пары офис-заведение
+    assert conn.execute('SELECT COUNT(*) FROM office_place').fetchone()[0] == len(legacy) * len(OFFICES)
+
+
+def table_contents(conn):
+    return {table: conn.execute(f'SELECT * FROM {table} ORDER BY 1, 2').fetchall() for table in TABLES}
+
+
+def broken_in_last_chunk(conn):
+    """
+    CSV, в котором портится только последняя порция: первые порции успевают лечь в staging-таблицы.
+    """
+    csv = legacy_places(conn).astype({'id': 'Int64'}).astype({'id': object})
+    csv.loc[csv.index[-1], 'id'] = 'не число'
+    return csv.to_csv(index=False)
+
+
+@pytest.mark.parametrize('bulk', [False, True], ids=['chunks', 'bulk'])
+@pytest.mark.parametrize('make_csv', [
+    lambda conn: legacy_places(conn).drop(columns=['point_lat']).to_csv(index=False),
+    broken_in_last_chunk
+], ids=['missing_column', 'broken_last_chunk'])
+def test_failed_upload_keeps_live_tables(conn, make_csv, bulk):
+    before = table_contents(conn)
+    with pytest.raises((IngestError, ValueError)):
+        ingest_csv(conn, io.StringIO(make_csv(conn)), chunk_rows=200, bulk=bulk)
+
+    assert table_contents(conn) == before
+    assert get_run(conn)['state'] == 'failed'
+    assert not conn.execute("SELECT name FROM sqlite_master WHERE name LIKE ?", (f'%{STAGING_SUFFIX}',)).fetchall()
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+
+# Скорость пешехода: 5 км/ч. С ней время по прямой совпадает с временем из прежних выгрузок
+# (office_N_time) в среднем до 0.1 минуты.
+WALK_SPEED_M_PER_MIN = float(os.getenv('WALK_SPEED_M_PER_MIN', '83.3'))
+# Признак «рядом с офисом» (near) берётся из выгрузки (near_office_N) и при пересчёте времени не меняется.
+# Радиус задаёт near только для пар офис × заведение, для которых признака нет: новый офис,
+# заведения из выгрузок парсера – или при явном пересчёте с параметром radius
+NEAR_RADIUS_M = float(os.getenv('NEAR_RADIUS_M', '2000'))
+# Сколько заведений считаем за раз при пересчёте
+RECOMPUTE_CHUNK_ROWS = 50000
+
+EARTH_RADIUS_M = 6371000
+
+# Запись пересчитанного времени: у существующей пары меняется только walk_time (или и near)
+UPSERT_WALK_TIME = ('INSERT INTO office_place (office_id, place_id, walk_time, near) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (office_id, place_id) DO UPDATE SET walk_time = excluded.walk_time')
+UPSERT_NEAR = ('INSERT INTO office_place (office_id, place_id, walk_time, near) VALUES (?, ?, ?, ?) '
+               'ON CONFLICT (office_id, place_id) DO UPDATE SET walk_time = excluded.walk_time, near = excluded.near')
+
+
+def distance_matrix(place_lat, place_lon, office_lat, office_lon):
+    """
+    Расстояния по формуле гаверсинусов, в метрах: матрица заведения × офисы за один проход.
+    """
+    place_lat, place_lon = np.radians(place_lat)[:, None], np.radians(place_lon)[:, None]
+    office_lat, office_lon = np.radians(office_lat)[None, :], np.radians(office_lon)[None, :]
+    a = (np.sin((office_lat - place_lat) / 2) ** 2 +
+         np.cos(place_lat) * np.cos(office_lat) * np.sin((office_lon - place_lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def office_place_rows(place_ids, place_lat, place_lon, offices, speed=None, radius=None, near=None):
+    """
+    Строки office_place (office_id, place_id, walk_time, near) для всех пар офис × заведение.
+    offices – {office_id: (lat, lon)}; near – {office_id: признаки из выгрузки по заведениям},
+    для остальных офисов near считается по радиусу.
+    """
+    if not offices or not len(place_ids):
+        return []
+    speed = speed or WALK_SPEED_M_PER_MIN
+    radius = radius or NEAR_RADIUS_M
+    office_ids = list(offices)
+    coords = np.array([offices[office_id] for office_id in office_ids], dtype=float)
+    distance = distance_matrix(np.asarray(place_lat, dtype=float), np.asarray(place_lon, dtype=float),
+                               coords[:, 0], coords[:, 1])
+    walk_time = np.round(distance / speed, 2)
+    within_radius = distance <= radius
+    near = near or {}
+    place_ids = list(place_ids)
+    rows = []
+    for column, office_id in enumerate(office_ids):
+        flags = near[office_id] if office_id in near else within_radius[:, column]
+        rows.extend(zip([office_id] * len(place_ids), place_ids,
+                        walk_time[:, column].tolist(), np.asarray(flags).astype(int).tolist()))
+    return rows
+
+
+def office_coordinates(conn, office_ids=None):
+    """
+    Координаты офисов из таблицы offices: {office_id: (lat, lon)}; офисы без координат пропускаются.
+    """
+    rows = conn.execute('SELECT id, lat, lon FROM offices WHERE lat IS NOT NULL AND lon IS NOT NULL').fetchall()
+    return {office_id: (lat, lon) for office_id, lat, lon in rows if office_ids is None or office_id in office_ids}
+
+
+def recompute_walk_times(conn, office_ids=None, speed=None, radius=None):
+    """
+    Пересчитывает время в пути в office_place для офисов office_ids (по умолчанию – всех с координатами)
+    одной транзакцией. Признак near у существующих пар сохраняется, новые пары получают его по радиусу;
+    если radius передан явно, near пересчитывается по нему для всех пар.
+    conn – соединение sqlite3 с isolation_level=None. Возвращает число строк.
+    """
+    offices = office_coordinates(conn, office_ids)
+    if not offices:
+        return 0
+    upsert = UPSERT_NEAR if radius else UPSERT_WALK_TIME
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        cursor = conn.execute('SELECT id, point_lat, point_lon FROM places WHERE point_lat IS NOT NULL '
+                              'AND point_lon IS NOT NULL ORDER BY id')
+        total = 0
+        while True:
+            places = cursor.fetchmany(RECOMPUTE_CHUNK_ROWS)
+            if not places:
+                break
+            place_ids, lat, lon = zip(*places)
+            rows = office_place_rows(place_ids, lat, lon, offices, speed, radius)
+            conn.executemany(upsert, rows)
+            total += len(rows)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return total
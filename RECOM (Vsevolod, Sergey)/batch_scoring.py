@@ -0,0 +1,137 @@
+"""
+Рекомендации сразу для многих групп одним матричным умножением.
+
+Балл calculate_score линеен по признакам заведения: флаги кухонь и ограничений, «цена не выше бюджета»
+и «время в пути не больше лимита» для каждого варианта из ответов. Поэтому для офиса строится матрица
+заведение × признак из нулей и единиц (признаки – все колонки и лимиты, встретившиеся в ответах групп),
+для групп – матрица признак × группа из долей с весами calculate_score. Баллы всех групп – их произведение
+плюс баллы за рейтинг, общие для всех. Порядок в топе тот же, что у /recommendations: по баллу, рейтингу
+и числу отзывов, при равенстве – в порядке заведений офиса.
+
+Умножение складывает доли в другом порядке, чем calculate_score, и равные баллы могут отличаться
+в последнем знаке. Поэтому заведения, близкие к порогу топа, пересчитываются точно той же функцией,
+что в /recommendations, – иначе при равенстве баллов порядок мог бы отличаться.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+from catalog import text_values
+
+# Веса долей из calculate_score
+CUISINE_WEIGHT = 2
+RESTRICTION_WEIGHT = 1.5
+# Насколько балл из умножения может отличаться от точного – с запасом на порядки
+TIE_EPSILON = 1e-9
+
+
+def weight_matrix(groups):
+    """
+    Признаки (('flag', колонка) | ('price', лимит) | ('walk', лимит)) и матрица их весов признак × группа.
+    """
+    features = {}
+    weights = defaultdict(float)
+    for group_no, user_answers in enumerate(groups):
+        terms = ([(('flag', column), share * CUISINE_WEIGHT)
+                  for column, share in user_answers['wanted_cuisines'] if column]
+                 + [(('flag', column), share * RESTRICTION_WEIGHT)
+                    for column, share in user_answers['food_restrictions'] if column]
+                 + [(('price', limit), share) for limit, share in user_answers['price_limit']]
+                 + [(('walk', limit), share) for limit, share in user_answers['walk_time']])
+        for feature, weight in terms:
+            weights[features.setdefault(feature, len(features)), group_no] += weight
+    matrix = np.zeros((len(features), len(groups)))
+    for (feature_no, group_no), weight in weights.items():
+        matrix[feature_no, group_no] = weight
+    return list(features), matrix
+
+
+def feature_matrix(numeric, order, walk_time, features):
+    """
+    Признаки заведений (строки каталога order со временем в пути walk_time): матрица заведение × признак.
+    """
+    price = numeric['price_limit'].to_numpy()[order]
+    matrix = np.zeros((len(order), len(features)))
+    for feature_no, (kind, value) in enumerate(features):
+        if kind == 'flag':
+            if value in numeric:
+                # Как row.get(column) в calculate_score: засчитывается любое ненулевое значение, в том числе NaN
+                matrix[:, feature_no] = numeric[value].to_numpy()[order] != 0
+        else:
+            # Сравнение с NaN даёт False – пропуск не проходит ни один лимит
+            matrix[:, feature_no] = (price if kind == 'price' else walk_time) <= value
+    return matrix
+
+
+def top_rows(scores, rating, reviews, k, exact_scores):
+    """
+    Позиции k лучших заведений по баллу, затем рейтингу и числу отзывов (по убыванию, пропуски в конце).
+    exact_scores(позиции) – точные баллы претендентов.
+    """
+    if len(scores) > k:
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        positions = np.flatnonzero(scores >= threshold - TIE_EPSILON)
+    else:
+        positions = np.arange(len(scores))
+    exact = np.asarray(exact_scores(positions), dtype=float)
+    # np.lexsort устойчива и сортирует по последнему ключу в первую очередь
+    keys = [np.nan_to_num(-values, nan=np.inf) for values in (reviews[positions], rating[positions], exact)]
+    return positions[np.lexsort(keys)[:k]]
+
+
+def row_values(numeric, order, user_answers, walk_time, positions):
+    """
+    Строки заведений в позициях positions с колонками, которые читает calculate_score для этой группы.
+    """
+    columns = {column for column, _ in user_answers['wanted_cuisines'] + user_answers['food_restrictions']
+               if column and column in numeric}
+    columns |= {'price_limit', 'reviews_general_rating', 'reviews_general_review_count'}
+    values = {column: numeric[column].to_numpy()[order[positions]] for column in columns}
+    values['office_time'] = walk_time[positions]
+    return [{column: column_values[i] for column, column_values in values.items()} for i in range(len(positions))]
+
+
+def rank_places(snapshot, order, walk_time, groups, score_row, k=3):
+    """
+    Топ-k заведений из строк каталога order (со временем в пути walk_time) для каждой группы:
+    [названия, id]. Все группы оцениваются одним умножением матриц; score_row(строка, user_answers) –
+    точный балл, как в /recommendations.
+    """
+    numeric = snapshot.numeric
+    features, weights = weight_matrix(groups)
+    places = feature_matrix(numeric, order, walk_time, features)
+    rating = numeric['reviews_general_rating'].to_numpy()[order]
+    reviews = numeric['reviews_general_review_count'].to_numpy()[order]
+    rating_score = (rating > 4.5).astype(float) + (reviews > 200)
+    scores = places @ weights + rating_score[:, None]
+    ids = numeric['id'].to_numpy()[order]
+    results = []
+    for column, user_answers in enumerate(groups):
+
+        def exact_scores(positions):
+            rows = row_values(numeric, order, user_answers, walk_time, positions)
+            return [score_row(row, user_answers) for row in rows]
+
+        top = top_rows(scores[:, column], rating, reviews, k, exact_scores)
+        results.append([text_values(snapshot, 'name', order[top]), ids[top].tolist()])
+    return results
+
+
+def recommend_batch(snapshot, groups, score_row, k=3):
+    """
+    Топ-k заведений для каждой группы: [названия, id] или None, если офиса группы нет.
+    Группы одного офиса оцениваются вместе (см. rank_places).
+    """
+    results = [None] * len(groups)
+    by_office = defaultdict(list)
+    for group_no, user_answers in enumerate(groups):
+        if user_answers['office'] in snapshot.walk_times:
+            by_office[user_answers['office']].append(group_no)
+
+    for office_id, group_nos in by_office.items():
+        times, order = snapshot.walk_times[office_id]
+        office_results = rank_places(snapshot, order, times[order], [groups[group_no] for group_no in group_nos],
+                                     score_row, k)
+        for group_no, result in zip(group_nos, office_results):
+            results[group_no] = result
+    return results
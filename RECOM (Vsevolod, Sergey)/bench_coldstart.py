@@ -0,0 +1,96 @@
+"""
+Холодный старт сервиса рекомендаций: время импорта recommend.py и время от запуска сервера
+до первого ответа /recommendations.
+
+Импорт меряется через python -X importtime в отдельном процессе: общий итог, самые тяжёлые пакеты
+верхнего уровня (по собственному времени их модулей) и проверка, что стек ML (torch, transformers,
+fuzzywuzzy) не загружен. Сервер каждый раз запускается заново командой --cmd и опрашивается,
+пока не ответит 200. --fresh-snapshot удаляет снимок каталога
+перед каждым запуском, как у нового пода без общего тома; тогда в замер входит и публикация снимка.
+
+    python bench_coldstart.py --runs 5
+    python bench_coldstart.py --cmd 'uvicorn recommend_asgi:app --port {port}' --fresh-snapshot
+"""
+import argparse
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import requests
+
+from catalog import SNAPSHOT_DIR
+
+ML_PACKAGES = ('torch', 'transformers', 'fuzzywuzzy')
+PAYLOAD = {'v': 2, 'office': 1, 'cuisines': [[1, 0.5]], 'restrictions': [], 'budget': [[1, 1.0]],
+           'walk': [[1, 1.0]], 'positive': '', 'negative': ''}
+
+
+def import_times(module):
+    """
+    Секунды на импорт module и {пакет верхнего уровня: секунды на его модули} по выводу -X importtime.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             capture_output=True, text=True, check=True)
+    packages = defaultdict(float)
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(own) / 1e6
+    return sum(packages.values()), packages
+
+
+def time_to_first_response(cmd, port, timeout):
+    started_at = time.perf_counter()
+    server = subprocess.Popen(shlex.split(cmd.format(port=port)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started_at < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f'Сервер завершился с кодом {server.returncode}')
+            try:
+                response = requests.post(f'http://127.0.0.1:{port}/recommendations', json=PAYLOAD, timeout=timeout)
+                if response.status_code == 200:
+                    return time.perf_counter() - started_at
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.02)
+        raise RuntimeError(f'Сервер не ответил за {timeout} с')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='recommend', help='модуль, импорт которого меряется')
+    parser.add_argument('--cmd', default=f'{sys.executable} -m gunicorn -w 1 -b 127.0.0.1:{{port}} recommend:app',
+                        help='команда запуска сервера, {port} – порт')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--fresh-snapshot', action='store_true', help='удалять снимок каталога перед запуском')
+    parser.add_argument('--top', type=int, default=10, help='сколько самых тяжёлых пакетов показать')
+    args = parser.parse_args()
+
+    total, packages = import_times(args.module)
+    print(f'Импорт {args.module}: {total:.3f} с')
+    for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {name:<24} {seconds:.3f} с')
+    loaded_ml = [name for name in ML_PACKAGES if name in packages]
+    print('Стек ML загружен: ' + (', '.join(loaded_ml) if loaded_ml else 'нет'))
+
+    results = []
+    for _ in range(args.runs):
+        if args.fresh_snapshot:
+            shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+        results.append(time_to_first_response(args.cmd, args.port, args.timeout))
+    print(f'До первого ответа: медиана {statistics.median(results):.2f} с, '
+          f'мин {min(results):.2f} с, макс {max(results):.2f} с ({args.runs} запусков)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Каталог заведений: одна таблица уникальных заведений (data/catalog.csv) и для каждого офиса –
+вектор времени в пути, выровненный по строкам каталога (data/walk_times.npz).
+Вместо трёх полных копий заведений по офисам память растёт только с числом уникальных заведений.
+
+Воркеры gunicorn читают каталог из снимка (data/snapshot): числовые колонки – одна матрица,
+текстовые – байты UTF-8 со смещениями строк; файлы .npy отображаются в память только для чтения,
+поэтому все воркеры делят одну копию данных. Новый каталог публикуется следующим поколением снимка; номер текущего
+поколения – в data/snapshot/CURRENT, воркеры сверяют его на каждом запросе.
+
+Конвертер из прежних выгрузок по офисам:
+
+    python catalog.py office1.csv office2.csv office3.csv
+"""
+import fcntl
+import json
+import os
+import shutil
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+CATALOG_PATH = 'data/catalog.csv'
+WALK_TIMES_PATH = 'data/walk_times.npz'
+SNAPSHOT_DIR = 'data/snapshot'
+# Сколько поколений снимка хранить: воркер может ещё не перейти на новое
+KEEP_GENERATIONS = 3
+
+# Колонки выгрузки, которые не относятся к заведению: индекс DataFrame, повтор price_limit, время до офиса
+_OFFICE_ONLY_COLUMNS = ['Unnamed: 0', 'price_limit.1', 'office_time']
+
+
+def build_catalog(office_frames):
+    """
+    Собирает каталог из таблиц заведений по офисам {office_id: DataFrame с колонкой office_time}.
+    Возвращает (каталог, {office_id: (время в пути по строкам каталога, строки каталога в порядке офиса)}).
+    Время – NaN, если заведения нет в выдаче офиса.
+    """
+    frames = [df.drop(columns=[c for c in _OFFICE_ONLY_COLUMNS if c in df.columns]) for df in office_frames.values()]
+    catalog = pd.concat(frames).drop_duplicates(subset='id').sort_values('id').reset_index(drop=True)
+    positions = pd.Series(np.arange(len(catalog)), index=catalog['id'])
+
+    walk_times = {}
+    for office_id, df in office_frames.items():
+        order = positions.loc[df['id']].to_numpy(dtype=np.int32)
+        times = np.full(len(catalog), np.nan)
+        times[order] = df['office_time'].to_numpy(dtype=float)
+        walk_times[office_id] = (times, order)
+    return catalog, walk_times
+
+
+def save_catalog(catalog, walk_times, catalog_path=CATALOG_PATH, walk_times_path=WALK_TIMES_PATH):
+    catalog.to_csv(catalog_path, index=False)
+    arrays = {'ids': catalog['id'].to_numpy()}
+    for office_id, (times, order) in walk_times.items():
+        arrays[f'time_{office_id}'] = times
+        arrays[f'order_{office_id}'] = order
+    np.savez(walk_times_path, **arrays)
+
+
+def load_catalog(catalog_path=CATALOG_PATH, walk_times_path=WALK_TIMES_PATH):
+    """
+    Загружает каталог и векторы времени; проверяет, что векторы выровнены по строкам каталога.
+    """
+    catalog = pd.read_csv(catalog_path)
+    walk_times = {}
+    with np.load(walk_times_path) as arrays:
+        if not np.array_equal(arrays['ids'], catalog['id'].to_numpy()):
+            raise ValueError(f'{walk_times_path} не соответствует каталогу {catalog_path}')
+        for key in arrays.files:
+            if key.startswith('time_'):
+                office_id = int(key[len('time_'):])
+                walk_times[office_id] = (arrays[key], arrays[f'order_{office_id}'])
+    return catalog, walk_times
+
+
+# Снимок каталога: numeric – DataFrame поверх отображённой матрицы (id и числовые колонки),
+# text – {колонка: (байты UTF-8 всех строк, смещения строк, пропуски)},
+# walk_times – {office_id: (время, порядок)}
+Snapshot = namedtuple('Snapshot', ['generation', 'numeric', 'text', 'walk_times'])
+
+
+def current_generation(root=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(root, 'CURRENT')) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 0
+
+
+def publish_catalog(catalog, walk_times, root=SNAPSHOT_DIR, if_missing=False):
+    """
+    Записывает каталог следующим поколением снимка и делает его текущим.
+    if_missing – только если снимка ещё нет (при одновременном старте воркеров публикует один).
+    Возвращает номер текущего поколения.
+    """
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generation = current_generation(root)
+        if if_missing and generation:
+            return generation
+        generation += 1
+        path = os.path.join(root, str(generation))
+        staging = path + '.tmp'
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        numeric = [c for c in catalog.columns if c != 'id' and pd.api.types.is_numeric_dtype(catalog[c])]
+        text = [c for c in catalog.columns if c != 'id' and c not in numeric]
+        np.save(os.path.join(staging, 'ids.npy'), catalog['id'].to_numpy(dtype=np.int64))
+        # Матрица по колонкам (Fortran order): колонка DataFrame – непрерывный участок файла
+        np.save(os.path.join(staging, 'numeric.npy'), np.asfortranarray(catalog[numeric].to_numpy(dtype=float)))
+        for i, column in enumerate(text):
+            encoded = [value.encode('utf-8') for value in catalog[column].fillna('').astype(str)]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            np.save(os.path.join(staging, f'text_{i}.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            np.save(os.path.join(staging, f'text_{i}_offsets.npy'), offsets)
+            np.save(os.path.join(staging, f'text_{i}_nulls.npy'), catalog[column].isna().to_numpy())
+        for office_id, (times, order) in walk_times.items():
+            np.save(os.path.join(staging, f'time_{office_id}.npy'), times)
+            np.save(os.path.join(staging, f'order_{office_id}.npy'), order)
+        with open(os.path.join(staging, 'meta.json'), 'w') as f:
+            json.dump({'numeric': numeric, 'text': text, 'offices': list(walk_times)}, f, ensure_ascii=False)
+        os.rename(staging, path)
+
+        # Переключение поколения – атомарная замена файла CURRENT
+        with open(os.path.join(root, 'CURRENT.tmp'), 'w') as f:
+            f.write(str(generation))
+        os.replace(os.path.join(root, 'CURRENT.tmp'), os.path.join(root, 'CURRENT'))
+        # Удалённые файлы остаются доступны воркерам, которые их уже отобразили
+        for old in range(1, generation - KEEP_GENERATIONS + 1):
+            shutil.rmtree(os.path.join(root, str(old)), ignore_errors=True)
+    return generation
+
+
+def open_snapshot(root=SNAPSHOT_DIR, generation=None):
+    """
+    Отображает поколение снимка (по умолчанию текущее) в память только для чтения.
+    """
+    generation = generation or current_generation(root)
+    path = os.path.join(root, str(generation))
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+    numeric = pd.DataFrame(load('numeric'), columns=meta['numeric'], copy=False)
+    numeric.insert(0, 'id', load('ids'))
+    text = {column: (load(f'text_{i}'), load(f'text_{i}_offsets'), load(f'text_{i}_nulls'))
+            for i, column in enumerate(meta['text'])}
+    walk_times = {office_id: (load(f'time_{office_id}'), load(f'order_{office_id}')) for office_id in meta['offices']}
+    return Snapshot(generation, numeric, text, walk_times)
+
+
+class SharedCatalog:
+    """
+    Текущий снимок каталога в воркере: при смене поколения в CURRENT отображается новое.
+    """
+
+    def __init__(self, root=SNAPSHOT_DIR):
+        self.root = root
+        if not current_generation(root):
+            publish_catalog(*load_catalog(), root=root, if_missing=True)
+        self.snapshot = open_snapshot(root)
+
+    def current(self):
+        generation = current_generation(self.root)
+        if generation != self.snapshot.generation:
+            self.snapshot = open_snapshot(self.root, generation)
+        return self.snapshot
+
+
+def office_places(snapshot, office_id):
+    """
+    Заведения у офиса в его порядке: числовые колонки каталога, office_time и row – строка каталога
+    (по ней текстовые колонки читаются через text_values). Новая таблица на каждый запрос,
+    снимок не меняется. None, если офиса нет.
+    """
+    if office_id not in snapshot.walk_times:
+        return None
+    times, order = snapshot.walk_times[office_id]
+    return places_frame(snapshot, order, times[order])
+
+
+def places_frame(snapshot, rows, walk_time):
+    """
+    Таблица заведений в строках каталога rows (как у office_places) со временем в пути walk_time.
+    """
+    df = snapshot.numeric.iloc[rows].reset_index(drop=True)
+    df['office_time'] = walk_time
+    df['row'] = rows
+    return df
+
+
+def group_walk_times(snapshot, offices, objective='max'):
+    """
+    Заведения у любого из офисов группы: строки каталога и общее время в пути, по возрастанию времени.
+    offices – пары (id офиса, доля участников). Время в пути сводится по матрице заведение × офис:
+    'max' – время самого дальнего участника, 'mean' – среднее, взвешенное по долям. Если заведения нет
+    в выгрузке какого-то из офисов, время до него неизвестно (NaN) – такие заведения идут в конце.
+    """
+    offices = [(office_id, share) for office_id, share in offices if office_id in snapshot.walk_times]
+    times = np.column_stack([snapshot.walk_times[office_id][0] for office_id, _ in offices])
+    if objective == 'mean':
+        shares = np.array([share for _, share in offices], dtype=float)
+        combined = times @ shares / shares.sum()
+    else:
+        combined = times.max(axis=1)
+    # NaN (заведения нет у какого-то из офисов) сохраняется и в max, и в среднем
+    rows = np.flatnonzero(~np.isnan(times).all(axis=1))
+    rows = rows[np.argsort(combined[rows], kind='stable')]
+    return rows, combined[rows]
+
+
+def text_values(snapshot, column, rows):
+    """
+    Значения текстовой колонки каталога для строк rows; пропуск – NaN.
+    """
+    data, offsets, nulls = snapshot.text[column]
+    return [np.nan if nulls[row] else bytes(data[offsets[row]:offsets[row + 1]]).decode('utf-8') for row in rows]
+
+
+def read_office_csv(source):
+    """
+    Таблица заведений офиса из выгрузки (файл или текст CSV): колонка office_N_time приводится к office_time.
+    """
+    df = pd.read_csv(source)
+    time_columns = [c for c in df.columns if c.startswith('office_') and c.endswith('_time')]
+    return df.rename(columns={time_columns[0]: 'office_time'}) if time_columns else df
+
+
+if __name__ == '__main__':
+    # Номер офиса – порядковый номер файла в командной строке
+    frames = {office_id: read_office_csv(path) for office_id, path in enumerate(sys.argv[1:], start=1)}
+    catalog, walk_times = build_catalog(frames)
+    save_catalog(catalog, walk_times)
+    generation = publish_catalog(catalog, walk_times)
+    print(f'{len(catalog)} заведений, офисов: {len(walk_times)} -> {CATALOG_PATH}, {WALK_TIMES_PATH}, '
+          f'снимок {generation}')
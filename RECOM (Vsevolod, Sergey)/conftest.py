@@ -0,0 +1,58 @@
+"""
+Общие фикстуры тестов: приложение рекомендаций поверх копии каталога из data/ во временном каталоге,
+чтобы снимок (data/snapshot) и журнал профилей не появлялись в репозитории.
+"""
+import os
+import random
+import shutil
+from pathlib import Path
+
+import pytest
+
+DATA_DIR = Path(__file__).with_name('data')
+
+
+@pytest.fixture(scope='session')
+def recommend(tmp_path_factory):
+    """
+    Модуль recommend.py. Снимок каталога публикуется при импорте по относительному пути,
+    поэтому тесты идут из временного каталога с копией data/.
+    """
+    root = tmp_path_factory.mktemp('recom')
+    shutil.copytree(DATA_DIR, root / 'data', ignore=shutil.ignore_patterns('snapshot', 'profile_log.jsonl'))
+    previous_cwd, previous_log = os.getcwd(), os.environ.get('PROFILE_LOG')
+    os.environ['PROFILE_LOG'] = str(root / 'data' / 'profile_log.jsonl')
+    os.chdir(root)
+    try:
+        import recommend
+        yield recommend
+    finally:
+        os.chdir(previous_cwd)
+        if previous_log is None:
+            del os.environ['PROFILE_LOG']
+        else:
+            os.environ['PROFILE_LOG'] = previous_log
+
+
+def random_payloads(count, seed, mixed=False):
+    """
+    Случайные запросы v2 от бота; mixed – группы из нескольких офисов с долями участников и целью по времени в пути.
+    """
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(count):
+        payload = {
+            'v': 2, 'office': rng.randint(1, 3),
+            'cuisines': [[i, round(rng.random(), 2)] for i in rng.sample(range(5), rng.randint(0, 3))],
+            'restrictions': [[i, round(rng.random(), 2)] for i in rng.sample(range(3), rng.randint(0, 2))],
+            'budget': [[i, round(rng.random(), 2)] for i in rng.sample(range(4), rng.randint(1, 3))],
+            'walk': [[i, round(rng.random(), 2)] for i in rng.sample(range(3), rng.randint(1, 2))],
+            'positive': '', 'negative': ''
+        }
+        if mixed:
+            offices = rng.sample([1, 2, 3], rng.randint(2, 3))
+            payload['office'] = offices[0]
+            payload['offices'] = [[office_id, round(rng.random() + 0.1, 2)] for office_id in offices]
+            payload['walk_objective'] = rng.choice(['max', 'mean'])
+        payloads.append(payload)
+    return payloads
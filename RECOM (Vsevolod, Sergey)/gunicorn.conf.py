@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+from prometheus_client import multiprocess
+
+from inference import NER_ENABLED
+
+# Потоки в воркере: одинаковые одновременные запросы объединяются только внутри воркера (singleflight.py),
+# а sync-воркер обрабатывает по одному запросу, и объединять ему нечего
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+
+def on_starting(server):
+    # Один пул разбора пожеланий на все воркеры (см. inference.py)
+    if NER_ENABLED:
+        server.ner_process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'inference.py')])
+
+
+def on_exit(server):
+    process = getattr(server, 'ner_process', None)
+    if process is not None:
+        process.terminate()
+        process.wait()
+
+
+def child_exit(server, worker):
+    # Метрики завершившегося воркера больше не учитываются в gauge с режимом live*
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,261 @@
+"""
+Разбор пожеланий моделью (FoodAnalyzer) в отдельных процессах.
+
+Модель не грузится в web-воркеры: там она делила бы GIL с обработкой запросов, а потоки torch
+каждого воркера заняли бы все ядра. Вместо этого NER_WORKERS процессов загружают модель по одному
+разу и используют NER_THREADS потоков каждый. Web-воркеры отправляют тексты по unix-сокету
+NER_SOCKET (кадры «длина + JSON»). Процесс разбора забирает из очереди все накопившиеся тексты
+(до NER_BATCH, ожидая ещё до NER_BATCH_WAIT_MS) и прогоняет их через модель одним батчем.
+
+    python inference.py --workers 2 --threads 2
+
+Под gunicorn пул запускается сам при NER_WORKERS > 0 (см. gunicorn.conf.py). Без NER_WORKERS
+пожелания не разбираются, как раньше, и web-воркеры не импортируют torch и transformers вовсе –
+образ без них собирается из requirements.txt, с ними – из requirements-ner.txt.
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+NER_WORKERS = int(os.getenv('NER_WORKERS', '0'))
+NER_ENABLED = NER_WORKERS > 0
+NER_SOCKET = os.getenv('NER_SOCKET', '/tmp/recom-ner.sock')
+# Потоков torch на процесс разбора: NER_WORKERS * NER_THREADS не должно превышать число ядер
+NER_THREADS = int(os.getenv('NER_THREADS', '1'))
+# Закрепить процессы разбора за своими ядрами (только Linux)
+NER_PIN_CPUS = os.getenv('NER_PIN_CPUS') == '1'
+NER_BATCH = int(os.getenv('NER_BATCH', '16'))
+# 0 – в батч идут только тексты, уже ждущие в очереди, одиночный запрос не задерживается
+NER_BATCH_WAIT_MS = float(os.getenv('NER_BATCH_WAIT_MS', '0'))
+# Сколько web-воркер ждёт разбора, прежде чем рекомендовать без пожеланий
+NER_TIMEOUT = float(os.getenv('NER_TIMEOUT', '5'))
+
+MODEL_PATH = 'models/request_processing/request_processing_model.pth'
+CUISINES_PATH = 'data/unique_cuisines.json'
+DISHES_PATH = 'data/unique_dishes.json'
+
+FRAME_HEADER = struct.Struct('!I')
+
+
+class InferenceError(Exception):
+    pass
+
+
+def write_frame(sock, message):
+    data = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def read_frame(stream):
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise EOFError()
+    (size,) = FRAME_HEADER.unpack(header)
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError()
+    return json.loads(data)
+
+
+# 🔹 Процессы разбора
+
+def load_analyzer():
+    import torch
+    from processing_requests import FoodAnalyzer
+    torch.set_num_threads(NER_THREADS)
+    torch.set_num_interop_threads(1)
+    return FoodAnalyzer(model_path=MODEL_PATH, cuisine_json_path=CUISINES_PATH, dish_json_path=DISHES_PATH)
+
+
+def recommendation_wishes(result):
+    """
+    Результат FoodAnalyzer в виде structured_wishes для recommend.py; несопоставленные сущности
+    (в скобках) отбрасываются.
+    """
+    from processing_requests import FoodAnalyzer
+    return {
+        'positive_cuisines': FoodAnalyzer.filter_words(result['cuisine_positive']),
+        'positive_dishes': FoodAnalyzer.filter_words(result['dish_positive']),
+        'negative_cuisines': FoodAnalyzer.filter_words(result['cuisine_negative']),
+        'negative_dishes': FoodAnalyzer.filter_words(result['dish_negative'])
+    }
+
+
+def next_batch(tasks):
+    batch = [tasks.get()]
+    deadline = time.monotonic() + NER_BATCH_WAIT_MS / 1000
+    while len(batch) < NER_BATCH:
+        try:
+            batch.append(tasks.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+    return batch
+
+
+def worker_main(number, tasks, results, factory, convert):
+    # До импорта torch: OpenMP и MKL берут число потоков из окружения при загрузке
+    os.environ['OMP_NUM_THREADS'] = os.environ['MKL_NUM_THREADS'] = str(NER_THREADS)
+    if NER_PIN_CPUS and hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        first = number * NER_THREADS % len(cpus)
+        os.sched_setaffinity(0, cpus[first:first + NER_THREADS] or cpus)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    analyzer = factory()
+    while True:
+        batch = next_batch(tasks)
+        try:
+            outputs = [convert(result) for result in analyzer.analyze_batch([text for _, _, text in batch])]
+            results.put([(conn_no, request_id, output, None)
+                         for (conn_no, request_id, _), output in zip(batch, outputs)])
+        except Exception as e:
+            logging.exception("Ошибка разбора батча")
+            results.put([(conn_no, request_id, None, str(e)) for conn_no, request_id, _ in batch])
+
+
+# 🔹 Сервер: принимает тексты от web-воркеров и раздаёт им результаты
+
+def receive_requests(conn_no, conn, tasks, connections):
+    stream = conn.makefile('rb')
+    try:
+        while True:
+            message = read_frame(stream)
+            tasks.put((conn_no, message['id'], message['text']))
+    except (EOFError, OSError, ValueError):
+        pass
+    finally:
+        connections.pop(conn_no, None)
+        conn.close()
+
+
+def send_results(results, connections):
+    while True:
+        for conn_no, request_id, output, error in results.get():
+            connection = connections.get(conn_no)
+            if connection is None:
+                continue
+            conn, lock = connection
+            try:
+                with lock:
+                    write_frame(conn, {'id': request_id, 'result': output, 'error': error})
+            except OSError:
+                pass
+
+
+def serve(path=NER_SOCKET, workers=NER_WORKERS, factory=load_analyzer, convert=recommendation_wishes):
+    if factory is load_analyzer and importlib.util.find_spec('torch') is None:
+        raise SystemExit('Для разбора пожеланий нужен стек ML: pip install -r requirements-ner.txt')
+    # spawn, а не fork: процессы разбора не наследуют состояние torch и потоки сервера
+    context = multiprocessing.get_context('spawn')
+    tasks, results = context.Queue(), context.Queue()
+    for number in range(workers):
+        context.Process(target=worker_main, args=(number, tasks, results, factory, convert), daemon=True).start()
+
+    connections = {}
+    threading.Thread(target=send_results, args=(results, connections), daemon=True).start()
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    logging.info("Пул разбора: %d процессов по %d потоков, сокет %s", workers, NER_THREADS, path)
+    for conn_no in itertools.count():
+        conn, _ = server.accept()
+        connections[conn_no] = (conn, threading.Lock())
+        threading.Thread(target=receive_requests, args=(conn_no, conn, tasks, connections), daemon=True).start()
+
+
+# 🔹 Клиент в web-воркере
+
+class NerClient:
+    """
+    Соединение web-воркера с пулом разбора: потоки воркера отправляют тексты по одному сокету,
+    фоновый поток раздаёт ответы по id. После fork соединение открывается заново.
+    """
+
+    def __init__(self, path=NER_SOCKET):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.sock = None
+        self.pid = None
+        self.futures = {}
+
+    def _connect(self):
+        if self.sock is not None and self.pid == os.getpid():
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.sock, self.pid, self.futures = sock, os.getpid(), {}
+        threading.Thread(target=self._read, args=(sock, self.futures), daemon=True).start()
+
+    def _read(self, sock, futures):
+        stream = sock.makefile('rb')
+        try:
+            while True:
+                message = read_frame(stream)
+                future = futures.pop(message['id'], None)
+                if future is None:
+                    continue
+                if message['error'] is not None:
+                    future.set_exception(InferenceError(message['error']))
+                else:
+                    future.set_result(message['result'])
+        except (EOFError, OSError, ValueError):
+            pass
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+            for future in futures.values():
+                future.set_exception(InferenceError('Соединение с пулом разбора закрыто'))
+            futures.clear()
+        sock.close()
+
+    def submit(self, text):
+        future = Future()
+        with self.lock:
+            self._connect()
+            request_id = next(self.ids)
+            self.futures[request_id] = future
+            try:
+                write_frame(self.sock, {'id': request_id, 'text': text})
+            except OSError:
+                self.futures.pop(request_id, None)
+                self.sock.close()
+                self.sock = None
+                raise
+        return future
+
+    def analyze(self, texts, timeout=NER_TIMEOUT):
+        """
+        Разбирает тексты (они уходят в пул одновременно и могут попасть в один батч).
+        """
+        deadline = time.monotonic() + timeout
+        futures = [self.submit(text) for text in texts]
+        return [future.result(timeout=max(0, deadline - time.monotonic())) for future in futures]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=NER_SOCKET)
+    parser.add_argument('--workers', type=int, default=NER_WORKERS or 1)
+    parser.add_argument('--threads', type=int, default=NER_THREADS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # Процессы разбора читают число потоков из окружения при импорте модуля
+    os.environ['NER_THREADS'] = str(args.threads)
+    NER_THREADS = args.threads
+    # SIGTERM от gunicorn завершает сервер штатно, вместе с процессами разбора
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    serve(args.socket, args.workers)
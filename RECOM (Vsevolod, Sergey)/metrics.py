@@ -0,0 +1,64 @@
+"""
+Метрики сервиса рекомендаций в текстовом формате Prometheus: GET /metrics.
+
+Под gunicorn с несколькими воркерами задайте PROMETHEUS_MULTIPROC_DIR – пустой каталог,
+через который воркеры складывают значения (см. gunicorn.conf.py), иначе каждый воркер
+отдаёт только свои счётчики.
+"""
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Этапы рекомендации занимают от долей миллисекунды, поэтому нижние корзины мельче стандартных
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUESTS = Counter('recom_requests_total', 'Запросы к сервису рекомендаций', ['endpoint', 'status'])
+REQUEST_SECONDS = Histogram('recom_request_seconds', 'Время обработки запроса', ['endpoint'], buckets=BUCKETS)
+# load – загрузка каталога из сервиса БД, candidates – запрос /candidates, scoring – баллы заведений,
+# sort – сортировка и топ-3, ner – разбор пожеланий моделью, fuzzy – сопоставление с кухнями и блюдами,
+# rankings – расчёт готовых рейтингов частых профилей, batch – совместная оценка групп в /recommendations/batch
+STAGE_SECONDS = Histogram('recom_stage_seconds', 'Время этапов рекомендации', ['stage'], buckets=BUCKETS)
+CANDIDATE_ROWS = Histogram('recom_candidate_rows', 'Сколько заведений оценивается в запросе',
+                           buckets=(10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000))
+DATASET_GENERATION = Gauge('recom_dataset_generation', 'Поколение снимка каталога', multiprocess_mode='livemax')
+DATASET_ROWS = Gauge('recom_dataset_rows', 'Заведений в каталоге', multiprocess_mode='livemax')
+# Асинхронный режим (recommend_asgi.py): задачи в пуле расчёта и запросы, отклонённые при его переполнении
+EXECUTOR_PENDING = Gauge('recom_executor_pending', 'Задач в пуле расчёта, выполняемых и ожидающих',
+                         multiprocess_mode='livesum')
+REJECTED = Counter('recom_rejected_total', 'Запросы, отклонённые с 503 из-за переполнения пула расчёта')
+# Вызовы, дождавшиеся уже идущего такого же вычисления вместо своего (см. singleflight.py)
+COALESCED = Counter('recom_coalesced_total', 'Одинаковые одновременные запросы, объединённые с уже идущим',
+                    ['endpoint'])
+
+
+def metrics_payload():
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def metrics_view():
+    return Response(metrics_payload(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """
+    Считает запросы и время их обработки по endpoint и добавляет /metrics.
+    """
+    @app.before_request
+    def start_timer():
+        g.started_at = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'unknown'
+        REQUESTS.labels(endpoint, response.status_code).inc()
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.started_at)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -3,6 +3,7 @@ import re
 import torch
 from fuzzywuzzy import fuzz
 from transformers import BertForTokenClassification, BertTokenizerFast, logging as transformers_logging
+from metrics import STAGE_SECONDS
 transformers_logging.set_verbosity_error()
 
 
@@ -39,29 +40,39 @@ class FoodAnalyzer:
         self.label_map_reverse = {v: k for k, v in self.label_map.items()}
 
     def analyze(self, text):
-        inputs = self.tokenizer(
-            text.replace("ресторан","кухня").replace("кафе","кухня"), 
-            return_tensors="pt", 
-            truncation=True, 
-            padding=True
-        ).to(self.device)
-        
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            logits = outputs.logits
-            
-        predicted_labels = torch.argmax(logits, dim=-1).squeeze().tolist()
-        tokens = self.tokenizer.convert_ids_to_tokens(inputs["input_ids"].squeeze().tolist())
-        
-        word_labels = self._align_tokens_with_words(tokens, predicted_labels)
-        entities = self._extract_entities(word_labels)
-        
-        return {
-            "cuisine_positive": self._process_entities(entities["cuisine_positive"], "cuisine"),
-            "cuisine_negative": self._process_entities(entities["cuisine_negative"], "cuisine"),
-            "dish_positive": self._process_entities(entities["dish_positive"], "dish"),
-            "dish_negative": self._process_entities(entities["dish_negative"], "dish"),
-        }
+        return self.analyze_batch([text])[0]
+
+    def analyze_batch(self, texts):
+        """
+        Разбирает несколько текстов одним проходом модели: короткие дополняются [PAD],
+        которые при сборке слов пропускаются.
+        """
+        with STAGE_SECONDS.labels('ner').time():
+            inputs = self.tokenizer(
+                [text.replace("ресторан","кухня").replace("кафе","кухня") for text in texts],
+                return_tensors="pt",
+                truncation=True,
+                padding=True
+            ).to(self.device)
+
+            with torch.no_grad():
+                outputs = self.model(**inputs)
+                logits = outputs.logits
+
+        results = []
+        for input_ids, predicted_labels in zip(inputs["input_ids"].tolist(), torch.argmax(logits, dim=-1).tolist()):
+            tokens = self.tokenizer.convert_ids_to_tokens(input_ids)
+
+            word_labels = self._align_tokens_with_words(tokens, predicted_labels)
+            entities = self._extract_entities(word_labels)
+
+            results.append({
+                "cuisine_positive": self._process_entities(entities["cuisine_positive"], "cuisine"),
+                "cuisine_negative": self._process_entities(entities["cuisine_negative"], "cuisine"),
+                "dish_positive": self._process_entities(entities["dish_positive"], "dish"),
+                "dish_negative": self._process_entities(entities["dish_negative"], "dish"),
+            })
+        return results
         
     def _align_tokens_with_words(self, tokens, predicted_labels):
         word_labels = []
@@ -158,6 +169,7 @@ class FoodAnalyzer:
         return self._check_similarity(text, self.unique_dishes, threshold)
         
     @staticmethod
+    @STAGE_SECONDS.labels('fuzzy').time()
     def _check_similarity(text, targets, threshold):
         best_match = None
         max_similarity = 0
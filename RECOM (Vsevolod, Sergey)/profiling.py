@@ -0,0 +1,139 @@
+"""
+Профилирование отдельного запроса по требованию.
+
+Включается конфигурацией PROFILE_ENABLED=1; тогда запрос с заголовком X-Profile: 1
+(или параметром ?profile=1) выполняется под сэмплирующим профилировщиком: отдельный поток
+каждые PROFILE_INTERVAL_MS снимает стек потока, обрабатывающего запрос. Результат – свёрнутые стеки
+(«кадр;кадр;кадр число_сэмплов», формат flamegraph.pl / speedscope) в PROFILE_DIR/<request id>.folded;
+id берётся из X-Request-Id или генерируется и возвращается в заголовке X-Profile-Id.
+Профиль отдаётся по GET /profiles/<request id>.
+
+    curl -H 'X-Profile: 1' -H 'X-Request-Id: slow-group' -d @payload.json ... /recommendations
+    curl .../profiles/slow-group | flamegraph.pl > slow-group.svg
+
+Без PROFILE_ENABLED обработчики не регистрируются и запросы не проверяются вовсе.
+"""
+import os
+import re
+import sys
+import threading
+import uuid
+from collections import Counter
+
+from flask import Response, g, request
+
+PROFILE_ENABLED = os.getenv('PROFILE_ENABLED') == '1'
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '1'))
+# Сколько последних профилей хранить
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '100'))
+
+REQUEST_ID_PATTERN = re.compile(r'^[\w.-]{1,64}$')
+
+# Пока идёт профилирование, интервал переключения потоков уменьшается до интервала сэмплов,
+# иначе поток профилировщика получает GIL не чаще раза в 5 мс
+_switch_lock = threading.Lock()
+_active_profiles = 0
+_default_switch_interval = sys.getswitchinterval()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """
+    Сэмплирует стек одного потока в фоне; stop() возвращает Counter {свёрнутый стек: сэмплов}.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse(frame)] += 1
+
+    def start(self):
+        global _active_profiles
+        with _switch_lock:
+            _active_profiles += 1
+            sys.setswitchinterval(min(_default_switch_interval, self.interval))
+        self.thread.start()
+        return self
+
+    def stop(self):
+        global _active_profiles
+        self.stopped.set()
+        self.thread.join()
+        with _switch_lock:
+            _active_profiles -= 1
+            if not _active_profiles:
+                sys.setswitchinterval(_default_switch_interval)
+        return self.samples
+
+
+def profile_path(request_id):
+    return os.path.join(PROFILE_DIR, f'{request_id}.folded')
+
+
+def save_profile(request_id, samples):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(profile_path(request_id), 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f'{stack} {count}\n')
+    profiles = sorted(os.scandir(PROFILE_DIR), key=lambda entry: entry.stat().st_mtime)
+    for entry in profiles[:-PROFILE_KEEP]:
+        os.remove(entry.path)
+
+
+def profile_requested():
+    return request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1'
+
+
+def get_profile(request_id):
+    if not REQUEST_ID_PATTERN.match(request_id) or not os.path.exists(profile_path(request_id)):
+        return 'Профиль не найден', 404
+    with open(profile_path(request_id)) as f:
+        return Response(f.read(), mimetype='text/plain')
+
+
+def init_profiling(app):
+    if not PROFILE_ENABLED:
+        return
+
+    @app.before_request
+    def start_profile():
+        if not profile_requested():
+            return
+        request_id = request.headers.get('X-Request-Id', '')
+        g.profile_id = request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+        g.profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000).start()
+
+    @app.teardown_request
+    def stop_profile(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            save_profile(g.profile_id, profiler.stop())
+
+    @app.after_request
+    def add_profile_id(response):
+        if 'profiler' in g:
+            response.headers['X-Profile-Id'] = g.profile_id
+        return response
+
+    app.add_url_rule('/profiles/<request_id>', 'get_profile', get_profile)
@@ -0,0 +1,258 @@
+"""
+Готовые рейтинги для частых ответов групп.
+
+Ответы сильно повторяются: несколько вариантов бюджета и времени в пути и пять кухонь. Каждый запрос
+без свободных пожеланий записывается в PROFILE_LOG каноническим профилем: офис и доли по кухням,
+ограничениям, бюджетам и времени в пути. Запрос только кладёт профиль в буфер процесса, фоновый поток
+дописывает буфер в журнал раз в PROFILE_FLUSH_SECONDS.
+
+Когда воркер переходит на новое поколение каталога, фоновый поток берёт последние PROFILE_LOG_BYTES журнала
+и считает топ-3 для PRECOMPUTE_PROFILES самых частых профилей каждого офиса. Считает один воркер,
+результат сохраняется в каталог поколения (rankings.json), остальные воркеры ждут файл и читают его.
+Пока рейтинги нового поколения не готовы, все запросы считаются как обычно. Рейтинги пересчитываются
+и внутри поколения – через RANKINGS_REFRESH_SECONDS или после RANKINGS_REFRESH_PROFILES новых профилей
+в воркере, – иначе после нового развёртывания с пустым журналом они оставались бы пустыми до следующей
+загрузки каталога.
+
+Запрос с тем же профилем отвечается из готового рейтинга. При PROFILE_TOLERANCE > 0 доли сравниваются
+с этой точностью: ответ частого профиля отдаётся и близким к нему, хотя точный расчёт мог бы немного отличаться.
+По умолчанию нужно точное совпадение.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+from metrics import STAGE_SECONDS
+
+PROFILE_LOG = os.getenv('PROFILE_LOG', 'data/profile_log.jsonl')
+# Сколько последних байт журнала учитывать; журнал длиннее вдвое обрезается до них
+PROFILE_LOG_BYTES = int(os.getenv('PROFILE_LOG_BYTES', str(8 * 1024 * 1024)))
+PRECOMPUTE_PROFILES = int(os.getenv('PRECOMPUTE_PROFILES', '200'))
+PROFILE_TOLERANCE = float(os.getenv('PROFILE_TOLERANCE', '0'))
+# Как часто буфер профилей дописывается в журнал, и при каком размере буфера – сразу
+PROFILE_FLUSH_SECONDS = float(os.getenv('PROFILE_FLUSH_SECONDS', '1'))
+PROFILE_BUFFER_ENTRIES = int(os.getenv('PROFILE_BUFFER_ENTRIES', '256'))
+# Пересчёт рейтингов внутри поколения: по времени и по числу новых профилей в воркере
+RANKINGS_REFRESH_SECONDS = float(os.getenv('RANKINGS_REFRESH_SECONDS', '600'))
+RANKINGS_REFRESH_PROFILES = int(os.getenv('RANKINGS_REFRESH_PROFILES', '1000'))
+
+RANKINGS_FILE = 'rankings.json'
+
+
+def profile_key(user_answers, tolerance=0):
+    """
+    Канонический профиль ответа – строка JSON; порядок вариантов не важен, варианты без колонки
+    на баллы не влияют. tolerance – доли округляются до кратных ей.
+    """
+    def shares(pairs):
+        return sorted([value, round(round(share / tolerance) * tolerance, 6) if tolerance else share]
+                      for value, share in pairs if value)
+
+    return json.dumps([user_answers['office'], shares(user_answers['wanted_cuisines']),
+                       shares(user_answers['food_restrictions']), shares(user_answers['price_limit']),
+                       shares(user_answers['walk_time'])], ensure_ascii=False)
+
+
+def profile_answers(key):
+    office, cuisines, restrictions, budget, walk = json.loads(key)
+    return {
+        'office': office,
+        # Группы из разных офисов в рейтинги не попадают (см. precomputed_recommendation)
+        'offices': [],
+        'wanted_cuisines': [tuple(pair) for pair in cuisines],
+        'food_restrictions': [tuple(pair) for pair in restrictions],
+        'price_limit': [tuple(pair) for pair in budget],
+        'walk_time': [tuple(pair) for pair in walk],
+        'positive': '',
+        'negative': ''
+    }
+
+
+# 🔹 Журнал профилей
+
+class ProfileLog:
+    """
+    Буфер профилей процесса и фоновый поток, дописывающий его в журнал. Запись идёт одним os.write
+    с O_APPEND – строки воркеров не перемешиваются; после обрезки журнала (файл заменён) он открывается
+    заново. Поток запускается в каждом процессе при первой записи (воркеры gunicorn – форки).
+    """
+
+    def __init__(self, path=PROFILE_LOG):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = []
+        # Сколько профилей записано в этом процессе – по нему Rankings решает, пора ли пересчитать рейтинги
+        self.recorded = 0
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.fd = None
+
+    def record(self, key):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid, self.fd, self.pending, self.recorded = os.getpid(), None, [], 0
+                self.wakeup = threading.Event()
+                threading.Thread(target=self._run, args=(self.wakeup,), daemon=True).start()
+            self.pending.append(key)
+            self.recorded += 1
+            if len(self.pending) >= PROFILE_BUFFER_ENTRIES:
+                self.wakeup.set()
+
+    def _run(self, wakeup):
+        while True:
+            wakeup.wait(PROFILE_FLUSH_SECONDS)
+            wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            keys, self.pending = self.pending, []
+            if not keys or self.pid != os.getpid():
+                return
+            try:
+                if self.fd is not None and os.fstat(self.fd).st_nlink == 0:
+                    os.close(self.fd)
+                    self.fd = None
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                os.write(self.fd, ''.join(key + '\n' for key in keys).encode('utf-8'))
+            except OSError as e:
+                logging.error("Не удалось записать профили: %s", e)
+
+
+profile_log = ProfileLog()
+# Профили из буфера не теряются при штатной остановке воркера
+atexit.register(profile_log.flush)
+
+
+def record_profile(key):
+    """
+    Кладёт профиль в буфер журнала; без файлового ввода-вывода, можно вызывать из цикла событий.
+    """
+    profile_log.record(key)
+
+
+def frequent_profiles(path=PROFILE_LOG, limit=PRECOMPUTE_PROFILES):
+    """
+    Самые частые профили каждого офиса среди последних PROFILE_LOG_BYTES журнала.
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - PROFILE_LOG_BYTES))
+            tail = f.read()
+    except FileNotFoundError:
+        return []
+    lines = tail.decode('utf-8', errors='replace').splitlines()
+    if size > PROFILE_LOG_BYTES:
+        # Первая строка могла попасть в окно не целиком
+        lines = lines[1:]
+    by_office = defaultdict(Counter)
+    for line in lines:
+        try:
+            by_office[json.loads(line)[0]][line] += 1
+        except (ValueError, IndexError, TypeError):
+            continue
+    if size > 2 * PROFILE_LOG_BYTES:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.writelines(line + '\n' for line in lines)
+        os.replace(path + '.tmp', path)
+    return [key for counts in by_office.values() for key, _ in counts.most_common(limit)]
+
+
+# 🔹 Рейтинги поколения
+
+class Rankings:
+    """
+    Готовые рейтинги текущего поколения в воркере. score(user_answers, snapshot) – обычный расчёт,
+    по которому они строятся.
+    """
+
+    def __init__(self, root, score, tolerance=PROFILE_TOLERANCE):
+        self.root = root
+        self.score = score
+        self.tolerance = tolerance
+        self.generation = None
+        self.exact = {}
+        self.approx = {}
+        # Время изменения загруженного rankings.json и когда / при каком числе профилей начата загрузка
+        self.built_at = None
+        self.started_at = 0
+        self.started_recorded = 0
+        self.loading = False
+        self.lock = threading.Lock()
+
+    def lookup(self, snapshot, key, user_answers):
+        """
+        Готовый рейтинг для профиля key (см. profile_key) или None.
+        """
+        if snapshot.generation != self.generation:
+            with self.lock:
+                if snapshot.generation != self.generation:
+                    self.generation, self.exact, self.approx, self.built_at = snapshot.generation, {}, {}, None
+                    self._start_load(snapshot)
+            return None
+        if self._refresh_due():
+            with self.lock:
+                if self._refresh_due():
+                    self._start_load(snapshot)
+        result = self.exact.get(key)
+        if result is None and self.approx:
+            result = self.approx.get(profile_key(user_answers, self.tolerance))
+        return result
+
+    def _refresh_due(self):
+        return not self.loading and (time.monotonic() - self.started_at >= RANKINGS_REFRESH_SECONDS or
+                                     profile_log.recorded - self.started_recorded >= RANKINGS_REFRESH_PROFILES)
+
+    def _start_load(self, snapshot):
+        # Вызывается под self.lock; рейтинги пересчитываются в фоне, пока запросы отвечаются по старым
+        self.loading = True
+        self.started_at, self.started_recorded = time.monotonic(), profile_log.recorded
+        threading.Thread(target=self._load, args=(snapshot, self.built_at), daemon=True).start()
+
+    def _load(self, snapshot, built_at):
+        try:
+            # Свежие профили этого воркера должны попасть в журнал до подсчёта частот
+            profile_log.flush()
+            rankings, built_at = self._shared_rankings(snapshot, built_at)
+        except Exception:
+            logging.exception("Не удалось подготовить рейтинги поколения %s", snapshot.generation)
+            with self.lock:
+                self.loading = False
+            return
+        approx = {}
+        if self.tolerance:
+            # Профили идут по убыванию частоты: близким достаётся рейтинг самого частого
+            for key, result in rankings.items():
+                approx.setdefault(profile_key(profile_answers(key), self.tolerance), result)
+        with self.lock:
+            self.loading = False
+            if self.generation == snapshot.generation:
+                self.exact, self.approx, self.built_at = rankings, approx, built_at
+
+    def _shared_rankings(self, snapshot, built_at=None):
+        """
+        Рейтинги из каталога поколения и время изменения их файла. Если их ещё нет или в воркере
+        загружены рейтинги от built_at и с тех пор их никто не пересчитал, считает их под блокировкой –
+        воркеры, пришедшие за рейтингами одновременно, ждут первого.
+        """
+        directory = os.path.join(self.root, str(snapshot.generation))
+        path = os.path.join(directory, RANKINGS_FILE)
+        with open(os.path.join(directory, 'rankings.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path) or (built_at is not None and os.stat(path).st_mtime_ns <= built_at):
+                with STAGE_SECONDS.labels('rankings').time():
+                    rankings = {key: self.score(profile_answers(key), snapshot) for key in frequent_profiles()}
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(rankings, f, ensure_ascii=False)
+                os.replace(path + '.tmp', path)
+                logging.info("Рейтинги поколения %s: %d профилей", snapshot.generation, len(rankings))
+            built_at = os.stat(path).st_mtime_ns
+            with open(path, encoding='utf-8') as f:
+                return json.load(f), built_at
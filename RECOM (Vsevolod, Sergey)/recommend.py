@@ -1,45 +1,125 @@
 from flask import Flask, request, jsonify
+import fcntl
+import hashlib
+import json
+import logging
+import os
 import pandas as pd
 import requests
 from io import StringIO
-# Модель весит слишком много, поэтому не вошла
-# from processing_requests import FoodAnalyzer
+from vocabulary import OFFICE_IDS, OFFICES, CUISINES, RESTRICTIONS, BUDGETS, WALK_TIMES
+from catalog import (SharedCatalog, build_catalog, current_generation, group_walk_times, office_places, places_frame,
+                     publish_catalog, read_office_csv, save_catalog, text_values)
+from metrics import CANDIDATE_ROWS, COALESCED, DATASET_GENERATION, DATASET_ROWS, STAGE_SECONDS, init_app
+from profiling import init_profiling
+from inference import NER_ENABLED, InferenceError, NerClient
+from rankings import Rankings, profile_key, record_profile
+from batch_scoring import rank_places, recommend_batch
+from singleflight import SingleFlight
 app = Flask(__name__)
+init_app(app)
+# Профиль отдельного запроса по заголовку X-Profile (только при PROFILE_ENABLED=1), см. profiling.py
+init_profiling(app)
+
+# Пока нет автоматизированного парсинга, нет большого смысла смысла от БД, поэтому просто грузим всю инфу в память:
+# каталог уникальных заведений и векторы времени в пути для каждого офиса (см. catalog.py).
+# Снимок каталога отображается в память, все воркеры gunicorn делят одну копию
+shared_catalog = SharedCatalog()
+
+# Если задан адрес сервиса БД, кандидаты с жёсткими ограничениями (бюджет, время в пути)
+# отбираются запросом /candidates на стороне БД, а не из всех заведений у офиса
+DB_URL = os.getenv('DB_URL')
+# Сколько кандидатов запрашивать (0 – без ограничения)
+CANDIDATE_LIMIT = int(os.getenv('CANDIDATE_LIMIT', '0'))
+# Во сколько раз заведение может превышать самый большой бюджет и время в пути из ответов
+CANDIDATE_SLACK = float(os.getenv('CANDIDATE_SLACK', '1.5'))
+# Сервис БД, из которого /get_data загружает каталог, и офисы, которые загружаются
+CATALOG_SOURCE_URL = DB_URL or 'http://127.0.0.1:5000'
+CATALOG_OFFICES = (1, 2, 3)
+# Сколько секунд ждать выгрузку офиса: зависший сервис БД не должен блокировать перезагрузку навсегда
+CATALOG_TIMEOUT = float(os.getenv('CATALOG_TIMEOUT', '30'))
+# Сколько групп принимается в одном запросе /recommendations/batch
+BATCH_MAX_GROUPS = int(os.getenv('BATCH_MAX_GROUPS', '1000'))
+# Как сводить время в пути для группы из разных офисов, если в запросе не указано:
+# 'max' – по самому дальнему участнику, 'mean' – среднее по участникам (см. catalog.group_walk_times)
+WALK_OBJECTIVES = ('max', 'mean')
+WALK_OBJECTIVE = os.getenv('WALK_OBJECTIVE', 'max')
+
+# Пока NER выключен, дополнительных пожеланий по кухням и блюдам нет
+EMPTY_WISHES = {
+    'positive_cuisines': [],
+    'positive_dishes': [],
+    'negative_cuisines': [],
+    'negative_dishes': []
+}
+
+def refresh_catalog(office_csvs):
+    """
+    Собирает каталог из выгрузок офисов {office_id: текст CSV}, сохраняет его на диск
+    и публикует новым поколением снимка – все воркеры переходят на него со следующего запроса.
+    """
+    frames = {office_id: read_office_csv(StringIO(text)) for office_id, text in office_csvs.items()}
+    catalog, walk_times = build_catalog(frames)
+    save_catalog(catalog, walk_times)
+    publish_catalog(catalog, walk_times)
+
+
+def acquire_reload(generation):
+    """
+    Берёт блокировку перезагрузки каталога: воркеры, одновременно получившие /get_data, ждут друг друга.
+    Возвращает открытый файл блокировки (закрытие снимает её) или None, если после поколения generation
+    каталог уже обновил кто-то другой и загружать его не нужно.
+    """
+    os.makedirs(shared_catalog.root, exist_ok=True)
+    lock = open(os.path.join(shared_catalog.root, 'reload.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    if current_generation(shared_catalog.root) != generation:
+        lock.close()
+        COALESCED.labels('get_data').inc()
+        return None
+    return lock
+
+
+def reload_catalog(generation, office_csvs):
+    """
+    Обновляет каталог, если после поколения generation его ещё никто не обновил (см. acquire_reload).
+    office_csvs() – выгрузки офисов, запрашиваются только если загрузка нужна.
+    """
+    lock = acquire_reload(generation)
+    if lock is None:
+        return
+    with lock:
+        refresh_catalog(office_csvs())
+
+
+def fetch_offices():
+    return {office_id: requests.get(url=f'{CATALOG_SOURCE_URL}/get_office_{office_id}', timeout=CATALOG_TIMEOUT).text
+            for office_id in CATALOG_OFFICES}
+
+
+# Одинаковые одновременные вызовы в воркере выполняются один раз (см. singleflight.py):
+# перезагрузки – по поколению каталога, рекомендации – по ключу запроса
+reloads = SingleFlight('get_data')
+recommendations = SingleFlight('recommendations')
 
-# Пока нет автоматизированного парсинга, нет большого смысла смысла от БД, поэтому просто грузим всю инфу в память.
-# Если будет автопарсер, то уже можно использовать функцию ниже 
-df_office_1 = pd.read_csv('office1.csv')
-df_office_2 = pd.read_csv('office2.csv')
-df_office_3 = pd.read_csv('office3.csv')
 
 @app.route('/get_data', methods=['POST'])
 def get_data():
-    global df_office_1
-    global df_office_2
-    global df_office_3
+    """
+    Обновляет каталог из сервиса БД.
+    """
     try:
-        office_1 = requests.get(url='http://127.0.0.1:5000/get_office_1').text
-        csv_file = StringIO(office_1)
-        df_office_1 = pd.read_csv(csv_file)
-        df_office_1 = df_office_1.rename(columns={'office_1_time': 'office_time'})
-        office_2 = requests.get(url='http://127.0.0.1:5000/get_office_2').text
-        csv_file = StringIO(office_2)
-        df_office_2 = pd.read_csv(csv_file)
-        df_office_2 = df_office_2.rename(columns={'office_2_time': 'office_time'})
-        office_3 = requests.get(url='http://127.0.0.1:5000/get_office_3').text
-        csv_file = StringIO(office_3)
-        df_office_3 = pd.read_csv(csv_file)
-        df_office_3 = df_office_3.rename(columns={'office_3_time': 'office_time'})
-        return 200
-    except:
-        return 400
-
-
-# analyzer = FoodAnalyzer(
-#     model_path='models/request_processing/request_processing_model.pth',
-#     cuisine_json_path='data/unique_cuisines.json',
-#     dish_json_path='data/unique_dishes.json'
-# )
+        generation = current_generation(shared_catalog.root)
+        with STAGE_SECONDS.labels('load').time():
+            reloads.do(generation, lambda: reload_catalog(generation, fetch_offices))
+        return 'OK', 200
+    except Exception as e:
+        logging.error("Не удалось обновить каталог: %s", e)
+        return 'Не удалось обновить каталог', 400
+
+
+# Модель разбора пожеланий работает в отдельных процессах (inference.py), web-воркер только отправляет тексты
+ner_client = NerClient() if NER_ENABLED else None
 
 
 # 🔹 Функция для учета пожеланий по блюдам (без штрафов за негативные блюда)
@@ -79,28 +159,64 @@ def adjust_cuisine_score(row, structured_wishes):
 
     return positive_cuisine_bonus + negative_cuisine_penalty
 
+# 🔹 Разбор запроса: поддерживаются компактный формат v2 (id вариантов из vocabulary.py)
+# и старый формат с подписями в качестве ключей (на время миграции бота)
+def parse_user_answers(payload):
+    """
+    Приводит запрос к внутреннему виду: офис – id, офисы участников – пары (id, доля), кухни и ограничения –
+    пары (колонка, доля), бюджет и время в пути – пары (число, доля). Числа разбираются один раз на запрос,
+    а не на каждую строку.
+    """
+    objective = payload.get('walk_objective')
+    if objective not in WALK_OBJECTIVES:
+        objective = WALK_OBJECTIVE
+    if payload.get('v') == 2:
+        return {
+            'office': payload.get('office'),
+            'offices': [(i, share) for i, share in payload.get('offices', []) if i in OFFICES],
+            'walk_objective': objective,
+            'wanted_cuisines': [(CUISINES[i][1], share) for i, share in payload.get('cuisines', []) if i in CUISINES],
+            'food_restrictions': [(RESTRICTIONS[i][1], share) for i, share in payload.get('restrictions', []) if i in RESTRICTIONS],
+            'price_limit': [(BUDGETS[i][1], share) for i, share in payload.get('budget', []) if i in BUDGETS],
+            'walk_time': [(WALK_TIMES[i][1], share) for i, share in payload.get('walk', []) if i in WALK_TIMES],
+            'positive': payload.get('positive', ''),
+            'negative': payload.get('negative', '')
+        }
+    return {
+        'office': OFFICE_IDS.get(payload.get('office')),
+        'offices': [(OFFICE_IDS[office], share) for office, share in payload.get('offices', {}).items()
+                    if office in OFFICE_IDS],
+        'walk_objective': objective,
+        'wanted_cuisines': list(payload.get('wanted_cuisines', {}).items()),
+        'food_restrictions': list(payload.get('food_restrictions', {}).items()),
+        'price_limit': [(int(limit), share) for limit, share in payload.get('price_limit', {}).items()],
+        'walk_time': [(int(limit), share) for limit, share in payload.get('walk_time', {}).items()],
+        'positive': payload.get('positive', ''),
+        'negative': payload.get('negative', '')
+    }
+
 # 🔹 Функция для расчета итогового балла заведения (по опросу + дополнительно по structured_wishes)
 def calculate_score(row, user_answers, structured_wishes):
     # 🔹 1. Баллы за кухню (по результатам опроса)
     cuisine_score = sum(
-        user_answers["wanted_cuisines"].get(c, 0)*2 for c in user_answers["wanted_cuisines"] if row.get(c, False)
+        share * 2 for column, share in user_answers["wanted_cuisines"] if column and row.get(column, False)
     )
 
     # 🔹 2. Баллы за ограничения по питанию (по результатам опроса)
     restrictions_score = sum(
-        user_answers["food_restrictions"].get(r, 0) * 1.5 for r in user_answers["food_restrictions"] if row.get(r, False)
+        share * 1.5 for column, share in user_answers["food_restrictions"] if column and row.get(column, False)
     )
 
     # 🔹 3. Баллы за цену (по результатам опроса)
     price = row["price_limit"]
     price_score = sum(
-        user_answers["price_limit"].get(limit, 0) for limit in user_answers["price_limit"] if pd.notna(price) and price <= int(limit)
+        share for limit, share in user_answers["price_limit"] if pd.notna(price) and price <= limit
     )
 
     # 🔹 4. Баллы за время в пути (по результатам опроса)
     walk_time = row["office_time"]
     walk_score = sum(
-        user_answers["walk_time"].get(limit, 0) for limit in user_answers["walk_time"] if pd.notna(walk_time) and walk_time <= int(limit)
+        share for limit, share in user_answers["walk_time"] if pd.notna(walk_time) and walk_time <= limit
     )
 
     # 🔹 5. Баллы за рейтинг и отзывы (по результатам опроса)
@@ -108,58 +224,221 @@ def calculate_score(row, user_answers, structured_wishes):
     reviews = row["reviews_general_review_count"]
     rating_score = (1 if rating > 4.5 else 0) + (1 if reviews > 200 else 0)
 
-    # # 🔹 6. ДОПОЛНИТЕЛЬНЫЕ Баллы за structured_wishes (кухни и блюда)
-    # structured_cuisine_score = adjust_cuisine_score(row, structured_wishes)
-    # structured_dish_score = adjust_score_by_dishes(row, structured_wishes)
+    # 🔹 6. ДОПОЛНИТЕЛЬНЫЕ Баллы за structured_wishes (кухни и блюда), если пожелания разобраны
+    structured_score = 0
+    if structured_wishes is not EMPTY_WISHES:
+        structured_score = adjust_cuisine_score(row, structured_wishes) + adjust_score_by_dishes(row, structured_wishes)
 
     # 🔹 Общая сумма баллов
-    # total_score = (cuisine_score + restrictions_score + price_score +
-    #                walk_score + rating_score + structured_cuisine_score + structured_dish_score)
     total_score = (cuisine_score + restrictions_score + price_score +
-                   walk_score + rating_score)
+                   walk_score + rating_score + structured_score)
 
     return total_score
 
-# def user_wishes(user_wish):
-#     result = analyzer.analyze(user_wish)
-#     output_for_recommendation_system = {
-#     'positive_cuisines': FoodAnalyzer.filter_words(result['cuisine_positive']),
-#     'positive_dishes': FoodAnalyzer.filter_words(result['dish_positive']),
-#     'negative_cuisines': FoodAnalyzer.filter_words(result['cuisine_negative']),
-#     'negative_dishes': FoodAnalyzer.filter_words(result['dish_negative'])
-#     }
-#     return output_for_recommendation_system
+def survey_score(row, user_answers):
+    return calculate_score(row, user_answers, EMPTY_WISHES)
 
-@app.route('/recommendations', methods=['POST'])
-def get_recommendation():
-    # Получаем входные данные от пользователя
-    user_answers = request.json
-    if user_answers['office'] == "пер. Виленский, 14А":
-        df = df_office_1
-    elif user_answers['office'] == "Дегтярный пер., 11Б":
-        df = df_office_2
-    elif user_answers['office'] == "Киевская ул., 5 корп. 4":
-        df = df_office_3
+def mixed_offices(user_answers):
+    """
+    Участники группы из разных офисов – время в пути считается до всех них, а не до офиса организатора.
+    """
+    return len({office_id for office_id, _ in user_answers['offices']}) > 1
+
+def group_candidates(user_answers, snapshot, k):
+    """
+    Заведения для группы из разных офисов: строки каталога и общее время в пути. Как и кандидаты из БД,
+    остаются только заведения не намного дальше самого большого времени в пути из ответов – если их
+    хотя бы k. Иначе (например, у офисов нет общих заведений) оцениваются все, без баллов за время в пути
+    там, где оно неизвестно.
+    """
+    rows, walk_time = group_walk_times(snapshot, user_answers['offices'], user_answers['walk_objective'])
+    if user_answers['walk_time']:
+        near = walk_time <= max(limit for limit, _ in user_answers['walk_time']) * CANDIDATE_SLACK
+        if near.sum() >= k:
+            rows, walk_time = rows[near], walk_time[near]
+    return rows, walk_time
+
+def candidate_filters(user_answers):
+    """
+    Жёсткие ограничения группы: заведение намного дороже самого большого бюджета или намного
+    дальше самого большого времени в пути из ответов не подходит ни одному участнику.
+    """
+    params = {'office_id': user_answers['office']}
+    if user_answers['price_limit']:
+        params['max_price'] = max(limit for limit, _ in user_answers['price_limit']) * CANDIDATE_SLACK
+    if user_answers['walk_time']:
+        params['max_walk'] = max(limit for limit, _ in user_answers['walk_time']) * CANDIDATE_SLACK
+    if CANDIDATE_LIMIT:
+        params['limit'] = CANDIDATE_LIMIT
+    return params
+
+
+def fetch_candidates(user_answers):
+    """
+    CSV кандидатов из сервиса БД или None, если он недоступен.
+    """
+    try:
+        with STAGE_SECONDS.labels('candidates').time():
+            response = requests.get(f'{DB_URL}/candidates', params=candidate_filters(user_answers), timeout=5)
+            response.raise_for_status()
+    except requests.RequestException as e:
+        logging.error("Не удалось получить кандидатов из БД: %s", e)
+        return None
+    return response.text
+
+
+def candidates_frame(text, office_id):
+    return pd.read_csv(StringIO(text)).rename(columns={f'office_{office_id}_time': 'office_time'})
+
+def user_wishes(user_answers):
+    """
+    Пожелания группы по кухням и блюдам из свободных ответов. Если пул разбора выключен
+    или не ответил вовремя, рекомендация строится без них.
+    """
+    texts = [text for text in (user_answers['positive'], user_answers['negative']) if text]
+    if ner_client is None or not texts:
+        return EMPTY_WISHES
+    try:
+        results = ner_client.analyze(texts)
+    except (InferenceError, OSError, TimeoutError) as e:
+        logging.error("Не удалось разобрать пожелания: %s", e)
+        return EMPTY_WISHES
+    return {key: list(set().union(*(result[key] for result in results))) for key in EMPTY_WISHES}
+
+def recommend(user_answers, snapshot, candidates=None, k=3):
+    """
+    Топ-k заведений для группы: [названия, id]. candidates – CSV кандидатов из сервиса БД,
+    иначе оцениваются все заведения у офиса из снимка. Для группы из разных офисов оцениваются
+    заведения рядом со всеми офисами (group_candidates); без свободных пожеланий – матрично, как в батче.
+    Только вычисления, без сетевых запросов – асинхронный режим выполняет её в пуле (см. recommend_asgi.py).
+    """
+    DATASET_GENERATION.set(snapshot.generation)
+    DATASET_ROWS.set(len(snapshot.numeric))
+    structured_wishes = user_wishes(user_answers)
+    if mixed_offices(user_answers):
+        rows, walk_time = group_candidates(user_answers, snapshot, k)
+        CANDIDATE_ROWS.observe(len(rows))
+        if structured_wishes is EMPTY_WISHES:
+            with STAGE_SECONDS.labels('scoring').time():
+                return rank_places(snapshot, rows, walk_time, [user_answers], survey_score, k)[0]
+        df = places_frame(snapshot, rows, walk_time)
+    elif candidates is not None:
+        df = candidates_frame(candidates, user_answers['office'])
     else:
-        return '400, office with this name not found'
-    # wished = user_wishes(user_answers['positive'])
-    # not_wished = user_wishes(user_answers['negative'])
-    # structured_wishes = {
-    # key: list(set(wished.get(key, []) + not_wished.get(key, [])))
-    # for key in wished.keys() | not_wished.keys()
-    # }
+        df = office_places(snapshot, user_answers['office'])
+    if structured_wishes is not EMPTY_WISHES and 'Cuisine' not in df:
+        df['Cuisine'] = text_values(snapshot, 'Cuisine', df['row'])
+    if not mixed_offices(user_answers):
+        CANDIDATE_ROWS.observe(len(df))
     # 🔹 Добавляем колонку с баллами
-    df["total_score"] = df.apply(lambda row: calculate_score(row, user_answers, structured_wishes), axis=1)
+    with STAGE_SECONDS.labels('scoring').time():
+        df["total_score"] = df.apply(lambda row: calculate_score(row, user_answers, structured_wishes), axis=1)
 
-    # 🔹 Сортируем по баллам, затем по рейтингу, затем по количеству отзывов
-    df_sorted = df.sort_values(by=["total_score", "reviews_general_rating", "reviews_general_review_count"], 
-                            ascending=[False, False, False])
+    with STAGE_SECONDS.labels('sort').time():
+        # 🔹 Сортируем по баллам, затем по рейтингу, затем по количеству отзывов
+        df_sorted = df.sort_values(by=["total_score", "reviews_general_rating", "reviews_general_review_count"],
+                                ascending=[False, False, False])
 
-    # 🔹 Выбираем топ-3 ресторана
-    top_3_places = df_sorted.head(3)
+        # 🔹 Выбираем топ-3 ресторана
+        top_3_places = df_sorted.head(k)
+    if 'name' not in top_3_places:
+        # Названия из снимка каталога читаются только для выбранных заведений
+        top_3_places = top_3_places.assign(name=text_values(snapshot, 'name', top_3_places['row']))
     # Преобразуем результат в JSON
     result = list([list(top_3_places['name'].to_list()), list(top_3_places['id'].to_list())])
     return result
 
+
+# Готовые рейтинги частых профилей ответов, пересчитываются для каждого поколения каталога (см. rankings.py)
+rankings = Rankings(shared_catalog.root, recommend)
+
+
+def precomputed_recommendation(user_answers, snapshot):
+    """
+    Готовый рейтинг для профиля ответа или None. Рейтинги считаются по снимку каталога, поэтому
+    не используются, если кандидаты берутся из БД; запросы со свободными пожеланиями и группы из разных
+    офисов всегда считаются.
+    """
+    if DB_URL or user_answers['positive'] or user_answers['negative'] or mixed_offices(user_answers):
+        return None
+    key = profile_key(user_answers)
+    record_profile(key)
+    return rankings.lookup(snapshot, key, user_answers)
+
+
+def request_key(user_answers, snapshot):
+    """
+    Ключ одинаковых запросов: хеш канонического профиля, офисов участников, свободных пожеланий
+    и поколения каталога.
+    """
+    offices = [sorted(user_answers['offices']), user_answers['walk_objective']] if mixed_offices(user_answers) else None
+    canonical = json.dumps([profile_key(user_answers), offices, user_answers['positive'], user_answers['negative'],
+                            snapshot.generation], ensure_ascii=False)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+@app.route('/recommendations', methods=['POST'])
+def get_recommendation():
+    # Получаем входные данные от пользователя
+    user_answers = parse_user_answers(request.json)
+    snapshot = shared_catalog.current()
+    if user_answers['office'] not in snapshot.walk_times:
+        return '400, office with this name not found'
+    result = precomputed_recommendation(user_answers, snapshot)
+    if result is not None:
+        return result
+
+    def compute():
+        candidates = fetch_candidates(user_answers) if DB_URL and not mixed_offices(user_answers) else None
+        return recommend(user_answers, snapshot, candidates)
+
+    return recommendations.do(request_key(user_answers, snapshot), compute)
+
+
+def batch_recommendations(groups, snapshot, k=3):
+    """
+    Топ-k для каждой группы ([названия, id] или None, если офиса нет) по снимку каталога.
+    Группы одного офиса без свободных пожеланий оцениваются вместе (см. batch_scoring.py),
+    остальные – по одной.
+    """
+    with STAGE_SECONDS.labels('batch').time():
+        plain = [i for i, user_answers in enumerate(groups) if not mixed_offices(user_answers)
+                 and (ner_client is None or not (user_answers['positive'] or user_answers['negative']))]
+        results = [None] * len(groups)
+        for i, result in zip(plain, recommend_batch(snapshot, [groups[i] for i in plain], survey_score, k)):
+            results[i] = result
+    for i, user_answers in enumerate(groups):
+        if results[i] is None and user_answers['office'] in snapshot.walk_times:
+            results[i] = recommend(user_answers, snapshot, k=k)
+    return results
+
+
+def parse_batch(payload):
+    """
+    Запрос /recommendations/batch: {"groups": [тело запроса /recommendations, ...], "k": 3}.
+    Возвращает (ответы групп, k) или текст ошибки.
+    """
+    groups = payload.get('groups')
+    if not isinstance(groups, list) or len(groups) > BATCH_MAX_GROUPS:
+        return f'400, groups must be a list of at most {BATCH_MAX_GROUPS} requests'
+    k = payload.get('k', 3)
+    if not isinstance(k, int) or k < 1:
+        return '400, k must be a positive integer'
+    return [parse_user_answers(group) for group in groups], k
+
+
+@app.route('/recommendations/batch', methods=['POST'])
+def get_batch_recommendations():
+    """
+    Рекомендации для многих групп за один запрос: {"results": [...]} в порядке групп,
+    null – офис группы не найден.
+    """
+    parsed = parse_batch(request.json)
+    if isinstance(parsed, str):
+        return parsed, 400
+    groups, k = parsed
+    return jsonify({'results': batch_recommendations(groups, shared_catalog.current(), k)})
+
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5005)
\ No newline at end of file
+    app.run(debug=True, port=5005)
@@ -0,0 +1,196 @@
+"""
+Асинхронный режим сервиса рекомендаций (ASGI): те же /recommendations, /recommendations/batch, /get_data
+и /metrics, что в recommend.py, но соединения обслуживает цикл событий, а не отдельный воркер gunicorn
+на запрос.
+
+Запросы к сервису БД (кандидаты, выгрузки офисов для /get_data) выполняются асинхронно,
+а расчёт рекомендации и сборка каталога – в ограниченном пуле из SCORING_THREADS потоков.
+Если в пуле уже MAX_PENDING задач, запрос сразу получает 503 с Retry-After и не копится в очереди –
+бот повторит его позже.
+
+    uvicorn recommend_asgi:app --workers 2 --port 5005
+    gunicorn -k uvicorn.workers.UvicornWorker -w 2 -b 0.0.0.0:5005 recommend_asgi:app
+
+Профилирование по X-Profile (profiling.py) есть только в синхронном режиме.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from metrics import EXECUTOR_PENDING, REJECTED, REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, metrics_payload
+from catalog import current_generation
+from recommend import (CATALOG_OFFICES, CATALOG_SOURCE_URL, CATALOG_TIMEOUT, DB_URL, acquire_reload,
+                       batch_recommendations, candidate_filters, mixed_offices, parse_batch, parse_user_answers,
+                       precomputed_recommendation, recommend, refresh_catalog, request_key, shared_catalog)
+from singleflight import AsyncSingleFlight
+
+# Потоков расчёта в процессе и сколько задач (выполняемых и ожидающих) допускается до отказа с 503
+SCORING_THREADS = int(os.getenv('SCORING_THREADS', '4'))
+MAX_PENDING = int(os.getenv('MAX_PENDING', '64'))
+# Через сколько секунд клиенту стоит повторить отклонённый запрос
+RETRY_AFTER = os.getenv('RETRY_AFTER', '1')
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """
+    Пул потоков с ограничением числа задач: run() поднимает Overloaded, если их уже max_pending.
+    Счётчик меняется только из цикла событий, поэтому обходится без блокировок.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scoring')
+        self.max_pending = max_pending
+        self.pending = 0
+
+    def _release(self, future):
+        self.pending -= 1
+        EXECUTOR_PENDING.dec()
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            REJECTED.inc()
+            raise Overloaded()
+        self.pending += 1
+        EXECUTOR_PENDING.inc()
+        future = asyncio.wrap_future(self.pool.submit(func, *args))
+        # Задача занимает место в пуле до конца расчёта, даже если клиент уже отключился
+        future.add_done_callback(self._release)
+        return await asyncio.shield(future)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+executor = BoundedExecutor(SCORING_THREADS, MAX_PENDING)
+# Одинаковые одновременные запросы в процессе выполняются один раз: перезагрузки – по поколению каталога,
+# рекомендации – по ключу запроса
+reloads = AsyncSingleFlight('get_data')
+recommendations = AsyncSingleFlight('recommendations')
+
+
+async def fetch_candidates(client, user_answers):
+    """
+    CSV кандидатов из сервиса БД или None, если он недоступен.
+    """
+    try:
+        with STAGE_SECONDS.labels('candidates').time():
+            response = await client.get(f'{DB_URL}/candidates', params=candidate_filters(user_answers), timeout=5)
+            response.raise_for_status()
+    except httpx.HTTPError as e:
+        logging.error("Не удалось получить кандидатов из БД: %s", e)
+        return None
+    return response.text
+
+
+async def get_data(request):
+    """
+    Обновляет каталог из сервиса БД: выгрузки офисов запрашиваются параллельно и только после того,
+    как взята блокировка перезагрузки, – если каталог уже обновил другой воркер, ничего не скачивается.
+    """
+    client = request.app.state.http
+
+    async def reload(generation):
+        lock = await executor.run(acquire_reload, generation)
+        if lock is None:
+            return
+        with lock:
+            responses = await asyncio.gather(*(client.get(f'{CATALOG_SOURCE_URL}/get_office_{office_id}')
+                                               for office_id in CATALOG_OFFICES))
+            office_csvs = {office_id: response.text for office_id, response in zip(CATALOG_OFFICES, responses)}
+            await executor.run(refresh_catalog, office_csvs)
+
+    try:
+        # Файловый ввод-вывод – не в цикле событий
+        generation = await asyncio.to_thread(current_generation, shared_catalog.root)
+        with STAGE_SECONDS.labels('load').time():
+            await reloads.do(generation, lambda: reload(generation))
+        return PlainTextResponse('OK')
+    except Overloaded:
+        raise
+    except Exception as e:
+        logging.error("Не удалось обновить каталог: %s", e)
+        return PlainTextResponse('Не удалось обновить каталог', status_code=400)
+
+
+async def get_recommendation(request):
+    user_answers = parse_user_answers(await request.json())
+    # current() читает номер поколения с диска, а при смене поколения открывает новый снимок
+    snapshot = await asyncio.to_thread(shared_catalog.current)
+    if user_answers['office'] not in snapshot.walk_times:
+        return PlainTextResponse('400, office with this name not found')
+    # Без файлового ввода-вывода: профиль только кладётся в буфер, рейтинги пересчитываются в фоне (rankings.py)
+    result = precomputed_recommendation(user_answers, snapshot)
+    if result is not None:
+        return JSONResponse(result)
+
+    async def compute():
+        use_db = DB_URL and not mixed_offices(user_answers)
+        candidates = await fetch_candidates(request.app.state.http, user_answers) if use_db else None
+        return await executor.run(recommend, user_answers, snapshot, candidates)
+
+    return JSONResponse(await recommendations.do(request_key(user_answers, snapshot), compute))
+
+
+async def get_batch_recommendations(request):
+    parsed = parse_batch(await request.json())
+    if isinstance(parsed, str):
+        return PlainTextResponse(parsed, status_code=400)
+    groups, k = parsed
+    snapshot = await asyncio.to_thread(shared_catalog.current)
+    return JSONResponse({'results': await executor.run(batch_recommendations, groups, snapshot, k)})
+
+
+async def metrics(request):
+    return Response(metrics_payload(), media_type=CONTENT_TYPE_LATEST)
+
+
+async def overloaded(request, exc):
+    return PlainTextResponse('Сервис перегружен, повторите запрос позже', status_code=503,
+                             headers={'Retry-After': RETRY_AFTER})
+
+
+async def record_request(request, call_next):
+    started_at = time.perf_counter()
+    response = await call_next(request)
+    # Имена endpoint совпадают с синхронным режимом, чтобы метрики обоих режимов сравнивались напрямую
+    endpoint = getattr(request.scope.get('endpoint'), '__name__', 'unknown')
+    REQUESTS.labels(endpoint, response.status_code).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started_at)
+    return response
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Одно соединение с сервисом БД на процесс, запросы переиспользуют его пул
+    async with httpx.AsyncClient(timeout=CATALOG_TIMEOUT) as client:
+        app.state.http = client
+        yield
+    executor.shutdown()
+
+
+app = Starlette(
+    routes=[
+        Route('/recommendations', get_recommendation, methods=['POST']),
+        Route('/recommendations/batch', get_batch_recommendations, methods=['POST']),
+        Route('/get_data', get_data, methods=['POST']),
+        Route('/metrics', metrics),
+    ],
+    middleware=[Middleware(BaseHTTPMiddleware, dispatch=record_request)],
+    exception_handlers={Overloaded: overloaded},
+    lifespan=lifespan,
+)
@@ -0,0 +1,62 @@
+"""
+Объединение одинаковых одновременных вызовов: пока вычисление по ключу выполняется, остальные
+вызовы с тем же ключом ждут его и получают тот же результат (или то же исключение).
+Ожидающие считаются в recom_coalesced_total по имени.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from metrics import COALESCED
+
+
+class SingleFlight:
+    """
+    Для потоков воркера gunicorn (gthread, см. gunicorn.conf.py).
+    """
+
+    def __init__(self, name):
+        self.coalesced = COALESCED.labels(name)
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            self.coalesced.inc()
+            return call.result()
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class AsyncSingleFlight:
+    """
+    Для цикла событий (recommend_asgi.py). Вычисление идёт отдельной задачей: отключение клиента,
+    который его начал, не прерывает его для остальных.
+    """
+
+    def __init__(self, name):
+        self.coalesced = COALESCED.labels(name)
+        self.calls = {}
+
+    async def do(self, key, func):
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced.inc()
+        return await asyncio.shield(task)
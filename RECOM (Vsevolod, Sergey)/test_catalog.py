@@ -0,0 +1,53 @@
+"""
+Время в пути для группы из разных офисов: 'max' упорядочивает заведения по самому дальнему участнику,
+'mean' – по среднему, взвешенному по долям; заведения, до которых время известно не от всех офисов, идут в конце.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+from catalog import Snapshot, group_walk_times
+
+NAN = np.nan
+# Строки каталога: время от офиса 1 и офиса 2
+TIMES = {
+    'A': (5, 25),
+    'B': (15, 15),
+    'C': (NAN, 3),
+    'D': (NAN, NAN),
+    'E': (20, 10),
+}
+
+
+def snapshot():
+    columns = np.array(list(TIMES.values()), dtype=float)
+    walk_times = {office_id: (columns[:, i], np.flatnonzero(~np.isnan(columns[:, i])))
+                  for i, office_id in enumerate((1, 2))}
+    return Snapshot(1, None, {}, walk_times)
+
+
+def ranking(rows):
+    names = list(TIMES)
+    return [names[row] for row in rows]
+
+
+@pytest.mark.parametrize('objective, expected_order, expected_times', [
+    # Самый дальний участник: A – 25 минут, хотя для большинства группы ближе всех
+    ('max', ['B', 'E', 'A', 'C'], [15, 20, 25, NAN]),
+    # Три четверти группы из офиса 1: A – 5 * 0.75 + 25 * 0.25 = 10
+    ('mean', ['A', 'B', 'E', 'C'], [10, 15, 17.5, NAN]),
+])
+def test_walk_objective_orders_places(objective, expected_order, expected_times):
+    # Офиса 9 нет в каталоге – его участники не учитываются
+    rows, walk_time = group_walk_times(snapshot(), [(1, 3), (2, 1), (9, 5)], objective)
+    assert ranking(rows) == expected_order
+    np.testing.assert_allclose(walk_time, expected_times)
+
+
+def test_single_office_keeps_its_times():
+    for objective in ('max', 'mean'):
+        rows, walk_time = group_walk_times(snapshot(), [(2, 1)], objective)
+        assert ranking(rows) == ['C', 'E', 'B', 'A']
+        np.testing.assert_allclose(walk_time, [3, 10, 15, 25])
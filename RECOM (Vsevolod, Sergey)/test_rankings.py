@@ -0,0 +1,36 @@
+"""
+Готовые рейтинги: для частого профиля ответ из rankings.json совпадает с обычным расчётом.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import time
+
+from catalog import load_catalog, publish_catalog
+from conftest import random_payloads
+
+
+def wait_for_rankings(rankings, generation, timeout=30):
+    deadline = time.monotonic() + timeout
+    while rankings.generation != generation or rankings.loading or not rankings.exact:
+        assert time.monotonic() < deadline, 'рейтинги поколения не подготовлены'
+        time.sleep(0.05)
+
+
+def test_precomputed_rankings_match_live_scoring(recommend):
+    client = recommend.app.test_client()
+    payloads = random_payloads(50, seed=3)
+    # Профили попадают в журнал, рейтинги по ним строятся для следующего поколения каталога
+    live = [client.post('/recommendations', json=payload).json for payload in payloads]
+    generation = publish_catalog(*load_catalog())
+    client.post('/recommendations', json=payloads[0])
+    wait_for_rankings(recommend.rankings, generation)
+
+    snapshot = recommend.shared_catalog.current()
+    assert snapshot.generation == generation
+    for payload, expected in zip(payloads, live):
+        user_answers = recommend.parse_user_answers(payload)
+        precomputed = recommend.rankings.lookup(snapshot, recommend.profile_key(user_answers), user_answers)
+        assert precomputed is not None
+        assert precomputed == recommend.recommend(user_answers, snapshot) == expected
+        assert client.post('/recommendations', json=payload).json == expected
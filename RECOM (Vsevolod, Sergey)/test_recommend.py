@@ -0,0 +1,74 @@
+"""
+Рекомендации: /recommendations/batch отвечает так же, как /recommendations по каждой группе;
+для группы из разных офисов время в пути сводится по цели walk_objective ('max' или 'mean').
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import random_payloads
+
+
+@pytest.mark.parametrize('mixed', [False, True], ids=['one_office', 'mixed_offices'])
+def test_batch_matches_single_endpoint(recommend, mixed):
+    client = recommend.app.test_client()
+    payloads = random_payloads(100, seed=1, mixed=mixed)
+    # Офис, которого нет в каталоге: в батче null, одиночный запрос отвечает ошибкой
+    payloads.append({'v': 2, 'office': 9})
+
+    response = client.post('/recommendations/batch', json={'groups': payloads})
+    assert response.status_code == 200
+    results = response.json['results']
+
+    assert results[-1] is None
+    assert results[:-1] == [client.post('/recommendations', json=payload).json for payload in payloads[:-1]]
+
+
+def test_batch_matches_single_scoring_for_any_k(recommend):
+    snapshot = recommend.shared_catalog.current()
+    groups = [recommend.parse_user_answers(payload) for payload in random_payloads(100, seed=2)]
+
+    assert recommend.batch_recommendations(groups, snapshot, k=10) == [
+        recommend.recommend(user_answers, snapshot, k=10) for user_answers in groups]
+
+
+def expected_group_ranking(recommend, user_answers, k=3):
+    """
+    Топ-k группы из разных офисов, посчитанный прямо по data/catalog.csv и data/walk_times.npz:
+    время до заведения – max или взвешенное среднее по офисам участников.
+    """
+    catalog = pd.read_csv('data/catalog.csv')
+    shares = dict(user_answers['offices'])
+    with np.load('data/walk_times.npz') as arrays:
+        times = pd.DataFrame({office_id: arrays[f'time_{office_id}'] for office_id in shares})
+    if user_answers['walk_objective'] == 'max':
+        combined = times.max(axis=1, skipna=False)
+    else:
+        combined = sum(times[office_id] * share for office_id, share in shares.items()) / sum(shares.values())
+    catalog['office_time'] = combined
+    places = catalog[times.notna().any(axis=1)].sort_values('office_time', kind='stable')
+    if user_answers['walk_time']:
+        near = places['office_time'] <= max(limit for limit, _ in user_answers['walk_time']) * recommend.CANDIDATE_SLACK
+        if near.sum() >= k:
+            places = places[near]
+    places = places.assign(score=places.apply(lambda row: recommend.survey_score(row, user_answers), axis=1))
+    top = places.sort_values(['score', 'reviews_general_rating', 'reviews_general_review_count'],
+                             ascending=False, kind='stable').head(k)
+    return [top['name'].tolist(), top['id'].tolist()]
+
+
+def test_walk_objective_chooses_expected_ranking(recommend):
+    snapshot = recommend.shared_catalog.current()
+    differs = 0
+    for payload in random_payloads(50, seed=4, mixed=True):
+        rankings = {}
+        for objective in recommend.WALK_OBJECTIVES:
+            user_answers = recommend.parse_user_answers(dict(payload, walk_objective=objective))
+            rankings[objective] = recommend.recommend(user_answers, snapshot)
+            assert rankings[objective] == expected_group_ranking(recommend, user_answers)
+        differs += rankings['max'] != rankings['mean']
+    # Цель действительно влияет на выбор хотя бы для части групп
+    assert differs
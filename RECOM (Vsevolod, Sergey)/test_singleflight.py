@@ -0,0 +1,138 @@
+"""
+SingleFlight и AsyncSingleFlight: одновременные вызовы с одним ключом выполняют вычисление один раз
+и получают его результат или исключение; вызовы с разными ключами не ждут друг друга.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+CALLERS = 8
+
+
+def coalesced(name):
+    return REGISTRY.get_sample_value('recom_coalesced_total', {'endpoint': name})
+
+
+def run_threads(flight, key, func):
+    """
+    CALLERS потоков одновременно вызывают flight.do(key, func); результаты или исключения в порядке потоков.
+    """
+    results = [None] * CALLERS
+    barrier = threading.Barrier(CALLERS)
+
+    def call(i):
+        barrier.wait()
+        try:
+            results[i] = flight.do(key, func)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(CALLERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_are_coalesced():
+    flight = SingleFlight('test_coalesced')
+    calls = []
+
+    def compute():
+        calls.append(1)
+        # Остальные потоки успевают прийти, пока вычисление идёт
+        time.sleep(0.2)
+        return object()
+
+    results = run_threads(flight, 'key', compute)
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert coalesced('test_coalesced') == CALLERS - 1
+    assert flight.calls == {}
+
+
+def test_concurrent_calls_share_the_exception():
+    flight = SingleFlight('test_exception')
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError('boom')
+
+    results = run_threads(flight, 'key', compute)
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    # После ошибки ключ свободен: следующий вызов считает заново
+    assert flight.do('key', lambda: 42) == 42
+
+
+def test_different_keys_are_not_coalesced():
+    flight = SingleFlight('test_keys')
+    started = threading.Barrier(2, timeout=5)
+
+    def compute(key):
+        # Оба вычисления идут одновременно, иначе барьер не пройти
+        started.wait()
+        return key
+
+    results = {}
+    threads = [threading.Thread(target=lambda key=key: results.update({key: flight.do(key, lambda: compute(key))}))
+               for key in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {'a': 'a', 'b': 'b'}
+
+
+def test_async_concurrent_calls_are_coalesced():
+    flight = AsyncSingleFlight('test_async_coalesced')
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return object()
+
+    async def main():
+        return await asyncio.gather(*(flight.do('key', compute) for _ in range(CALLERS)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert coalesced('test_async_coalesced') == CALLERS - 1
+    assert flight.calls == {}
+
+
+def test_async_cancelled_caller_does_not_cancel_computation():
+    flight = AsyncSingleFlight('test_async_cancel')
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'done'
+
+    async def main():
+        first = asyncio.ensure_future(flight.do('key', compute))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(flight.do('key', compute))
+        await asyncio.sleep(0.01)
+        # Клиент, начавший вычисление, отключился
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == 'done'
+    assert len(calls) == 1
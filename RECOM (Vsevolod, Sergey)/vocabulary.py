@@ -0,0 +1,51 @@
+# Общий словарь вариантов ответов для протокола бот <-> сервис рекомендаций.
+# Файл лежит и в TG-BOT, и в RECOM (сервисы собираются из разных Docker-контекстов) –
+# копии должны совпадать, это проверяет TG-BOT/test_bot.py. Идентификаторы стабильны:
+# новые варианты добавляются с новым id, старые id не переиспользуются.
+
+# Версия компактного формата запроса /recommendations
+PROTOCOL_VERSION = 2
+
+# id офиса -> адрес
+OFFICES = {
+    1: "пер. Виленский, 14А",
+    2: "Дегтярный пер., 11Б",
+    3: "Киевская ул., 5 корп. 4",
+}
+
+# id -> (подпись кнопки в боте, колонка датасета или None, если колонки нет)
+CUISINES = {
+    0: ("🍲 Русская", "Русская кухня"),
+    1: ("🍽️ Европейская", "Европейская кухня"),
+    2: ("🍜 Азиатская", "Паназиатская кухня"),
+    3: ("🍔 Фастфуд", None),
+    4: ("🏢 Бизнес-ланч", None),
+}
+
+RESTRICTIONS = {
+    0: ("🥗 Вегетарианские блюда", "Вегетарианское меню"),
+    1: ("🌱 Постное меню", "Постное меню"),
+    2: ("Нет ограничений", None),
+}
+
+# id -> (подпись кнопки в боте, верхняя граница среднего чека в рублях)
+BUDGETS = {
+    0: ("💵 До 500 руб.", 500),
+    1: ("💵 До 1000 руб.", 1000),
+    2: ("💵 До 1500 руб.", 1500),
+    3: ("💵 Без разницы", 999999),
+}
+
+# id -> (подпись кнопки в боте, время в пути в минутах)
+WALK_TIMES = {
+    0: ("🚶 До 5 минут", 5),
+    1: ("🚶 До 10 минут", 10),
+    2: ("🚶 До 15 минут", 15),
+}
+
+# Обратные словари: подпись -> id
+OFFICE_IDS = {name: office_id for office_id, name in OFFICES.items()}
+CUISINE_IDS = {label: option_id for option_id, (label, _) in CUISINES.items()}
+RESTRICTION_IDS = {label: option_id for option_id, (label, _) in RESTRICTIONS.items()}
+BUDGET_IDS = {label: option_id for option_id, (label, _) in BUDGETS.items()}
+WALK_TIME_IDS = {label: option_id for option_id, (label, _) in WALK_TIMES.items()}
@@ -1,10 +1,14 @@
 import os
+import asyncio
 import logging
 import json
+import time
 import re
 import requests
+from prometheus_client import start_http_server
 from collections import defaultdict
-from typing import Set, Dict, Any
+from functools import partial
+from typing import Set, Dict, Any, Tuple
 from dotenv import load_dotenv
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from telegram.ext import (
@@ -15,6 +19,14 @@ from telegram.ext import (
     MessageHandler,
     filters
 )
+from dispatcher import OutboundDispatcher, DELIVERED, UNKNOWN
+from metrics import CACHE_LOOKUPS, RECOMMENDER_SECONDS, set_state_gauges, timed
+from state_store import create_state_store
+from sweeper import touch_state, sweep_store
+from vocabulary import (
+    PROTOCOL_VERSION, OFFICES, CUISINES, RESTRICTIONS, BUDGETS, WALK_TIMES,
+    OFFICE_IDS, CUISINE_IDS, RESTRICTION_IDS, BUDGET_IDS, WALK_TIME_IDS
+)
 
 # Включаем логирование
 logging.basicConfig(
@@ -27,19 +39,53 @@ TOKEN = os.getenv("TOKEN")
 # Имя бота (без @)
 BOT_USERNAME = os.getenv("BOTNAME")
 
+# Формат запроса в модуль рекомендаций: 2 – компактный (id вариантов), 1 – старый (подписи без эмодзи).
+# Старый формат нужен, пока сервис рекомендаций не обновлён.
+RECOMMENDER_PROTOCOL = int(os.getenv("RECOMMENDER_PROTOCOL", PROTOCOL_VERSION))
+# Адрес сервиса рекомендаций
+RECOMMENDER_URL = os.getenv("RECOMMENDER_URL", "http://127.0.0.1:5005")
+# Сколько секунд ждать ответа сервиса рекомендаций
+RECOMMENDER_TIMEOUT = float(os.getenv("RECOMMENDER_TIMEOUT", 10))
+# Как сводить время в пути для участников из разных офисов: "max" – по самому дальнему, "mean" – среднее.
+# Не задано – решает сервис рекомендаций
+WALK_OBJECTIVE = os.getenv("WALK_OBJECTIVE")
+
+# Сроки жизни состояния групп (в часах) и период фоновой очистки (в минутах)
+POLL_TTL_HOURS = float(os.getenv("POLL_TTL_HOURS", 24))
+CLOSED_INVITATION_TTL_HOURS = float(os.getenv("CLOSED_INVITATION_TTL_HOURS", 3))
+GROUP_MEMBERS_TTL_HOURS = float(os.getenv("GROUP_MEMBERS_TTL_HOURS", 24 * 30))
+SWEEP_INTERVAL_MINUTES = float(os.getenv("SWEEP_INTERVAL_MINUTES", 10))
+# Файл для архивации вытесненных опросов и приглашений (JSON Lines); если не задан – просто удаляем
+STATE_ARCHIVE_PATH = os.getenv("STATE_ARCHIVE_PATH")
+# Порт для метрик Prometheus (/metrics); если не задан – метрики не отдаются
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+# Хранилище состояния: "memory" – в памяти процесса, "redis" – общее для нескольких процессов бота
+state_store = create_state_store(os.getenv("STATE_BACKEND", "memory"), os.getenv("REDIS_URL"))
+
+# Диспетчер исходящих сообщений: общий лимит на бота и лимит на один чат (сообщений в секунду)
+dispatcher = OutboundDispatcher(
+    global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", 25)),
+    per_chat_rate=float(os.getenv("OUTBOUND_PER_CHAT_RATE", 1)),
+    # Сколько рассылок приглашений идёт одновременно и сколько ждёт в очереди
+    max_jobs=int(os.getenv("OUTBOUND_MAX_JOBS", 8)),
+    max_queued_jobs=int(os.getenv("OUTBOUND_MAX_QUEUED_JOBS", 100))
+)
+
+EMOJI_PATTERN = re.compile(
+    "["
+    u"\U0001F600-\U0001F64F"  # эмодзи лица
+    u"\U0001F300-\U0001F5FF"  # символы и пиктограммы
+    u"\U0001F680-\U0001F6FF"  # транспорт и карты
+    u"\U0001F1E0-\U0001F1FF"  # флаги
+    u"\U0001F900-\U0001F9FF"  # дополнительные эмодзи
+    "]+",
+    flags=re.UNICODE
+)
+
 # Функция для удаления эмодзи из строки
 def remove_emojis(text: str) -> str:
-    emoji_pattern = re.compile(
-        "["
-        u"\U0001F600-\U0001F64F"  # эмодзи лица
-        u"\U0001F300-\U0001F5FF"  # символы и пиктограммы
-        u"\U0001F680-\U0001F6FF"  # транспорт и карты
-        u"\U0001F1E0-\U0001F1FF"  # флаги
-        u"\U0001F900-\U0001F9FF"  # дополнительные эмодзи
-        "]+", 
-        flags=re.UNICODE
-    )
-    return emoji_pattern.sub("", text).strip()
+    return EMOJI_PATTERN.sub("", text).strip()
 
 # Функция для рекурсивной очистки ключей словаря
 def clean_dict_keys(d: dict) -> dict:
@@ -71,41 +117,37 @@ def init_group_data() -> Dict[str, Any]:
 
 
 # Карты для преобразования бюджетов и времени ходьбы в числовые значения
-BUDGET_MAP = {
-    "💵 До 500 руб.": 500,
-    "💵 До 1000 руб.": 1000,
-    "💵 До 1500 руб.": 1500,
-    "💵 Без разницы": 999999
-}
-WALK_TIME_MAP = {
-    "🚶 До 5 минут": 5,
-    "🚶 До 10 минут": 10,
-    "🚶 До 15 минут": 15
-}
+BUDGET_MAP = {label: limit for label, limit in BUDGETS.values()}
+WALK_TIME_MAP = {label: minutes for label, minutes in WALK_TIMES.values()}
 
-# Варианты ответов для опроса
-office_options = ["пер. Виленский, 14А", "Дегтярный пер., 11Б", "Киевская ул., 5 корп. 4"]
-cuisine_options = ["🍲 Русская", "🍽️ Европейская", "🍜 Азиатская", "🍔 Фастфуд", "🏢 Бизнес-ланч"]
-restriction_options = [
-    "🥗 Вегетарианские блюда",
-    "🌱 Постное меню",
-    "Нет ограничений"
-]
-budget_options = ["💵 До 500 руб.", "💵 До 1000 руб.", "💵 До 1500 руб.", "💵 Без разницы"]
-walk_time_options = ["🚶 До 5 минут", "🚶 До 10 минут", "🚶 До 15 минут"]
+# Варианты ответов для опроса (из общего словаря vocabulary.py)
+office_options = list(OFFICES.values())
+cuisine_options = [label for label, _ in CUISINES.values()]
+restriction_options = [label for label, _ in RESTRICTIONS.values()]
+budget_options = list(BUDGET_MAP)
+walk_time_options = list(WALK_TIME_MAP)
 
 # Конфигурация этапов опроса для пользователей (в ЛС)
-# Здесь «office» больше не используется для приглашённых – их опрос начинается с кухни
+# Приглашённые начинают с офиса (по умолчанию отмечен офис инициатора), инициатор – с кухни:
+# свой офис он уже выбрал в группе
 state_settings = {
+    "office": {
+        "text": "1️⃣ Выберите ваш офис:",
+        "options": office_options,
+        "prefix": "office",
+        "next_state": "cuisine",
+        "type": "single"
+    },
     "cuisine": {
-        "text": "1️⃣ Выберите желаемую кухню (можно несколько):",
+        "text": "2️⃣ Выберите желаемую кухню (можно несколько):",
         "options": cuisine_options,
         "prefix": "cuisine",
         "next_state": "restrictions",
+        "prev_state": "office",
         "type": "multi"
     },
     "restrictions": {
-        "text": "2️⃣ Выберите ограничения по питанию (если есть):",
+        "text": "3️⃣ Выберите ограничения по питанию (если есть):",
         "options": restriction_options,
         "prefix": "restrictions",
         "next_state": "budget",
@@ -113,7 +155,7 @@ state_settings = {
         "type": "multi"
     },
     "budget": {
-        "text": "3️⃣ Выберите желаемый средний чек:",
+        "text": "4️⃣ Выберите желаемый средний чек:",
         "options": budget_options,
         "prefix": "budget",
         "next_state": "walk_time",
@@ -121,7 +163,7 @@ state_settings = {
         "type": "single"
     },
     "walk_time": {
-        "text": "4️⃣ Выберите время в пути:",
+        "text": "5️⃣ Выберите время в пути:",
         "options": walk_time_options,
         "prefix": "walkTime",
         "next_state": "finish",
@@ -139,29 +181,93 @@ group_office_state = {
     "type": "single"
 }
 
-def create_inline_keyboard(options, prefix, selected_values: Set[str], next_step=None, prev_step=None) -> InlineKeyboardMarkup:
+def create_keyboard_template(settings: dict, navigation: bool = True) -> dict:
     """
-    Строит инлайн-клавиатуру с кнопками вариантов и навигационными кнопками.
+    Строит шаблон клавиатуры этапа: кнопки вариантов без отметки и с отметкой ✅,
+    а также навигационные кнопки. Кнопки неизменяемы, поэтому их можно переиспользовать.
     """
-    keyboard = []
-    for i, option in enumerate(options):
-        display_text = f"✅ {option}" if option in selected_values else option
-        keyboard.append([InlineKeyboardButton(display_text, callback_data=f"{prefix}_{i}")])
-    
+    prefix = settings["prefix"]
     nav_buttons = []
-    if prev_step:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"prev_{prev_step}"))
-    if next_step:
-        nav_buttons.append(InlineKeyboardButton("➡️ Далее", callback_data=f"next_{next_step}"))
-    if nav_buttons:
-        keyboard.append(nav_buttons)
+    if navigation and settings.get("prev_state"):
+        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"prev_{settings['prev_state']}"))
+    if navigation and settings.get("next_state"):
+        nav_buttons.append(InlineKeyboardButton("➡️ Далее", callback_data=f"next_{settings['next_state']}"))
+    return {
+        "plain": [InlineKeyboardButton(option, callback_data=f"{prefix}_{i}")
+                  for i, option in enumerate(settings["options"])],
+        "checked": [InlineKeyboardButton(f"✅ {option}", callback_data=f"{prefix}_{i}")
+                    for i, option in enumerate(settings["options"])],
+        "nav": nav_buttons,
+        "index": {option: i for i, option in enumerate(settings["options"])}
+    }
+
+def create_inline_keyboard(template: dict, mask: int) -> InlineKeyboardMarkup:
+    """
+    Собирает инлайн-клавиатуру из шаблона: i-й вариант отмечен, если в маске выставлен i-й бит.
+    """
+    keyboard = [
+        [template["checked"][i] if mask >> i & 1 else button]
+        for i, button in enumerate(template["plain"])
+    ]
+    if template["nav"]:
+        keyboard.append(template["nav"])
     return InlineKeyboardMarkup(keyboard)
 
+# Шаблоны клавиатур для этапов опроса в ЛС и для выбора офиса в группе (без навигации)
+keyboard_templates = {state: create_keyboard_template(stg) for state, stg in state_settings.items()}
+keyboard_templates["group_office"] = create_keyboard_template(group_office_state, navigation=False)
+# Кэш готовых клавиатур: (этап, битовая маска выбранных вариантов) -> InlineKeyboardMarkup
+keyboard_cache: Dict[Tuple[str, int], InlineKeyboardMarkup] = {}
+
+def warm_keyboard_cache():
+    """
+    Заранее строит клавиатуры для всех этапов и всех комбинаций выбранных вариантов,
+    чтобы нажатие кнопки сводилось к поиску в словаре.
+    """
+    for state, template in keyboard_templates.items():
+        for mask in range(1 << len(template["plain"])):
+            keyboard_cache[(state, mask)] = create_inline_keyboard(template, mask)
+
+def selection_mask(state: str, selected_values: Set[str]) -> int:
+    """
+    Переводит множество выбранных вариантов этапа в битовую маску.
+    """
+    index = keyboard_templates[state]["index"]
+    mask = 0
+    for option in selected_values:
+        if option in index:
+            mask |= 1 << index[option]
+    return mask
+
+def get_state_keyboard(state: str, selected_values: Set[str]) -> InlineKeyboardMarkup:
+    """
+    Возвращает клавиатуру этапа с отмеченными выбранными вариантами (из кэша).
+    """
+    key = (state, selection_mask(state, selected_values))
+    reply_markup = keyboard_cache.get(key)
+    if reply_markup is None:
+        CACHE_LOOKUPS.labels("keyboard", "miss").inc()
+        reply_markup = keyboard_cache[key] = create_inline_keyboard(keyboard_templates[state], key[1])
+    else:
+        CACHE_LOOKUPS.labels("keyboard", "hit").inc()
+    return reply_markup
+
+# Клавиатуры, которые не зависят от ответов пользователя
+finish_keyboard = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Написать желаемые блюда/кухни", callback_data="free_form_positive")]
+])
+free_form_negative_keyboard = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Написать нежелаемые блюда/кухни", callback_data="free_form_negative")]
+])
+
 def get_selected_values(state: str, user_id: int, group_data: dict) -> Set[str]:
     """
     Возвращает множество выбранных значений для конкретного этапа и пользователя.
     """
-    if state == "budget":
+    if state == "office":
+        value = group_data["office"].get(user_id)
+        return {value} if value else set()
+    elif state == "budget":
         value = group_data["price_limit"].get(user_id)
         return {value} if value else set()
     elif state == "walk_time":
@@ -191,6 +297,38 @@ def reset_user_answers(user_id: int, group_data: dict, skip_office=False):
 
     group_data["all_users"].add(user_id)
 
+##########################
+#  ДОСТУП К СОСТОЯНИЮ
+##########################
+
+def group_state(chat_id):
+    """
+    Атомарно изменяемое состояние группы: участники, приглашение, ответы опроса.
+    Использование: async with group_state(chat_id) as state: ...
+    """
+    return state_store.transaction(("group", chat_id))
+
+def user_session(user_id):
+    """
+    Атомарно изменяемая сессия пользователя в ЛС (группа опроса, режим свободного ввода).
+    """
+    return state_store.transaction(("user", user_id))
+
+async def get_user_session(user_id) -> dict:
+    """
+    Возвращает копию сессии пользователя (только для чтения).
+    """
+    async with user_session(user_id) as session:
+        return dict(session)
+
+def get_group_answers(state: dict, create: bool = False):
+    """
+    Возвращает данные опроса группы; при create=True создаёт их, если их ещё нет.
+    """
+    if create and not state.get("answers"):
+        state["answers"] = init_group_data()
+    return state.get("answers")
+
 # Обычный poll_callback для обработки выборов в ЛС
 async def poll_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -200,66 +338,69 @@ async def poll_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
 
-    group_id = context.user_data.get("group_id")
+    group_id = (await get_user_session(user_id)).get("group_id")
     if not group_id:
-        logging.error("Poll callback: group_id не найден в user_data")
+        logging.error("Poll callback: group_id не найден в сессии пользователя")
         await query.answer("Ошибка: группа не определена.")
         return
 
-    group_data = context.bot_data.get("group_answers", {}).get(group_id)
+    # Ответ в Telegram отправляется уже после транзакции: блокировка группы не держится на время
+    # сетевого запроса, а ошибка отправки не отменяет записанный голос
+    async with group_state(group_id) as state:
+        reply = apply_poll_callback(query, user_id, group_id, state)
+    if reply is not None:
+        await reply()
+
+def apply_poll_callback(query, user_id: int, group_id: int, state: dict):
+    """
+    Применяет нажатие кнопки опроса к состоянию группы. Возвращает ответ бота – функцию без аргументов,
+    возвращающую корутину, – или None, если отвечать не нужно.
+    """
+    group_data = get_group_answers(state)
     if not group_data:
         logging.error("Poll callback: данные опроса для группы %s не найдены", group_id)
-        await query.answer("Ошибка: данные опроса не найдены.")
-        return
+        return partial(query.answer, "Ошибка: данные опроса не найдены.")
 
     group_data["all_users"].add(user_id)
+    touch_state(state)
 
     data = query.data
-    if data.startswith("next_"):
-        next_state = data.split("_", 1)[1]
-        await handle_next(query, next_state, user_id, group_data, context)
-    elif data.startswith("prev_"):
-        prev_state = data.split("_", 1)[1]
-        await handle_prev(query, prev_state, user_id, group_data, context)
-    else:
-        try:
-            prefix, index_str = data.split("_", 1)
-            option_index = int(index_str)
-        except (ValueError, IndexError):
-            await query.answer("Некорректные данные!")
-            return
+    if data.startswith("next_") or data.startswith("prev_"):
+        return show_state(query, data.split("_", 1)[1], user_id, group_data)
+    try:
+        prefix, index_str = data.split("_", 1)
+        option_index = int(index_str)
+    except (ValueError, IndexError):
+        return partial(query.answer, "Некорректные данные!")
 
-        # Определяем этап по префиксу
-        state = None
-        for key, stg in state_settings.items():
-            if stg["prefix"] == prefix:
-                state = key
-                break
-        if not state:
-            await query.answer("Неизвестный этап!")
-            return
+    # Определяем этап по префиксу
+    poll_state = None
+    for key, stg in state_settings.items():
+        if stg["prefix"] == prefix:
+            poll_state = key
+            break
+    if not poll_state:
+        return partial(query.answer, "Неизвестный этап!")
 
-        await handle_selection(query, state, option_index, user_id, group_data)
+    return handle_selection(query, poll_state, option_index, user_id, group_data)
 
-async def handle_selection(update_query, state: str, option_index: int, user_id: int, group_data: dict):
+def handle_selection(update_query, state: str, option_index: int, user_id: int, group_data: dict):
     """
-    Обрабатывает выбор варианта для этапа опроса (для ЛС).
+    Обрабатывает выбор варианта для этапа опроса (для ЛС) и возвращает ответ бота или None.
     """
     settings = state_settings[state]
+    if not 0 <= option_index < len(settings["options"]):
+        return partial(update_query.answer, "Некорректные данные!")
     option = settings["options"][option_index]
+    mask_before = selection_mask(state, get_selected_values(state, user_id, group_data))
 
     if settings["type"] == "single":
-        if state == "budget":
+        if state == "office":
+            group_data["office"][user_id] = option
+        elif state == "budget":
             group_data["price_limit"][user_id] = option
         elif state == "walk_time":
             group_data["walk_time"][user_id] = option
-
-        selected = get_selected_values(state, user_id, group_data)
-        await update_query.edit_message_reply_markup(
-            create_inline_keyboard(settings["options"], settings["prefix"], selected,
-                                     next_step=settings.get("next_state"),
-                                     prev_step=settings.get("prev_state"))
-        )
     else:
         if state == "restrictions":
             if option == "Нет ограничений":
@@ -298,43 +439,28 @@ async def handle_selection(update_query, state: str, option_index: int, user_id:
             else:
                 group_data["wanted_cuisines"][option].add(user_id)
 
-        selected = get_selected_values(state, user_id, group_data)
-        await update_query.edit_message_reply_markup(
-            create_inline_keyboard(settings["options"], settings["prefix"], selected,
-                                     next_step=settings.get("next_state"),
-                                     prev_step=settings.get("prev_state"))
-        )
-
-async def handle_next(update_query, next_state: str, user_id: int, group_data: dict, context: ContextTypes.DEFAULT_TYPE):
-    await show_state(update_query, next_state, user_id, group_data, context)
-
-async def handle_prev(update_query, prev_state: str, user_id: int, group_data: dict, context: ContextTypes.DEFAULT_TYPE):
-    await show_state(update_query, prev_state, user_id, group_data, context)
+    selected = get_selected_values(state, user_id, group_data)
+    # Если набор выбранных вариантов не изменился, клавиатуру не перерисовываем
+    if selection_mask(state, selected) == mask_before:
+        return None
+    return partial(update_query.edit_message_reply_markup, get_state_keyboard(state, selected))
 
-async def show_state(query, state: str, user_id: int, group_data: dict, context: ContextTypes.DEFAULT_TYPE):
+def show_state(query, state: str, user_id: int, group_data: dict):
     """
-    Отображает сообщение и клавиатуру для выбранного этапа опроса (в ЛС).
+    Ответ бота с сообщением и клавиатурой выбранного этапа опроса (в ЛС).
     При состоянии "finish" выводится кнопка для свободного ввода пожеланий.
     """
     if state == "finish":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Написать желаемые блюда/кухни", callback_data="free_form_positive")]
-        ])
-        await query.edit_message_text(
+        return partial(
+            query.edit_message_text,
             "Опрос завершён!\n\nСпасибо за участие.\n\nМожете написать блюда/кухни, которые особенно любите:",
-            reply_markup=keyboard
+            reply_markup=finish_keyboard
         )
-        return
+    if state not in state_settings:
+        return partial(query.answer, "Неизвестный этап!")
 
-    settings = state_settings[state]
-    text = settings["text"]
-    options = settings["options"]
-    prefix = settings["prefix"]
-    next_state = settings.get("next_state")
-    prev_state = settings.get("prev_state")
     selected = get_selected_values(state, user_id, group_data)
-    reply_markup = create_inline_keyboard(options, prefix, selected, next_step=next_state, prev_step=prev_state)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    return partial(query.edit_message_text, state_settings[state]["text"], reply_markup=get_state_keyboard(state, selected))
 
 def calculate_set_distribution(votes_dict, total_users):
     """
@@ -356,16 +482,73 @@ def calculate_single_distribution(single_dict, total_users):
         result[option] = round(count / total_users, 2)
     return result
 
-def send_to_recommendation_module(user_answers: dict) -> str:
+def encode_shares(shares: dict, ids: dict) -> list:
     """
-    Функция логирует полученные данные и отправляет запрос в систему рекомендаций.
+    Доли вариантов парами [id, доля]. Подписи, которых нет в vocabulary.py, пропускаются.
     """
-    logging.info("Отправка данных в модуль рекомендаций: %s", user_answers)
-    # ЗДЕСЬ МОЖНО СДЕЛАТЬ ВЫЗОВ РЕАЛЬНОЙ ФУНКЦИИ ИЗ МОДУЛЯ РЕКОМЕНДАЦИЙ, НАПРИМЕР:
-    # return recommendation_module.get_recommendations(user_answers)
-    return requests.post(url='http://127.0.0.1:5005/recommendations', json=user_answers).json()
+    encoded = []
+    for option, share in shares.items():
+        if option in ids:
+            encoded.append([ids[option], share])
+        else:
+            logging.warning("Вариант «%s» отсутствует в vocabulary.py и не передаётся в рекомендации", option)
+    return encoded
 
-# Теперь формируем итоговый словарь без распределения по офисам – офис берётся из ответа инициатора
+def encode_user_answers(user_answers: dict) -> dict:
+    """
+    Переводит ответы в компактный формат протокола v2: вместо подписей – стабильные id
+    вариантов из vocabulary.py, доли передаются парами [id, доля].
+    """
+    office = user_answers.get("office")
+    if office not in OFFICE_IDS:
+        logging.warning("Офис «%s» отсутствует в vocabulary.py", office)
+    return {
+        "v": PROTOCOL_VERSION,
+        "office": OFFICE_IDS.get(office),
+        "cuisines": encode_shares(user_answers.get("wanted_cuisines", {}), CUISINE_IDS),
+        "restrictions": encode_shares(user_answers.get("food_restrictions", {}), RESTRICTION_IDS),
+        "budget": encode_shares(user_answers.get("price_limit", {}), BUDGET_IDS),
+        "walk": encode_shares(user_answers.get("walk_time", {}), WALK_TIME_IDS),
+        "offices": encode_shares(user_answers.get("offices", {}), OFFICE_IDS),
+        "positive": user_answers.get("positive", ""),
+        "negative": user_answers.get("negative", ""),
+    }
+
+def encode_user_answers_legacy(user_answers: dict) -> dict:
+    """
+    Старый формат запроса: подписи без эмодзи в качестве ключей, бюджет и время – числами.
+    """
+    legacy_answers = dict(user_answers)
+    legacy_answers["price_limit"] = {BUDGET_MAP.get(o, o): v for o, v in user_answers.get("price_limit", {}).items()}
+    legacy_answers["walk_time"] = {WALK_TIME_MAP.get(o, o): v for o, v in user_answers.get("walk_time", {}).items()}
+    return clean_dict_keys(legacy_answers)
+
+async def send_to_recommendation_module(user_answers: dict):
+    """
+    Функция логирует полученные данные и отправляет запрос в систему рекомендаций.
+    Запрос выполняется в отдельном потоке, чтобы не блокировать event loop.
+    Возвращает рекомендации или None, если сервис недоступен или ответил ошибкой.
+    """
+    if RECOMMENDER_PROTOCOL >= 2:
+        payload = encode_user_answers(user_answers)
+    else:
+        payload = encode_user_answers_legacy(user_answers)
+    if WALK_OBJECTIVE:
+        payload["walk_objective"] = WALK_OBJECTIVE
+    logging.info("Отправка данных в модуль рекомендаций: %s", payload)
+    try:
+        with RECOMMENDER_SECONDS.time():
+            response = await asyncio.to_thread(requests.post, url=f"{RECOMMENDER_URL}/recommendations",
+                                               json=payload, timeout=RECOMMENDER_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError) as e:
+        logging.error("Модуль рекомендаций не ответил: %s", e)
+        return None
+
+# Формируем итоговый словарь с подписями вариантов – офис берётся из ответа инициатора,
+# офисы участников – доли по их ответам (не ответившие считаются из офиса инициатора).
+# Для отправки в модуль рекомендаций он кодируется в encode_user_answers
 def get_user_answers(group_data: dict, invitation: dict = None) -> dict:
     total_users = len(group_data["all_users"])
     if total_users == 0:
@@ -376,28 +559,29 @@ def get_user_answers(group_data: dict, invitation: dict = None) -> dict:
     walk_time_dist = calculate_single_distribution(group_data["walk_time"], total_users)
     budget_dist = calculate_single_distribution(group_data["price_limit"], total_users)
 
-    numeric_walk_time_dist = {WALK_TIME_MAP.get(option, option): val for option, val in walk_time_dist.items()}
-    numeric_budget_dist = {BUDGET_MAP.get(option, option): val for option, val in budget_dist.items()}
-
     # Получаем офис, выбранный инициатором
     if invitation:
         organizer_id = invitation.get("organizer_id")
         chosen_office = group_data["office"].get(organizer_id, "Не выбрано")
     else:
         chosen_office = "Не выбрано"
+    attendee_offices = {user_id: group_data["office"].get(user_id, chosen_office) for user_id in group_data["all_users"]}
+    offices_dist = calculate_single_distribution(
+        {user_id: office for user_id, office in attendee_offices.items() if office in OFFICE_IDS}, total_users)
 
     positive_text = "\n".join(group_data["positive"].values()).replace("\n", ", ")
     negative_text = "\n".join(group_data["negative"].values()).replace("\n", ", ")
     user_answers = {
         "office": chosen_office,
+        "offices": offices_dist,
         "wanted_cuisines": wanted_cuisines_dist,
         "food_restrictions": food_restrictions_dist,
-        "price_limit": numeric_budget_dist,
-        "walk_time": numeric_walk_time_dist,
+        "price_limit": budget_dist,
+        "walk_time": walk_time_dist,
         "positive": positive_text,
         "negative": negative_text,
     }
-    return clean_dict_keys(user_answers)
+    return user_answers
 
 # В команде /pollresults для группы выводим выбранный инициатором офис
 async def poll_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -411,23 +595,30 @@ async def poll_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     group_id = update.effective_chat.id
-    group_data = context.bot_data.get("group_answers", {}).get(group_id)
+    async with group_state(group_id) as state:
+        group_data = get_group_answers(state)
+        # Передаём приглашение в get_user_answers, чтобы взять офис инициатора
+        user_answers = get_user_answers(group_data, get_invitation(state)) if group_data else None
     if not group_data:
         await update.message.reply_text("Пока никто не проголосовал.")
         return
 
-    user_answers = get_user_answers(group_data)
-    
-    # Получаем данные приглашения
-    invitation = get_invitation(group_id, context.bot_data)
-    # Передаём invitation в get_user_answers
-    user_answers = get_user_answers(group_data, invitation)
-
-    recommendations = send_to_recommendation_module(user_answers)
+    recommendations = await send_to_recommendation_module(user_answers)
+    if recommendations is None:
+        await update.message.reply_text("Сервис рекомендаций сейчас недоступен, попробуйте /pollresults чуть позже.")
+        return
+    # Рекомендации выданы – приглашение считается закрытым и будет вытеснено раньше
+    async with group_state(group_id) as state:
+        touch_state(state, closed=True)
 
+    offices = user_answers.get("offices", {})
+    if len(offices) > 1:
+        office_summary = "1️⃣ Офисы участников:\n" + "\n".join([f"{k}: {v}" for k, v in offices.items()])
+    else:
+        office_summary = f"1️⃣ Офис: {user_answers.get('office')}"
     summary = (
         "📊 Итоговые предпочтения:\n\n"
-        f"1️⃣ Офис: {user_answers.get('office')}\n\n"
+        f"{office_summary}\n\n"
         "2️⃣ Желаемая кухня:\n" + "\n".join([f"{k}: {v}" for k, v in user_answers.get("wanted_cuisines", {}).items()]) + "\n\n"
         "3️⃣ Ограничения по питанию:\n" + "\n".join([f"{k}: {v}" for k, v in user_answers.get("food_restrictions", {}).items()]) + "\n\n"
         "4️⃣ Желаемый средний чек:\n" + "\n".join([f"{k}: {v}" for k, v in user_answers.get("price_limit", {}).items()]) + "\n\n"
@@ -447,27 +638,21 @@ async def poll_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #  ЧАСТЬ 2. ПРИГЛАШЕНИЕ
 ##########################
 
-def get_group_members(chat_id, bot_data):
-    if "group_members" not in bot_data:
-        bot_data["group_members"] = {}
-    return bot_data["group_members"].setdefault(chat_id, {})
+def get_group_members(state: dict) -> dict:
+    return state.setdefault("members", {})
 
-def get_invitation(chat_id, bot_data):
-    if "invitations" not in bot_data:
-        bot_data["invitations"] = {}
-    return bot_data["invitations"].get(chat_id)
+def get_invitation(state: dict):
+    return state.get("invitation")
 
-def set_invitation(chat_id, invitation, bot_data):
-    if "invitations" not in bot_data:
-        bot_data["invitations"] = {}
-    bot_data["invitations"][chat_id] = invitation
+def set_invitation(state: dict, invitation: dict):
+    state["invitation"] = invitation
 
-def create_invitation_keyboard(chat_id, bot_data):
+def create_invitation_keyboard(state: dict):
     """
     Строит клавиатуру для выбора участников приглашения.
     """
-    members = get_group_members(chat_id, bot_data)
-    invitation = get_invitation(chat_id, bot_data)
+    members = get_group_members(state)
+    invitation = get_invitation(state)
     keyboard = []
     for user_id, name in members.items():
         text = f"✅ {name}" if user_id in invitation["invitees"] else name
@@ -497,8 +682,9 @@ async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эту команду можно использовать только в группе.")
         return
     user = update.effective_user
-    members = get_group_members(chat.id, context.bot_data)
-    members[user.id] = user.full_name
+    async with group_state(chat.id) as state:
+        get_group_members(state)[user.id] = user.full_name
+        touch_state(state)
     await update.message.reply_text(f"{user.full_name}, вы зарегистрированы для приглашений в этой группе.")
 
 # Новая логика: инициатор в группе сначала отвечает на вопрос про офис,
@@ -509,18 +695,15 @@ async def group_start_invitation(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("Команда для приглашения доступна только в группе.")
         return
     organizer = update.effective_user
-    members = get_group_members(chat.id, context.bot_data)
-    members[organizer.id] = organizer.full_name
-
-    # Инициализируем данные опроса для группы, если их ещё нет
-    if "group_answers" not in context.bot_data:
-        context.bot_data["group_answers"] = {}
-    if chat.id not in context.bot_data["group_answers"]:
-        context.bot_data["group_answers"][chat.id] = init_group_data()
-    
+    async with group_state(chat.id) as state:
+        get_group_members(state)[organizer.id] = organizer.full_name
+        # Инициализируем данные опроса для группы, если их ещё нет
+        get_group_answers(state, create=True)
+        touch_state(state)
+
     # Отправляем инициатору в группу вопрос по офису
     text = group_office_state["text"]
-    reply_markup = create_inline_keyboard(group_office_state["options"], group_office_state["prefix"], set())
+    reply_markup = get_state_keyboard("group_office", set())
     await update.message.reply_text(text, reply_markup=reply_markup)
 
 # Новый callback-обработчик для выбора офиса инициатором в группе
@@ -533,6 +716,7 @@ async def group_office_callback(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         prefix, index_str = query.data.split("_", 1)
         option_index = int(index_str)
+        option = group_office_state["options"][option_index]
     except Exception:
         await query.answer("Некорректные данные!")
         return
@@ -541,26 +725,24 @@ async def group_office_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await query.answer("Некорректные данные!")
         return
 
-    group_id = chat.id
-    if group_id not in context.bot_data.get("group_answers", {}):
-        context.bot_data["group_answers"][group_id] = init_group_data()
-    group_data = context.bot_data["group_answers"][group_id]
-
-    # Сохраняем выбранный офис для инициатора
-    option = group_office_state["options"][option_index]
-    group_data["office"][user_id] = option
-
-    # Создаём приглашение с данными организатора
-    invitation = {
-        "organizer_id": user_id,
-        "organizer_username": query.from_user.full_name,
-        "invitees": set(),
-        "responses": {}  # статусы: "pending", "accepted", "declined"
-    }
-    set_invitation(group_id, invitation, context.bot_data)
+    async with group_state(chat.id) as state:
+        # Сохраняем выбранный офис для инициатора
+        group_data = get_group_answers(state, create=True)
+        group_data["office"][user_id] = option
+
+        # Создаём приглашение с данными организатора
+        invitation = {
+            "organizer_id": user_id,
+            "organizer_username": query.from_user.full_name,
+            "created_at": time.time(),
+            "invitees": set(),
+            "responses": {}  # статусы: "pending", "accepted", "declined"
+        }
+        set_invitation(state, invitation)
+        touch_state(state, closed=False)
+        reply_markup = create_invitation_keyboard(state)
 
     # Отправляем сообщение для выбора участников приглашения
-    reply_markup = create_invitation_keyboard(group_id, context.bot_data)
     await query.edit_message_text(
         f"{query.from_user.full_name}, ваш офис выбран: {option}.\n\nТеперь выберите участников, которых хотите пригласить на обед:",
         reply_markup=reply_markup
@@ -574,45 +756,92 @@ async def invitation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     chat = update.effective_chat  # группа
+    # Как и в poll_callback, в Telegram отвечаем после транзакции
+    async with group_state(chat.id) as state:
+        reply, invitees, created_at = apply_invitation_callback(query, state)
+    try:
+        await reply()
+    finally:
+        if invitees:
+            # Рассылка идёт в фоне, чтобы не задерживать обработку остальных нажатий;
+            # очередь рассылок ограничена, при переполнении ждём места
+            await dispatcher.submit(
+                partial(send_invitations, query.message, created_at, invitees, context),
+                partial(context.application.create_task, update=update)
+            )
+
+def apply_invitation_callback(query, state: dict):
+    """
+    Применяет нажатие при выборе участников к состоянию группы.
+    Возвращает (ответ бота, кому разослать приглашения или None, время создания приглашения).
+    """
     data = query.data
-    invitation = get_invitation(chat.id, context.bot_data)
+    invitation = get_invitation(state)
     if not invitation:
-        await query.answer("Приглашение не найдено.")
-        return
+        return partial(query.answer, "Приглашение не найдено."), None, None
+    touch_state(state)
 
     if data.startswith("invite_") and data != "invite_next":
         try:
             user_id = int(data.split("_")[1])
         except ValueError:
-            await query.answer("Некорректные данные.")
-            return
+            return partial(query.answer, "Некорректные данные."), None, None
         if user_id in invitation["invitees"]:
             invitation["invitees"].remove(user_id)
         else:
             invitation["invitees"].add(user_id)
-        reply_markup = create_invitation_keyboard(chat.id, context.bot_data)
-        await query.edit_message_reply_markup(reply_markup=reply_markup)
-    elif data == "invite_next":
+        return partial(query.edit_message_reply_markup, reply_markup=create_invitation_keyboard(state)), None, None
+    if data == "invite_next":
         logging.info(f"invite_next pressed; invitees: {invitation['invitees']}")
         if not invitation["invitees"]:
-            await query.answer("Вы не выбрали ни одного участника.", show_alert=True)
-            return
+            return partial(query.answer, "Вы не выбрали ни одного участника.", show_alert=True), None, None
         for uid in invitation["invitees"]:
             invitation["responses"][uid] = "pending"
-        await query.edit_message_text("Приглашения отправлены выбранным участникам.")
-        # Отправка личных сообщений приглашенным
-        for uid in invitation["invitees"]:
-            logging.info(f"Отправляем приглашение пользователю {uid}")
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=f"Вам пришло приглашение на сегодняшний обед из группы \"{query.message.chat.title}\". Примите его?",
-                    reply_markup=create_response_keyboard(query.message.chat.id)
-                )
-            except Exception as e:
-                logging.error(f"Ошибка отправки сообщения пользователю {uid}: {e}")
-    else:
-        await query.answer("Неизвестное действие.")
+        return (partial(query.edit_message_text, "Отправляем приглашения выбранным участникам..."),
+                list(invitation["invitees"]), invitation["created_at"])
+    return partial(query.answer, "Неизвестное действие."), None, None
+
+async def send_invitations(group_message, invitation_created_at: float, invitees: list, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Параллельно рассылает приглашения через диспетчер, сохраняет статусы доставки
+    в приглашении и сообщает организатору итог рассылки.
+    """
+    chat = group_message.chat
+    logging.info("Отправляем приглашения пользователям %s", invitees)
+    results = await dispatcher.fan_out(context.bot, [
+        (uid, {
+            "text": f"Вам пришло приглашение на сегодняшний обед из группы \"{chat.title}\". Примите его?",
+            "reply_markup": create_response_keyboard(chat.id)
+        })
+        for uid in invitees
+    ])
+    delivery = {uid: status for uid, (status, _) in results.items()}
+
+    async with group_state(chat.id) as state:
+        invitation = get_invitation(state)
+        # За время рассылки организатор мог начать новое приглашение – старое не трогаем
+        if invitation and invitation.get("created_at") == invitation_created_at:
+            invitation["delivery"] = delivery
+            touch_state(state)
+        members = dict(get_group_members(state))
+
+    failed = [members.get(uid, str(uid)) for uid, status in delivery.items() if status not in (DELIVERED, UNKNOWN)]
+    unknown = [members.get(uid, str(uid)) for uid, status in delivery.items() if status == UNKNOWN]
+    summary = f"Приглашения отправлены: {len(invitees) - len(failed) - len(unknown)} из {len(invitees)}."
+    if failed:
+        summary += (
+            "\n\nНе удалось доставить: " + ", ".join(failed) +
+            ".\nПопросите их написать боту в личные сообщения и пригласите ещё раз."
+        )
+    if unknown:
+        summary += (
+            "\n\nTelegram не подтвердил доставку: " + ", ".join(unknown) +
+            ".\nСообщение могло дойти – уточните у них, прежде чем приглашать ещё раз."
+        )
+    try:
+        await group_message.edit_text(summary)
+    except Exception as e:
+        logging.error("Не удалось обновить сообщение с итогами рассылки: %s", e)
 
 async def response_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -631,25 +860,34 @@ async def response_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await query.answer("Некорректный идентификатор группы.")
         return
-    invitation = get_invitation(group_id, context.bot_data)
-    if not invitation:
-        await query.edit_message_text("Приглашение не найдено или истекло.")
+    if decision not in ("accept", "decline"):
+        await query.answer("Неизвестное решение.")
         return
     user_id = query.from_user.id
-    if user_id not in invitation["responses"]:
-        await query.edit_message_text("Вы не были приглашены.")
+    error = None
+    async with group_state(group_id) as state:
+        invitation = get_invitation(state)
+        if not invitation:
+            error = "Приглашение не найдено или истекло."
+        else:
+            touch_state(state)
+            if user_id not in invitation["responses"]:
+                error = "Вы не были приглашены."
+            else:
+                invitation["responses"][user_id] = "accepted" if decision == "accept" else "declined"
+    if error:
+        await query.edit_message_text(error)
         return
+
     if decision == "accept":
-        invitation["responses"][user_id] = "accepted"
-        context.user_data["invitation_accepted"] = True
-        context.user_data["group_id"] = group_id
+        async with user_session(user_id) as session:
+            session["invitation_accepted"] = True
+            session["group_id"] = group_id
+            touch_state(session)
         await query.edit_message_text("Вы приняли приглашение на обед!\nЗапускаем опрос...")
         await poll_start(update, context)
-    elif decision == "decline":
-        invitation["responses"][user_id] = "declined"
-        await query.edit_message_text("Вы отклонили приглашение.")
     else:
-        await query.answer("Неизвестное решение.")
+        await query.edit_message_text("Вы отклонили приглашение.")
 
 async def invitation_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -659,15 +897,21 @@ async def invitation_results(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if chat.type not in ["group", "supergroup"]:
         await update.message.reply_text("Эту команду можно использовать только в группе.")
         return
-    invitation = get_invitation(chat.id, context.bot_data)
+    async with group_state(chat.id) as state:
+        invitation = get_invitation(state)
+        members = dict(get_group_members(state))
     if not invitation:
         await update.message.reply_text("Нет активных приглашений в этой группе.")
         return
-    members = get_group_members(chat.id, context.bot_data)
     results_text = f"Приглашение от {invitation['organizer_username']}:\n\n"
     for uid in invitation["invitees"]:
         name = members.get(uid, "Неизвестно")
         status = invitation["responses"].get(uid, "pending")
+        delivery = invitation.get("delivery", {}).get(uid, DELIVERED)
+        if delivery == UNKNOWN and status == "pending":
+            status = "доставка не подтверждена"
+        elif delivery not in (DELIVERED, UNKNOWN):
+            status = "не доставлено"
         results_text += f"{name}: {status}\n"
     await update.message.reply_text(results_text)
 
@@ -707,56 +951,54 @@ async def free_form_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return
 
-    if not context.user_data.get("free_form_input_expected", False):
-        return
+    user_id = update.effective_user.id
+    async with user_session(user_id) as session:
+        if not session.get("free_form_input_expected", False):
+            return
+        group_id = session.get("group_id")
+        mode = session.get("free_form_mode")
+        session["free_form_input_expected"] = False
+        session["free_form_mode"] = None
+        touch_state(session)
 
     free_text = update.message.text
-    group_id = context.user_data.get("group_id")
     if not group_id:
         await update.message.reply_text("Ошибка: не найдена группа.")
         return
 
-    group_data = context.bot_data["group_answers"].get(group_id, {})
-    mode = context.user_data.get("free_form_mode")
-    user_id = update.effective_user.id
+    async with group_state(group_id) as state:
+        group_data = get_group_answers(state)
+        if group_data and mode in ("positive", "negative"):
+            # Перезаписываем ответ пользователя
+            group_data[mode][user_id] = free_text
+            touch_state(state)
 
-    if mode == "positive":
-        # Перезаписываем ответ пользователя
-        group_data["positive"][user_id] = free_text
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Написать нежелаемые блюда/кухни", callback_data="free_form_negative")]
-        ])
+    if not group_data:
+        await update.message.reply_text("Ошибка: данные опроса не найдены или устарели.")
+    elif mode == "positive":
         await update.message.reply_text(
             "Спасибо, ваши предпочтения учтены.\n"
             "Можете написать блюда/кухни, которые не любите:",
-            reply_markup=keyboard
+            reply_markup=free_form_negative_keyboard
         )
     elif mode == "negative":
-        group_data["negative"][user_id] = free_text
         await update.message.reply_text("Спасибо, это учтено! Ваши ответы сохранены.")
 
-    context.user_data["free_form_input_expected"] = False
-    context.user_data["free_form_mode"] = None
-
-
-
-
-
 async def free_form_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     data = query.data
 
-    context.user_data["free_form_input_expected"] = True
+    async with user_session(query.from_user.id) as session:
+        session["free_form_input_expected"] = data in ("free_form_positive", "free_form_negative")
+        session["free_form_mode"] = data[len("free_form_"):] if session["free_form_input_expected"] else None
+        touch_state(session)
 
     if data == "free_form_positive":
-        context.user_data["free_form_mode"] = "positive"
         await query.edit_message_text("Перечислите блюда и кухни, которые Вам особенно нравятся:")
     elif data == "free_form_negative":
-        context.user_data["free_form_mode"] = "negative"
         await query.edit_message_text("Перечислите блюда и кухни, которые Вам не по вкусу:")
     else:
-        context.user_data["free_form_input_expected"] = False
         await query.edit_message_text("Неизвестное действие.")
 
 
@@ -773,56 +1015,52 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Если команда вызвана в группе – инициируется приглашение.
     """
     if update.effective_chat.type == "private":
-        if not context.user_data.get("invitation_accepted", False):
+        session = await get_user_session(update.effective_user.id)
+        if not session.get("invitation_accepted", False):
             await hello_command(update, context)
             return
         await poll_start(update, context)
     else:
         await group_start_invitation(update, context)
 
-# Изменён: в ЛС опрос для приглашённых начинается с этапа "cuisine" (без вопроса об офисе)
+# В ЛС опрос для приглашённых начинается с этапа "office", для инициатора – с "cuisine"
 async def poll_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Запуск опроса в личном чате.
-    Теперь данные опроса сохраняются для конкретной группы, идентификатор которой хранится в context.user_data["group_id"].
+    Данные опроса сохраняются для конкретной группы, идентификатор которой хранится в сессии пользователя.
     """
     if update.effective_chat.type != "private":
         await update.effective_message.reply_text("Пожалуйста, напишите мне в личном чате для прохождения опроса.")
         return
 
-    group_id = context.user_data.get("group_id")
+    user_id = update.effective_user.id
+    group_id = (await get_user_session(user_id)).get("group_id")
     if not group_id:
-        logging.error("Poll start: group_id не найден в user_data")
-        await update.message.reply_text("Ошибка: не удалось определить группу.")
+        logging.error("Poll start: group_id не найден в сессии пользователя")
+        await update.effective_message.reply_text("Ошибка: не удалось определить группу.")
         return
 
-    if "group_answers" not in context.bot_data:
-        context.bot_data["group_answers"] = {}
-    if group_id not in context.bot_data["group_answers"]:
-        context.bot_data["group_answers"][group_id] = init_group_data()
-    group_data = context.bot_data["group_answers"][group_id]
-    user_id = update.effective_user.id
-
-    # Если пользователь является инициатором, не сбрасываем его офисный ответ
-    invitation = get_invitation(group_id, context.bot_data)
-    if invitation and invitation.get("organizer_id") == user_id:
-        skip_office = True
-    else:
-        skip_office = False
-
-    reset_user_answers(user_id, group_data, skip_office=skip_office)
-
-    # Начинаем опрос с этапа "cuisine"
-    initial_state = "cuisine"
-    settings = state_settings[initial_state]
-    text = settings["text"]
-    reply_markup = create_inline_keyboard(
-        settings["options"],
-        settings["prefix"],
-        get_selected_values(initial_state, user_id, group_data),
-        next_step=settings.get("next_state"),
-        prev_step=settings.get("prev_state")
-    )
+    async with group_state(group_id) as state:
+        group_data = get_group_answers(state, create=True)
+        touch_state(state)
+
+        # Если пользователь является инициатором, не сбрасываем его офисный ответ
+        invitation = get_invitation(state)
+        organizer_id = invitation.get("organizer_id") if invitation else None
+        skip_office = organizer_id == user_id
+        reset_user_answers(user_id, group_data, skip_office=skip_office)
+        if skip_office:
+            initial_state = "cuisine"
+        else:
+            # Приглашённому заранее отмечаем офис инициатора – чаще всего он тот же
+            initial_state = "office"
+            organizer_office = group_data["office"].get(organizer_id)
+            if organizer_office:
+                group_data["office"][user_id] = organizer_office
+        selected = get_selected_values(initial_state, user_id, group_data)
+
+    text = state_settings[initial_state]["text"]
+    reply_markup = get_state_keyboard(initial_state, selected)
     if update.message:
         await update.message.reply_text(text, reply_markup=reply_markup)
     elif update.callback_query and update.callback_query.message:
@@ -830,21 +1068,52 @@ async def poll_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         logging.error("Не найден объект сообщения для отправки опроса.")
 
+##########################
+#  ОЧИСТКА УСТАРЕВШЕГО СОСТОЯНИЯ
+##########################
+
+async def sweep_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая задача: вытесняет заброшенные опросы, закрытые приглашения,
+    давно неактивные списки участников и сессии, логирует gauge состояния.
+    """
+    evicted, gauges = await sweep_store(
+        state_store,
+        poll_ttl=POLL_TTL_HOURS * 3600,
+        closed_ttl=CLOSED_INVITATION_TTL_HOURS * 3600,
+        members_ttl=GROUP_MEMBERS_TTL_HOURS * 3600,
+        archive_path=STATE_ARCHIVE_PATH
+    )
+    logging.info("Очистка состояния: вытеснено %s; gauge: %s", evicted, gauges)
+    set_state_gauges(gauges)
+
 ##########################
 #  РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ
 ##########################
 
-app = ApplicationBuilder().token(TOKEN).build()
-
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("hello", hello_command))
-app.add_handler(CallbackQueryHandler(poll_callback, pattern=r"^(cuisine_|restrictions_|budget_|walkTime_|next_|prev_)"))
-app.add_handler(CallbackQueryHandler(group_office_callback, pattern=r"^groupOffice_"))
-app.add_handler(CommandHandler("pollresults", poll_results))
-app.add_handler(CommandHandler("join", join))
-app.add_handler(CallbackQueryHandler(invitation_callback, pattern=r"^(invite_|invite_next)"))
-app.add_handler(CallbackQueryHandler(response_callback, pattern=r"^response_"))
-app.add_handler(CallbackQueryHandler(free_form_callback, pattern=r"^free_form_(positive|negative)$"))
-app.add_handler(CommandHandler("invite_results", invitation_results))
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, free_form_handler))
-app.run_polling()
+def build_application(builder: ApplicationBuilder = None):
+    """
+    Создаёт приложение бота со всеми обработчиками. builder – ApplicationBuilder с уже заданными
+    токеном и параметрами (нагрузочный тест подставляет в него поддельный Telegram API).
+    """
+    warm_keyboard_cache()
+    app = (builder or ApplicationBuilder().token(TOKEN)).build()
+    app.add_handler(CommandHandler("start", timed(start)))
+    app.add_handler(CommandHandler("hello", timed(hello_command)))
+    app.add_handler(CallbackQueryHandler(timed(poll_callback), pattern=r"^(office_|cuisine_|restrictions_|budget_|walkTime_|next_|prev_)"))
+    app.add_handler(CallbackQueryHandler(timed(group_office_callback), pattern=r"^groupOffice_"))
+    app.add_handler(CommandHandler("pollresults", timed(poll_results)))
+    app.add_handler(CommandHandler("join", timed(join)))
+    app.add_handler(CallbackQueryHandler(timed(invitation_callback), pattern=r"^(invite_|invite_next)"))
+    app.add_handler(CallbackQueryHandler(timed(response_callback), pattern=r"^response_"))
+    app.add_handler(CallbackQueryHandler(timed(free_form_callback), pattern=r"^free_form_(positive|negative)$"))
+    app.add_handler(CommandHandler("invite_results", timed(invitation_results)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(free_form_handler)))
+    app.job_queue.run_repeating(sweep_state_job, interval=SWEEP_INTERVAL_MINUTES * 60, first=SWEEP_INTERVAL_MINUTES * 60)
+    return app
+
+
+if __name__ == "__main__":
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+    build_application().run_polling()
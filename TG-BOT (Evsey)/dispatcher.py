@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple
+
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+from metrics import OUTBOUND_MESSAGES
+
+# Статусы доставки исходящего сообщения
+DELIVERED = "delivered"
+FAILED = "failed"
+# Запрос ушёл, но ответа не дождались: сообщение могло дойти, повторять нельзя
+UNKNOWN = "unknown"
+
+# Таймауты, при которых запрос точно не был отправлен в Telegram
+NOT_SENT_TIMEOUTS = (httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше capacity в запасе.
+    Ожидающие обслуживаются по очереди (через lock), поэтому burst не «проскакивает».
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def pause(self, delay: float) -> None:
+        """
+        Забирает запас токенов: следующий будет выдан не раньше чем через delay секунд.
+        Ожидающие в acquire() досыпают паузу, даже если уже начали ждать.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 1 - delay * self.rate)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundDispatcher:
+    """
+    Центральный диспетчер исходящих сообщений.
+    Отправляет сообщения параллельно, но в пределах глобального лимита и лимита на один чат,
+    повторяет отправку после flood-wait (RetryAfter) через рекомендованную Telegram паузу.
+    Flood-wait относится ко всему боту, поэтому пауза ставится на глобальный бакет и её
+    выдерживают все отправки. sendMessage неидемпотентен: после таймаута ответа сообщение
+    не переотправляется, чтобы не дублировать его.
+    Фоновые рассылки (submit) идут через ограниченную очередь: не больше max_jobs одновременно
+    и не больше max_queued_jobs в ожидании.
+    """
+
+    # Сколько бакетов по чатам держим, прежде чем выкидывать простаивающие
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float = 25, per_chat_rate: float = 1,
+                 per_chat_burst: float = 3, max_retries: int = 3,
+                 max_jobs: int = 8, max_queued_jobs: int = 100):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        # Рассылки, которые выполняются сейчас, и все принятые (выполняются или ждут)
+        self.job_slots = asyncio.Semaphore(max_jobs)
+        self.queue_slots = asyncio.Semaphore(max_jobs + max_queued_jobs)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # Полный бакет эквивалентен новому, его можно безопасно удалить
+                for key in [k for k, b in self.chat_buckets.items() if b.is_full()]:
+                    del self.chat_buckets[key]
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def send_message(self, bot, chat_id: int, **kwargs) -> Tuple[str, Any]:
+        """
+        Отправляет одно сообщение с учётом лимитов.
+        Возвращает (статус, сообщение или текст ошибки).
+        """
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                message = await bot.send_message(chat_id=chat_id, **kwargs)
+                OUTBOUND_MESSAGES.labels(DELIVERED).inc()
+                return DELIVERED, message
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+                logging.warning("Flood-wait для чата %s: ждём %s с", chat_id, delay)
+                self.global_bucket.pause(delay)
+                # Паузу выдержим в global_bucket.acquire() вместе с остальными отправками
+                delay = 0
+                error = e
+            except (Forbidden, BadRequest) as e:
+                # Пользователь не начинал диалог с ботом или заблокировал его – повтор не поможет
+                logging.error("Ошибка отправки сообщения в чат %s: %s", chat_id, e)
+                OUTBOUND_MESSAGES.labels(FAILED).inc()
+                return FAILED, str(e)
+            except TimedOut as e:
+                if not isinstance(e.__cause__, NOT_SENT_TIMEOUTS):
+                    logging.error("Таймаут отправки в чат %s, доставка неизвестна: %s", chat_id, e)
+                    OUTBOUND_MESSAGES.labels(UNKNOWN).inc()
+                    return UNKNOWN, str(e)
+                delay = 2 ** attempt
+                logging.warning("Запрос в чат %s не отправлен: %s", chat_id, e)
+                error = e
+            except NetworkError as e:
+                delay = 2 ** attempt
+                logging.warning("Сетевая ошибка при отправке в чат %s: %s", chat_id, e)
+                error = e
+            except TelegramError as e:
+                logging.error("Ошибка отправки сообщения в чат %s: %s", chat_id, e)
+                OUTBOUND_MESSAGES.labels(FAILED).inc()
+                return FAILED, str(e)
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logging.error("Не удалось отправить сообщение в чат %s: %s", chat_id, error)
+                OUTBOUND_MESSAGES.labels(FAILED).inc()
+                return FAILED, str(error)
+            await asyncio.sleep(delay)
+
+    async def submit(self, job: Callable[[], Awaitable[Any]], create_task=asyncio.create_task) -> None:
+        """
+        Ставит фоновую рассылку job() в очередь и запускает её задачей через create_task.
+        Если очередь полна, ждёт места: перегрузка притормаживает обработчики, а не копит задачи.
+        """
+        await self.queue_slots.acquire()
+        try:
+            create_task(self._run_job(job))
+        except BaseException:
+            self.queue_slots.release()
+            raise
+
+    async def _run_job(self, job: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            async with self.job_slots:
+                await job()
+        finally:
+            self.queue_slots.release()
+
+    async def fan_out(self, bot, messages: Iterable[Tuple[int, Dict[str, Any]]]) -> Dict[int, Tuple[str, Any]]:
+        """
+        Параллельно рассылает сообщения [(chat_id, kwargs для send_message), ...].
+        Возвращает {chat_id: (статус, сообщение или текст ошибки)}.
+        """
+        messages = list(messages)
+        results = await asyncio.gather(
+            *(self.send_message(bot, chat_id, **kwargs) for chat_id, kwargs in messages)
+        )
+        return {chat_id: result for (chat_id, _), result in zip(messages, results)}
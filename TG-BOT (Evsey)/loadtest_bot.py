@@ -0,0 +1,311 @@
+"""
+Нагрузочный тест бота: тысячи групп одновременно проходят обеденный опрос через настоящие
+обработчики bot.py (/join, /start в группе, выбор офиса и участников, ответы на приглашение,
+опрос в ЛС, свободный ввод, /pollresults).
+
+Telegram заменён поддельным API внутри процесса (FakeTelegramRequest): обработчики и сериализация
+python-telegram-bot работают как обычно, ответы API приходят с задержкой --api-latency-ms.
+Рекомендации запрашиваются у настоящего сервиса (--recommender-url), который, в свою очередь,
+может ходить в сервис БД. Загруженность сервисов считается по их /metrics до и после прогона
+(под gunicorn с несколькими воркерами – только с PROMETHEUS_MULTIPROC_DIR, иначе /metrics
+отдаёт счётчики одного воркера).
+
+    python loadtest_bot.py --groups 2000 --members 4 --concurrency 500 \\
+        --recommender-url http://127.0.0.1:5005 --db-url http://127.0.0.1:5000
+
+Отчёт: пропускная способность (апдейтов и завершённых опросов в секунду), задержка от нажатия
+до ответа бота (p50/p95/p99) по обработчикам, ошибки, задержка event loop и CPU бота,
+запросы в секунду и занятость (секунд обработки на секунду прогона) сервисов.
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LunchBuddy", "username": "lunch_buddy_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+# Вызовы API, которые пользователь видит как ответ бота (answerCallbackQuery только убирает «часики»)
+REPLY_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup"}
+
+# Апдейт, который сейчас обрабатывается: время нажатия, время первого ответа, ошибка
+current_update = contextvars.ContextVar("current_update", default=None)
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Поддельный Bot API: отвечает на вызовы бота без сети, считает вызовы и отмечает время
+    первого ответа на текущий апдейт.
+    """
+
+    def __init__(self, latency: float, api_calls: dict):
+        self.latency = latency
+        self.api_calls = api_calls
+        self.message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.api_calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        entry = current_update.get()
+        if entry is not None and entry["replied_at"] is None and api_method in REPLY_METHODS:
+            entry["replied_at"] = time.perf_counter()
+
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in REPLY_METHODS and "chat_id" in params:
+            chat_id = int(params["chat_id"])
+            result = {
+                "message_id": params.get("message_id") or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": chat(chat_id),
+                "from": BOT_USER,
+                "text": params.get("text", "")
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def chat(chat_id: int) -> dict:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+    return {"id": chat_id, "type": "group", "title": f"Обед {-chat_id}"}
+
+
+def user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+update_ids = itertools.count(1)
+
+
+def message_update(chat_id: int, user_id: int, text: str) -> dict:
+    message = {"message_id": next(update_ids), "date": int(time.time()), "chat": chat(chat_id),
+               "from": user(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(update_ids), "message": message}
+
+
+def callback_update(chat_id: int, user_id: int, data: str) -> dict:
+    return {"update_id": next(update_ids), "callback_query": {
+        "id": str(next(update_ids)), "from": user(user_id), "chat_instance": str(chat_id), "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": chat(chat_id), "from": BOT_USER, "text": "-"}
+    }}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.no_reply = defaultdict(int)
+        self.api_calls = defaultdict(int)
+        self.updates = 0
+        self.polls_done = 0
+        self.loop_lag = []
+
+
+async def send(app, stats: Stats, handler: str, update: dict, think: float):
+    """
+    Передаёт апдейт в приложение бота после паузы «на раздумье» и записывает задержку ответа.
+    """
+    if think:
+        await asyncio.sleep(random.uniform(0, 2 * think))
+    entry = {"replied_at": None, "error": None}
+    token = current_update.set(entry)
+    started_at = time.perf_counter()
+    try:
+        await app.process_update(Update.de_json(update, app.bot))
+    finally:
+        current_update.reset(token)
+    stats.updates += 1
+    if entry["error"] is not None:
+        stats.errors[handler] += 1
+    elif entry["replied_at"] is None:
+        stats.no_reply[handler] += 1
+    else:
+        stats.latencies[handler].append(entry["replied_at"] - started_at)
+
+
+async def member_poll(app, stats: Stats, group_id: int, user_id: int, bot, think: float):
+    await send(app, stats, "response_callback", callback_update(user_id, user_id, f"response_{group_id}_accept"), think)
+    await send(app, stats, "poll_callback", callback_update(
+        user_id, user_id, f"office_{random.randrange(len(bot.office_options))}"), think)
+    await send(app, stats, "poll_callback", callback_update(user_id, user_id, "next_cuisine"), think)
+    for i in random.sample(range(len(bot.cuisine_options)), random.randint(1, 2)):
+        await send(app, stats, "poll_callback", callback_update(user_id, user_id, f"cuisine_{i}"), think)
+    await send(app, stats, "poll_callback", callback_update(user_id, user_id, "next_restrictions"), think)
+    await send(app, stats, "poll_callback", callback_update(
+        user_id, user_id, f"restrictions_{random.randrange(len(bot.restriction_options))}"), think)
+    await send(app, stats, "poll_callback", callback_update(user_id, user_id, "next_budget"), think)
+    await send(app, stats, "poll_callback", callback_update(
+        user_id, user_id, f"budget_{random.randrange(len(bot.budget_options))}"), think)
+    await send(app, stats, "poll_callback", callback_update(user_id, user_id, "next_walk_time"), think)
+    await send(app, stats, "poll_callback", callback_update(
+        user_id, user_id, f"walkTime_{random.randrange(len(bot.walk_time_options))}"), think)
+    await send(app, stats, "poll_callback", callback_update(user_id, user_id, "next_finish"), think)
+    await send(app, stats, "free_form_callback", callback_update(user_id, user_id, "free_form_positive"), think)
+    await send(app, stats, "free_form_handler", message_update(user_id, user_id, "Люблю пиццу и суши"), think)
+
+
+async def lunch_poll(app, stats: Stats, group_index: int, members: int, bot, think: float):
+    """
+    Один обеденный опрос группы от /join до /pollresults.
+    """
+    group_id = -(1000000 + group_index)
+    user_ids = [10000000 + group_index * members + i for i in range(members)]
+    organizer, invitees = user_ids[0], user_ids[1:]
+    for user_id in user_ids:
+        await send(app, stats, "join", message_update(group_id, user_id, "/join"), think)
+    await send(app, stats, "group_start_invitation", message_update(group_id, organizer, "/start"), think)
+    await send(app, stats, "group_office_callback", callback_update(
+        group_id, organizer, f"groupOffice_{random.randrange(len(bot.office_options))}"), think)
+    for user_id in invitees:
+        await send(app, stats, "invitation_callback", callback_update(group_id, organizer, f"invite_{user_id}"), think)
+    await send(app, stats, "invitation_callback", callback_update(group_id, organizer, "invite_next"), think)
+    await asyncio.gather(*(member_poll(app, stats, group_id, user_id, bot, think) for user_id in invitees))
+    await send(app, stats, "poll_results", message_update(group_id, organizer, "/pollresults"), think)
+    stats.polls_done += 1
+
+
+async def watch_loop_lag(stats: Stats, stop: asyncio.Event, interval: float = 0.01):
+    while not stop.is_set():
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(time.perf_counter() - started_at - interval)
+
+
+def scrape(url: str):
+    """
+    Суммы и число запросов по гистограммам *_request_seconds из /metrics сервиса или None.
+    """
+    if not url:
+        return None
+    try:
+        text = requests.get(f"{url}/metrics", timeout=5).text
+    except requests.RequestException:
+        return None
+    busy, count = 0.0, 0.0
+    for family in text_string_to_metric_families(text):
+        if family.name.endswith("_request_seconds"):
+            for sample in family.samples:
+                if sample.name.endswith("_sum"):
+                    busy += sample.value
+                elif sample.name.endswith("_count"):
+                    count += sample.value
+    return busy, count
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000 if values else 0
+
+
+async def run(args):
+    # Адрес рекомендаций нужно задать до импорта bot.py
+    os.environ["RECOMMENDER_URL"] = args.recommender_url
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stats = Stats()
+    fake = FakeTelegramRequest(args.api_latency_ms / 1000, stats.api_calls)
+    app = bot.build_application(
+        ApplicationBuilder().token("123456:LOADTEST").request(fake).get_updates_request(fake).updater(None)
+    )
+
+    async def record_error(update, context):
+        entry = current_update.get()
+        if entry is not None:
+            entry["error"] = context.error
+    app.add_error_handler(record_error)
+
+    services = {"recommender": args.recommender_url, "db": args.db_url}
+    before = {name: scrape(url) for name, url in services.items()}
+    await app.initialize()
+    await app.start()
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(watch_loop_lag(stats, stop))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(group_index):
+        # Группы стартуют равномерно в течение --ramp секунд
+        await asyncio.sleep(args.ramp * group_index / args.groups)
+        async with semaphore:
+            await lunch_poll(app, stats, group_index, args.members, bot, args.think_ms / 1000)
+
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+    await asyncio.gather(*(limited(i) for i in range(args.groups)))
+    wall = time.perf_counter() - started_at
+    cpu = time.process_time() - cpu_started_at
+    stop.set()
+    await lag_task
+    await app.stop()
+    await app.shutdown()
+    after = {name: scrape(url) for name, url in services.items()}
+
+    print(f"Групп: {args.groups}, участников: {args.members}, одновременно: {args.concurrency}, "
+          f"время: {wall:.1f} с")
+    print(f"Апдейтов: {stats.updates} ({stats.updates / wall:.1f}/с), опросов завершено: {stats.polls_done} "
+          f"({stats.polls_done / wall:.2f}/с), вызовов API Telegram: {sum(stats.api_calls.values()) / wall:.1f}/с")
+    print(f"\n{'обработчик':<24} {'ответов':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'ошибок':>7} {'без ответа':>10}")
+    for handler in sorted(set(stats.latencies) | set(stats.errors) | set(stats.no_reply)):
+        values = sorted(stats.latencies[handler])
+        print(f"{handler:<24} {len(values):>8} {percentile(values, 0.5):>9.1f} {percentile(values, 0.95):>9.1f} "
+              f"{percentile(values, 0.99):>9.1f} {stats.errors[handler]:>7} {stats.no_reply[handler]:>10}")
+
+    lag = sorted(stats.loop_lag)
+    print(f"\nБот: CPU {cpu / wall:.0%} одного ядра, задержка event loop p95 {percentile(lag, 0.95):.1f} мс, "
+          f"max {lag[-1] * 1000 if lag else 0:.1f} мс")
+    for name, url in services.items():
+        if before[name] is None or after[name] is None:
+            print(f"{name}: метрики недоступны ({url or 'адрес не задан'})")
+            continue
+        busy = after[name][0] - before[name][0]
+        count = after[name][1] - before[name][1]
+        print(f"{name}: {count / wall:.1f} запросов/с, занятость {busy / wall:.2f} воркер-секунд/с, "
+              f"среднее время запроса {busy / count * 1000 if count else 0:.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=1000, help="сколько групп проходят опрос")
+    parser.add_argument("--members", type=int, default=4, help="участников в группе вместе с организатором")
+    parser.add_argument("--concurrency", type=int, default=200, help="сколько групп проходят опрос одновременно")
+    parser.add_argument("--ramp", type=float, default=10, help="за сколько секунд стартуют все группы")
+    parser.add_argument("--think-ms", type=float, default=200, help="средняя пауза пользователя между нажатиями")
+    parser.add_argument("--api-latency-ms", type=float, default=30, help="задержка ответа поддельного Telegram API")
+    parser.add_argument("--recommender-url", default="http://127.0.0.1:5005")
+    parser.add_argument("--db-url", default=None, help="сервис БД – только для метрик занятости")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import functools
+import time
+from typing import Awaitable, Callable, Dict
+
+from prometheus_client import Counter, Gauge, Histogram
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Время обработчика по имени: у каждого шаблона callback_data свой обработчик
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта", ["handler"], buckets=BUCKETS)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+RECOMMENDER_SECONDS = Histogram("bot_recommender_seconds", "Время запроса в сервис рекомендаций", buckets=BUCKETS)
+OUTBOUND_MESSAGES = Counter("bot_outbound_messages_total", "Исходящие сообщения через диспетчер", ["status"])
+CACHE_LOOKUPS = Counter("bot_cache_lookups_total", "Обращения к кэшам бота", ["cache", "result"])
+STATE_GAUGE = Gauge("bot_state", "Состояние хранилища после очистки: живые группы, опросы, вытеснения", ["name"])
+
+
+def timed(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """
+    Оборачивает асинхронный обработчик: время и исключения пишутся в метрики с его именем.
+    """
+    histogram = HANDLER_SECONDS.labels(handler.__name__)
+    errors = HANDLER_ERRORS.labels(handler.__name__)
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started_at)
+
+    return wrapper
+
+
+def set_state_gauges(gauges: Dict[str, int]) -> None:
+    for name, value in gauges.items():
+        STATE_GAUGE.labels(name).set(value)
+
@@ -0,0 +1,179 @@
+import asyncio
+import copy
+import logging
+import pickle
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+# Ключ состояния: (вид, идентификатор), например ("group", chat_id) или ("user", user_id)
+StateKey = Tuple[str, int]
+
+
+class StateConflictError(Exception):
+    """Состояние успели изменить параллельно (например, истекла блокировка) – запись отклонена."""
+
+
+def is_empty_state(state: dict) -> bool:
+    """
+    Состояние без данных (только метаданные) не храним.
+    """
+    return not any(value for key, value in state.items() if key != "meta")
+
+
+class StateStore:
+    """
+    Хранилище состояния бота (участники групп, приглашения, ответы опросов, сессии пользователей).
+    Каждое состояние – словарь, изменяемый атомарно внутри transaction(key).
+    """
+
+    def transaction(self, key: StateKey):
+        """
+        Асинхронный контекстный менеджер: блокирует ключ, отдаёт словарь состояния
+        (пустой, если состояния ещё нет) и сохраняет его при выходе без исключения.
+        Пустое состояние удаляется.
+        """
+        raise NotImplementedError
+
+    async def keys(self) -> List[StateKey]:
+        raise NotImplementedError
+
+    async def incr_stats(self, counters: Dict[str, int]) -> None:
+        raise NotImplementedError
+
+    async def get_stats(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+class InMemoryStateStore(StateStore):
+    """
+    Состояние в памяти процесса с asyncio-блокировкой на каждый ключ.
+    Подходит для одного процесса бота. Транзакция работает с копией состояния:
+    как и в RedisStateStore, при исключении изменения не сохраняются.
+    """
+
+    def __init__(self):
+        self.states: Dict[StateKey, dict] = {}
+        self.locks: Dict[StateKey, asyncio.Lock] = {}
+        # Сколько корутин сейчас держат или ждут блокировку ключа – чтобы удалять неиспользуемые блокировки
+        self.lock_users: Dict[StateKey, int] = {}
+        self.stats: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def transaction(self, key: StateKey) -> AsyncIterator[dict]:
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.lock_users[key] = self.lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                state = copy.deepcopy(self.states.get(key, {}))
+                yield state
+                if is_empty_state(state):
+                    self.states.pop(key, None)
+                else:
+                    self.states[key] = state
+        finally:
+            self.lock_users[key] -= 1
+            if not self.lock_users[key]:
+                del self.lock_users[key]
+                del self.locks[key]
+
+    async def keys(self) -> List[StateKey]:
+        return list(self.states)
+
+    async def incr_stats(self, counters: Dict[str, int]) -> None:
+        for name, value in counters.items():
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    async def get_stats(self) -> Dict[str, int]:
+        return dict(self.stats)
+
+
+# Запись с проверкой версии (compare-and-swap): если версия изменилась, запись отклоняется
+_CAS_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'version') or '0'
+if current ~= ARGV[1] then
+    return 0
+end
+if ARGV[3] == '1' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('HSET', KEYS[1], 'version', tonumber(current) + 1, 'data', ARGV[2])
+end
+return 1
+"""
+
+
+class RedisStateStore(StateStore):
+    """
+    Общее состояние в Redis для нескольких процессов бота, обслуживающих один токен.
+    Изменение ключа выполняется под распределённой блокировкой, а запись – через
+    compare-and-swap по версии, так что параллельные голоса не теряются.
+    Для локальной проверки вместо сервера можно передать client=fakeredis.aioredis.FakeRedis().
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "lunchbot",
+                 lock_timeout: float = 30, client: Any = None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self._cas = self.redis.register_script(_CAS_SCRIPT)
+
+    def _key(self, key: StateKey) -> str:
+        kind, ident = key
+        return f"{self.prefix}:state:{kind}:{ident}"
+
+    @asynccontextmanager
+    async def transaction(self, key: StateKey) -> AsyncIterator[dict]:
+        redis_key = self._key(key)
+        lock = self.redis.lock(f"{self.prefix}:lock:{key[0]}:{key[1]}",
+                               timeout=self.lock_timeout, blocking_timeout=self.lock_timeout)
+        if not await lock.acquire():
+            raise StateConflictError(f"{redis_key}: блокировка не получена")
+        try:
+            data, version = await self.redis.hmget(redis_key, "data", "version")
+            state = pickle.loads(data) if data else {}
+            version = version.decode() if version else "0"
+            yield state
+            empty = is_empty_state(state)
+            saved = await self._cas(
+                keys=[redis_key],
+                args=[version, b"" if empty else pickle.dumps(state), "1" if empty else "0"]
+            )
+            if not saved:
+                logging.error("Конфликт записи состояния %s", redis_key)
+                raise StateConflictError(redis_key)
+        finally:
+            # Если блокировка истекла, снять её уже нельзя – ошибка снятия не должна подменять
+            # исход транзакции (в том числе StateConflictError)
+            try:
+                await lock.release()
+            except Exception as e:
+                logging.warning("Блокировка %s истекла до конца транзакции: %s", redis_key, e)
+
+    async def keys(self) -> List[StateKey]:
+        result = []
+        async for redis_key in self.redis.scan_iter(match=f"{self.prefix}:state:*"):
+            kind, ident = redis_key.decode().rsplit(":", 2)[-2:]
+            result.append((kind, int(ident)))
+        return result
+
+    async def incr_stats(self, counters: Dict[str, int]) -> None:
+        for name, value in counters.items():
+            await self.redis.hincrby(f"{self.prefix}:stats", name, value)
+
+    async def get_stats(self) -> Dict[str, int]:
+        stats = await self.redis.hgetall(f"{self.prefix}:stats")
+        return {name.decode(): int(value) for name, value in stats.items()}
+
+
+def create_state_store(backend: str, redis_url: Optional[str] = None) -> StateStore:
+    """
+    Создаёт хранилище по имени бэкенда: "memory" (по умолчанию) или "redis".
+    """
+    if backend == "redis":
+        return RedisStateStore(redis_url or "redis://localhost:6379/0")
+    if backend != "memory":
+        logging.warning("Неизвестный бэкенд состояния %s, используем memory", backend)
+    return InMemoryStateStore()
@@ -0,0 +1,86 @@
+import json
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from state_store import StateStore, StateKey
+
+
+def touch_state(state: dict, closed: Optional[bool] = None) -> None:
+    """
+    Обновляет метаданные срока жизни состояния: время последней активности,
+    а при closed=True/False – отмечает приглашение закрытым или снова открытым.
+    """
+    meta = state.setdefault("meta", {"created_at": time.time()})
+    meta["updated_at"] = time.time()
+    if closed:
+        meta["closed_at"] = meta["updated_at"]
+    elif closed is not None:
+        meta.pop("closed_at", None)
+
+
+def archive_state(path: str, key: StateKey, kind: str, state: Any) -> None:
+    """
+    Дописывает вытесненное состояние в архив (JSON Lines). Множества сохраняются списками.
+    """
+    record = {"key": list(key), "kind": kind, "archived_at": time.time(), "state": state}
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False, default=list) + "\n")
+
+
+def expire_state(key: StateKey, state: dict, now: float, poll_ttl: float, closed_ttl: float,
+                 members_ttl: float) -> Dict[str, Any]:
+    """
+    Удаляет из состояния устаревшие части и возвращает их {вид: данные}:
+      - опрос и приглашение группы, если она неактивна дольше poll_ttl секунд;
+      - закрытое приглашение и его опрос – уже через closed_ttl секунд после последней активности;
+      - список участников группы – если группа неактивна дольше members_ttl секунд;
+      - сессию пользователя – если он неактивен дольше poll_ttl секунд.
+    """
+    meta = state.setdefault("meta", {"created_at": now, "updated_at": now})
+    idle = now - meta.get("updated_at", now)
+    evicted = {}
+    if key[0] == "user":
+        if idle > poll_ttl:
+            evicted["sessions"] = {k: state.pop(k) for k in list(state) if k != "meta"}
+        return evicted
+
+    if idle > poll_ttl or ("closed_at" in meta and idle > closed_ttl):
+        for kind, field in (("polls", "answers"), ("invitations", "invitation")):
+            if state.get(field):
+                evicted[kind] = state.pop(field)
+    if idle > members_ttl and state.get("members"):
+        evicted["members"] = state.pop("members")
+    return evicted
+
+
+async def sweep_store(store: StateStore, poll_ttl: float, closed_ttl: float, members_ttl: float,
+                      archive_path: Optional[str] = None) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """
+    Проходит по всем состояниям хранилища и вытесняет устаревшие.
+    Возвращает (счётчики вытесненного за проход, gauge: живые группы и накопленные счётчики вытеснений).
+    """
+    now = time.time()
+    evicted_counts = {"polls": 0, "invitations": 0, "members": 0, "sessions": 0}
+    live = {"live_groups": 0, "live_polls": 0, "live_invitations": 0, "live_sessions": 0}
+    for key in await store.keys():
+        async with store.transaction(key) as state:
+            evicted = expire_state(key, state, now, poll_ttl, closed_ttl, members_ttl)
+            if key[0] == "group" and any(state.get(f) for f in ("members", "invitation", "answers")):
+                live["live_groups"] += 1
+                live["live_polls"] += bool(state.get("answers"))
+                live["live_invitations"] += bool(state.get("invitation"))
+            elif key[0] == "user" and len(state) > 1:
+                live["live_sessions"] += 1
+        for kind, data in evicted.items():
+            evicted_counts[kind] += 1
+            if archive_path and kind in ("polls", "invitations"):
+                try:
+                    archive_state(archive_path, key, kind, data)
+                except OSError as e:
+                    logging.error("Не удалось заархивировать состояние %s: %s", key, e)
+
+    await store.incr_stats({f"evicted_{kind}": count for kind, count in evicted_counts.items() if count})
+    gauges = dict(live)
+    gauges.update(await store.get_stats())
+    return evicted_counts, gauges
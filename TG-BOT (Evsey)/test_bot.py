@@ -0,0 +1,119 @@
+"""
+Обработчики бота: /pollresults не блокирует event loop запросом в сервис рекомендаций
+и отвечает, даже если сервис завис. Протокол v2: копии vocabulary.py в боте и в сервисе
+рекомендаций совпадают, каждый вариант доходит до сервиса под своим id, неизвестные
+подписи пропускаются.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import asyncio
+import importlib.util
+import socket
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+import bot
+from state_store import InMemoryStateStore
+
+GROUP_ID = -100
+RECOM_VOCABULARY = Path(__file__).resolve().parent.parent / "RECOM (Vsevolod, Sergey)" / "vocabulary.py"
+
+
+@pytest.fixture
+def recom_vocabulary():
+    """
+    vocabulary.py сервиса рекомендаций (в образе бота его нет – тогда тест пропускается).
+    """
+    if not RECOM_VOCABULARY.exists():
+        pytest.skip("нет каталога сервиса рекомендаций")
+    spec = importlib.util.spec_from_file_location("recom_vocabulary", RECOM_VOCABULARY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_vocabulary_copies_match(recom_vocabulary):
+    assert Path(bot.__file__).with_name("vocabulary.py").read_bytes() == RECOM_VOCABULARY.read_bytes()
+
+
+def test_every_option_round_trips(recom_vocabulary):
+    answers = {
+        "office": bot.office_options[0],
+        "offices": {office: 0.5 for office in bot.office_options},
+        "wanted_cuisines": {option: 0.5 for option in bot.cuisine_options},
+        "food_restrictions": {option: 0.5 for option in bot.restriction_options},
+        "price_limit": {option: 0.5 for option in bot.budget_options},
+        "walk_time": {option: 0.5 for option in bot.walk_time_options},
+    }
+    payload = bot.encode_user_answers(answers)
+    # Сервис рекомендаций разбирает id по своей копии словаря
+    assert recom_vocabulary.OFFICES[payload["office"]] == answers["office"]
+    assert [recom_vocabulary.OFFICES[i] for i, _ in payload["offices"]] == list(answers["offices"])
+    for field, options, question in (("cuisines", recom_vocabulary.CUISINES, "wanted_cuisines"),
+                                     ("restrictions", recom_vocabulary.RESTRICTIONS, "food_restrictions"),
+                                     ("budget", recom_vocabulary.BUDGETS, "price_limit"),
+                                     ("walk", recom_vocabulary.WALK_TIMES, "walk_time")):
+        assert [options[i][0] for i, _ in payload[field]] == list(answers[question])
+
+
+def test_unknown_options_are_skipped():
+    payload = bot.encode_user_answers({
+        "office": "Не выбрано",
+        "wanted_cuisines": {bot.cuisine_options[0]: 0.5, "🍕 Итальянская": 0.5},
+        "walk_time": {"🚶 До часа": 1.0},
+    })
+    assert payload["office"] is None
+    assert payload["cuisines"] == [[bot.CUISINE_IDS[bot.cuisine_options[0]], 0.5]]
+    assert payload["walk"] == []
+
+
+@pytest.fixture
+def hung_recommender(monkeypatch):
+    """
+    Сервис рекомендаций, который принимает соединение и никогда не отвечает.
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    monkeypatch.setattr(bot, "RECOMMENDER_URL", f"http://127.0.0.1:{server.getsockname()[1]}")
+    monkeypatch.setattr(bot, "RECOMMENDER_TIMEOUT", 0.5)
+    yield
+    server.close()
+
+
+def test_poll_results_survives_hung_recommender(monkeypatch, hung_recommender):
+    store = InMemoryStateStore()
+    monkeypatch.setattr(bot, "state_store", store)
+
+    async def main():
+        async with store.transaction(("group", GROUP_ID)) as state:
+            answers = bot.get_group_answers(state, create=True)
+            answers["all_users"].add(1)
+            answers["wanted_cuisines"][bot.cuisine_options[0]].add(1)
+        update = SimpleNamespace(effective_chat=SimpleNamespace(type="group", id=GROUP_ID),
+                                 message=SimpleNamespace(reply_text=AsyncMock()))
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.05)
+                ticks += 1
+
+        ticking = asyncio.create_task(ticker())
+        await bot.poll_results(update, None)
+        ticking.cancel()
+        return ticks, update.message.reply_text.await_args.args[0]
+
+    ticks, reply = asyncio.run(main())
+    # Пока ждали ответа, event loop продолжал обслуживать другие корутины
+    assert ticks >= 5
+    assert "недоступен" in reply
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,107 @@
+"""
+OutboundDispatcher: flood-wait останавливает все отправки, неидемпотентный sendMessage
+не повторяется после таймаута, если запрос мог дойти до Telegram, а фоновые рассылки
+ограничены очередью.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from telegram.error import RetryAfter, TimedOut
+
+from dispatcher import DELIVERED, UNKNOWN, OutboundDispatcher
+
+
+class FakeBot:
+    """
+    Бот, который отвечает ошибками из errors по очереди, а затем отправляет сообщения.
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+
+    async def send_message(self, chat_id, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, time.monotonic()))
+        return SimpleNamespace(chat_id=chat_id)
+
+
+def timed_out(cause):
+    try:
+        raise TimedOut() from cause
+    except TimedOut as e:
+        return e
+
+
+def test_retry_after_pauses_all_chats():
+    async def main():
+        dispatcher = OutboundDispatcher(global_rate=100)
+        bot = FakeBot(RetryAfter(0.3))
+        started_at = time.monotonic()
+        results = await dispatcher.fan_out(bot, [(chat_id, {"text": "x"}) for chat_id in range(5)])
+        return results, bot.sent, started_at
+
+    results, sent, started_at = asyncio.run(main())
+    assert {status for status, _ in results.values()} == {DELIVERED}
+    assert len(sent) == 5
+    # Flood-wait пришёл первому чату, но паузу выдержали и все остальные
+    assert all(sent_at - started_at >= 0.3 for _, sent_at in sent)
+
+
+def test_timed_out_is_not_retried():
+    async def main():
+        bot = FakeBot(timed_out(httpx.ReadTimeout("read")))
+        return await OutboundDispatcher().send_message(bot, 1, text="x"), bot.sent
+
+    (status, _), sent = asyncio.run(main())
+    assert status == UNKNOWN
+    assert sent == []
+
+
+def test_timeout_before_sending_is_retried():
+    async def main():
+        bot = FakeBot(timed_out(httpx.PoolTimeout("pool")))
+        return await OutboundDispatcher().send_message(bot, 1, text="x"), bot.sent
+
+    (status, _), sent = asyncio.run(main())
+    assert status == DELIVERED
+    assert len(sent) == 1
+
+
+def test_submit_bounds_background_jobs():
+    async def main():
+        dispatcher = OutboundDispatcher(max_jobs=2, max_queued_jobs=3)
+        release = asyncio.Event()
+        running, peak = 0, 0
+
+        async def job():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await release.wait()
+            running -= 1
+
+        tasks = []
+        for _ in range(5):
+            await dispatcher.submit(job, lambda coroutine: tasks.append(asyncio.create_task(coroutine)))
+        # Очередь заполнена: шестая рассылка ждёт, пока освободится место
+        sixth = asyncio.create_task(dispatcher.submit(job, lambda coroutine: tasks.append(asyncio.create_task(coroutine))))
+        await asyncio.sleep(0.05)
+        blocked = not sixth.done()
+        release.set()
+        await sixth
+        await asyncio.gather(*tasks)
+        return blocked, peak, len(tasks)
+
+    assert asyncio.run(main()) == (True, 2, 6)
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
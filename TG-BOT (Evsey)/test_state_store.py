@@ -0,0 +1,155 @@
+"""
+RedisStateStore на fakeredis: параллельные голоса из нескольких процессов бота не теряются,
+запись после истёкшей блокировки отклоняется (StateConflictError), а ошибка ответа в Telegram
+не отменяет записанный голос. Оба хранилища не сохраняют изменения транзакции с исключением.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import fakeredis
+import pytest
+
+import bot
+from state_store import InMemoryStateStore, RedisStateStore, StateConflictError
+
+GROUP_ID = -100
+
+
+def make_stores(count, **kwargs):
+    """
+    Хранилища, как у count процессов бота с общим сервером Redis.
+    """
+    server = fakeredis.FakeServer()
+    return [RedisStateStore(client=fakeredis.aioredis.FakeRedis(server=server), **kwargs) for _ in range(count)]
+
+
+def poll_query(user_id, data, edit_error=None):
+    return SimpleNamespace(
+        data=data,
+        from_user=SimpleNamespace(id=user_id),
+        answer=AsyncMock(),
+        edit_message_text=AsyncMock(),
+        edit_message_reply_markup=AsyncMock(side_effect=edit_error)
+    )
+
+
+async def start_poll(store, user_ids):
+    async with store.transaction(("group", GROUP_ID)) as state:
+        state["answers"] = bot.init_group_data()
+    for user_id in user_ids:
+        async with store.transaction(("user", user_id)) as session:
+            session["group_id"] = GROUP_ID
+
+
+async def read_group(store):
+    async with store.transaction(("group", GROUP_ID)) as state:
+        return state
+
+
+def test_concurrent_transactions_keep_all_votes():
+    async def main():
+        stores = make_stores(3)
+
+        async def vote(store, user_id):
+            async with store.transaction(("group", GROUP_ID)) as state:
+                votes = state.setdefault("votes", set())
+                # Переключение на другие корутины внутри транзакции
+                await asyncio.sleep(0)
+                votes.add(user_id)
+
+        await asyncio.gather(*(vote(stores[user_id % 3], user_id) for user_id in range(20)))
+        return (await read_group(stores[0]))["votes"]
+
+    assert asyncio.run(main()) == set(range(20))
+
+
+def test_expired_lock_raises_conflict():
+    async def main():
+        slow, fast = make_stores(2, lock_timeout=0.2)
+
+        async def slow_vote():
+            async with slow.transaction(("group", GROUP_ID)) as state:
+                state["votes"] = {"slow"}
+                # Дольше блокировки: её успевает взять другой процесс
+                await asyncio.sleep(0.5)
+
+        async def fast_vote():
+            await asyncio.sleep(0.3)
+            async with fast.transaction(("group", GROUP_ID)) as state:
+                state.setdefault("votes", set()).add("fast")
+
+        results = await asyncio.gather(slow_vote(), fast_vote(), return_exceptions=True)
+        return results, (await read_group(fast))["votes"]
+
+    (slow_result, fast_result), votes = asyncio.run(main())
+    assert isinstance(slow_result, StateConflictError)
+    assert fast_result is None
+    assert votes == {"fast"}
+
+
+@pytest.mark.parametrize("store", [InMemoryStateStore(), make_stores(1)[0]], ids=["memory", "redis"])
+def test_failed_transaction_keeps_state(store):
+    async def main():
+        async with store.transaction(("group", GROUP_ID)) as state:
+            state["answers"] = bot.init_group_data()
+            state["answers"]["all_users"].add(1)
+        with pytest.raises(RuntimeError):
+            async with store.transaction(("group", GROUP_ID)) as state:
+                state["answers"]["all_users"].add(2)
+                state["invitation"] = {"invitees": {2}}
+                raise RuntimeError("ошибка в обработчике")
+        return await read_group(store)
+
+    state = asyncio.run(main())
+    assert state["answers"]["all_users"] == {1}
+    assert "invitation" not in state
+
+
+def test_concurrent_poll_votes_survive_failed_replies(monkeypatch):
+    store, = make_stores(1)
+    monkeypatch.setattr(bot, "state_store", store)
+    user_ids = list(range(1, 11))
+    option = bot.cuisine_options[0]
+
+    async def main():
+        await start_poll(store, user_ids)
+        # Каждому второму Telegram отвечает ошибкой – голос всё равно должен сохраниться
+        queries = [poll_query(user_id, "cuisine_0", RuntimeError("Telegram недоступен") if user_id % 2 else None)
+                   for user_id in user_ids]
+        results = await asyncio.gather(*(bot.poll_callback(SimpleNamespace(callback_query=query), None)
+                                         for query in queries), return_exceptions=True)
+        return queries, results, await read_group(store)
+
+    queries, results, state = asyncio.run(main())
+    assert [isinstance(result, RuntimeError) for result in results] == [bool(user_id % 2) for user_id in user_ids]
+    assert state["answers"]["wanted_cuisines"][option] == set(user_ids)
+    for query in queries:
+        query.edit_message_reply_markup.assert_awaited_once()
+
+
+def test_poll_reply_is_sent_after_transaction(monkeypatch):
+    store, = make_stores(1)
+    monkeypatch.setattr(bot, "state_store", store)
+
+    async def main():
+        await start_poll(store, [1])
+        lock = store.redis.lock(f"{store.prefix}:lock:group:{GROUP_ID}")
+        locked_during_reply = []
+
+        async def edit(*args, **kwargs):
+            locked_during_reply.append(await lock.locked())
+
+        query = poll_query(1, "cuisine_0")
+        query.edit_message_reply_markup.side_effect = edit
+        await bot.poll_callback(SimpleNamespace(callback_query=query), None)
+        return locked_during_reply
+
+    assert asyncio.run(main()) == [False]
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))